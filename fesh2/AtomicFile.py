@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+import binascii
+import errno
+import fcntl
+import os
+import shutil
+from os import path
+
+# Files are replaced by writing a temporary file in the same directory and renaming it over the old one,
+# so readers (drudg, the FS, other fesh2 instances) only ever see a whole file, and the old file's inode is
+# never changed. Copies are made as reflinks where the file system supports them, so they take no time or
+# space. They are never hard links: a working file may be changed in place (e.g. by an editor or touch),
+# which would change every name for it.
+
+# Rename a file over another in one step. os.replace is Python 3 only. On Python 2 os.rename does the same
+# thing on POSIX systems.
+replace = getattr(os, "replace", os.rename)
+
+# ioctl to make a file share the data blocks of another (from linux/fs.h)
+FICLONE = 0x40049409
+
+
+def temp_file(filename):
+    """
+    Create an empty temporary file in the same directory as filename, so it can be renamed over it
+
+    :param filename: the file the temporary file will replace
+    :return: (file descriptor, temporary file name)
+    """
+    (directory, name) = path.split(filename)
+    while True:
+        # starting with a dot keeps it out of the way of things looking for schedule files
+        tmp = path.join(
+            directory, ".{}.{}.tmp".format(name, binascii.hexlify(os.urandom(4)).decode())
+        )
+        try:
+            # unlike tempfile.mkstemp, the permissions follow the umask like any other new file
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                continue
+            raise
+        return (fd, tmp)
+
+
+def reflink(src, dst):
+    """Make dst a copy of src that shares its data blocks, on file systems that support it (e.g. btrfs and
+    XFS). It takes no time or space, and unlike a hard link, changing one file doesn't change the other.
+    Returns False if it can't be done."""
+    with open(src, "rb") as fsrc:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            fcntl.ioctl(fd, FICLONE, fsrc.fileno())
+        except (IOError, OSError):
+            os.close(fd)
+            os.remove(dst)
+            return False
+        os.close(fd)
+    shutil.copystat(src, dst)
+    return True
+
+
+def copy_file(src, dst):
+    """Make dst an independent copy of src: a reflink or a real copy. dst mustn't exist."""
+    if not reflink(src, dst):
+        shutil.copy2(src, dst)
+
+
+def copy_replace(src, dst):
+    """Make dst an independent copy of src (see copy_file), replacing dst in one step if it exists"""
+    (fd, tmp) = temp_file(dst)
+    os.close(fd)
+    try:
+        # copy_file can't overwrite the temporary file
+        os.remove(tmp)
+        copy_file(src, tmp)
+        replace(tmp, dst)
+    except (IOError, OSError):
+        if path.exists(tmp):
+            os.remove(tmp)
+        raise
+
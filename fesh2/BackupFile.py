@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+import logging
+import os
+import re
+import threading
+from collections import namedtuple
+from os import path
+
+from fesh2.AtomicFile import copy_file
+from fesh2.FileManifest import connect, file_sha256
+
+# The backups of a file: the latest and oldest versions kept, and the content of the latest
+BackupEntry = namedtuple(
+    "BackupEntry", ["path", "version", "oldest", "sha256", "size"]
+)
+
+
+class BackupFile:
+    """ Manage backup file naming, creation, removal etc.
+
+    Backups are called <file>.bak.N, with N counting up from 1. The latest version number of each file is
+    kept in the database in the schedule directory (with the hash of its content) so the next name is
+    known without looking for the existing backups, and a backup is only made if the file is different
+    to the latest one. Backups are made as reflinks where possible rather than copies (see
+    AtomicFile.copy_file). They are never hard links to the file, which may be changed in place.
+
+    If keep is set, only that many backups of each file are kept and older ones are removed.
+    """
+
+    def __init__(self, directory, keep=0, manifest=None):
+        """
+        :param directory: where to keep the database (usually the schedule directory)
+        :param keep: the number of backups to keep for each file (0 = keep them all)
+        :param manifest: a FileManifest.Manifest to get file hashes from (optional)
+        """
+        # file extension
+        self.suffix = "bak"
+        self.keep = keep
+        self.manifest = manifest
+        self.lock = threading.Lock()
+        self.db = connect(directory)
+        with self.lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS backups ("
+                "path TEXT PRIMARY KEY, version INTEGER, oldest INTEGER, sha256 TEXT, size INTEGER)"
+            )
+
+    def backup_file_name(self, name, version):
+        """ Given a file name and a versio, return the name of
+        the corresponding backup file
+        :param name: file name
+        :type name: string
+        :param version:
+        :type version: int
+        :return: filename
+        :rtype: string
+        """
+        return "{}.{}.{}".format(name, self.suffix, version)
+
+    def find_versions(self, filename):
+        """The version numbers of the backups of a file that exist, from the directory. Only needed for files
+        that aren't in the database yet."""
+        (directory, name) = path.split(filename)
+        regex = re.compile(r"^{}\.{}\.(\d+)$".format(re.escape(name), self.suffix))
+        versions = []
+        for entry in os.listdir(directory or "."):
+            match = regex.match(entry)
+            if match:
+                versions.append(int(match.group(1)))
+        return sorted(versions)
+
+    def get(self, filename):
+        """The BackupEntry for a file, from the database or the existing backups. None if there are none."""
+        row = self.db.execute(
+            "SELECT {} FROM backups WHERE path = ?".format(
+                ", ".join(BackupEntry._fields)
+            ),
+            (filename,),
+        ).fetchone()
+        if row:
+            return BackupEntry(*row)
+        versions = self.find_versions(filename)
+        if not versions:
+            return None
+        latest = self.backup_file_name(filename, versions[-1])
+        return BackupEntry(
+            filename, versions[-1], versions[0], None, os.stat(latest).st_size
+        )
+
+    def sha256(self, filename):
+        if self.manifest:
+            return self.manifest.sha256(filename)
+        return file_sha256(filename)
+
+    def backup_file(self, filename):
+        """ Make a backup of the file and give it a suffix plus version number, unless the latest backup
+        has the same content.
+
+        :param filename: Full path to the file
+        :type filename: string
+        :return: The backup file name
+        :rtype: string
+        """
+        if not path.exists(filename):
+            msg = "File to be backed up was not found: {}".format(filename)
+            logging.error(msg)
+            raise Exception(msg)
+
+        # before the database is locked, as the manifest may be updated
+        sha256 = self.sha256(filename)
+        with self.lock:
+            # hold the database so another fesh2 instance can't take the same version
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                newfile = self.make_backup(filename, sha256)
+                self.db.commit()
+            except Exception:
+                self.db.rollback()
+                raise
+        return newfile
+
+    def make_backup(self, filename, sha256):
+        entry = self.get(filename)
+        size = os.stat(filename).st_size
+        if entry:
+            latest = self.backup_file_name(filename, entry.version)
+            if path.exists(latest):
+                if entry.size == size:
+                    if entry.sha256 is None:
+                        entry = entry._replace(sha256=file_sha256(latest))
+                    if sha256 == entry.sha256:
+                        logging.debug(
+                            "{} is the same as its latest backup".format(filename)
+                        )
+                        return latest
+            version = entry.version + 1
+            oldest = entry.oldest
+        else:
+            version = 1
+            oldest = 1
+        newfile = self.backup_file_name(filename, version)
+        while path.exists(newfile):
+            # made without the database (e.g. by an older fesh2)
+            version += 1
+            newfile = self.backup_file_name(filename, version)
+        copy_file(filename, newfile)
+        oldest = self.prune(filename, oldest, version)
+        self.db.execute(
+            "INSERT OR REPLACE INTO backups ({}) VALUES (?, ?, ?, ?, ?)".format(
+                ", ".join(BackupEntry._fields)
+            ),
+            (filename, version, oldest, sha256, size),
+        )
+        return newfile
+
+    def prune(self, filename, oldest, version):
+        """Remove the backups of a file that are too old to keep. Returns the oldest version left."""
+        if not self.keep:
+            return oldest
+        first_kept = max(oldest, version - self.keep + 1)
+        for old in range(oldest, first_kept):
+            old_file = self.backup_file_name(filename, old)
+            if path.exists(old_file):
+                logging.info("Removing old backup {}".format(old_file))
+                os.remove(old_file)
+        return first_kept
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime
+from os import path
+
+from fesh2.DirSnapshot import file_mtime
+
+# Sessions starting within this time have their schedules checked every ScheduleCheckTime (hours)
+imminent_h = 24.0
+# Otherwise the interval between checks is this fraction of the time to the start of the session
+interval_fraction = 0.25
+# ... but a schedule that changed this recently is checked every ScheduleCheckTime as it may change again
+# (hours)
+changed_recently_h = 24.0
+# The longest interval between checks of a schedule (hours)
+max_interval_h = 24.0
+
+
+def check_interval(config, ses, local_file, now=None):
+    """
+    The time between checks of a session's schedule on the servers (hours). Sessions that are about to
+    start, schedules that changed recently and schedules we haven't got yet are checked more often than
+    sessions a long way off. The result is between ScheduleCheckTime and the larger of ScheduleCheckTime
+    and max_interval_h. Only sessions within LookAheadTimeDays are checked at all.
+
+    :param config: configuration parameters (from the config file)
+    :param ses: the session
+    :param local_file: the local schedule file name (which may not exist yet)
+    :param now: the current time (UTC datetime, default is now)
+    """
+    if now is None:
+        now = datetime.utcnow()
+    shortest = config.ScheduleCheckTime
+    to_start_h = (ses.start - now).total_seconds() / 3600
+    if to_start_h <= imminent_h:
+        return shortest
+    interval = to_start_h * interval_fraction
+    mtime = file_mtime(local_file, config.snapshot)
+    if mtime is not None:
+        changed_h = (time.time() - mtime) / 3600
+        if changed_h < changed_recently_h:
+            return shortest
+    else:
+        # still waiting for it to be released
+        interval /= 2
+    return max(shortest, min(interval, max_interval_h))
+
+
+class CheckScheduler:
+    """ Runs the schedule checks when they are due. The master files and the schedule file of each session
+    have their own deadline (the time they were last checked on the servers plus the check interval, see
+    check_interval) kept in a priority queue. A single long-lived worker thread sleeps until the earliest
+    deadline and then runs a check, which updates the files that are due. The worker can be woken at any
+    time by trigger() (to check now) or stop().
+
+    Files changed locally (see FileWatcher) are passed to changed(). A new master file triggers a check;
+    other changes are handled by local_task for just the sessions affected.
+
+    Requests from the control socket are also handled by the worker: force() downloads the schedules of
+    particular sessions in the next check, and reconfigure() changes the configuration between checks.
+    """
+
+    # Don't run checks closer together than this (sec), even if a file still seems to be due
+    min_wait_s = 60
+    # A little extra wait past a deadline so the file is definitely due when we check (sec)
+    margin_s = 30
+
+    def __init__(self, config, task, local_task=None):
+        """
+        :param config: configuration parameters (from the config file)
+        :param task: called with the config to do a check. Returns the sessions that were considered.
+        :param local_task: called with the config and a set of session codes to process sessions with
+                           locally changed files
+        """
+        self.config = config
+        self.task = task
+        self.local_task = local_task
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.triggered = False
+        # sessions with locally changed files waiting for local_task
+        self.pending = set()
+        # sessions to download schedules for in the next check, whether they're due or not
+        self.forced = set()
+        # functions to call with the config before the next check
+        self.reconfigures = []
+        # True while a task is running
+        self.running = False
+        # a FileWatcher, rescanned after each task so our own changes aren't reported
+        self.watcher = None
+        # heap of (deadline, master file or session code). Deadlines are time.time() values
+        self.queue = []
+        self.last_run = 0
+        self.thread = None
+
+    def start(self, sessions):
+        """Start the worker thread
+
+        :param sessions: the sessions from the last check
+        """
+        self.update_deadlines(sessions)
+        self.thread = threading.Thread(name="sched_check", target=self.run)
+        self.thread.start()
+
+    def trigger(self):
+        """Do a check now"""
+        with self.cond:
+            self.triggered = True
+            self.cond.notify()
+
+    def stop(self):
+        """Stop the worker as soon as it isn't running a check"""
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+
+    def force(self, codes):
+        """Download the schedules for these sessions now, whether they're due for a check or not
+
+        :param codes: session codes
+        """
+        with self.cond:
+            self.forced.update(codes)
+            self.triggered = True
+            self.cond.notify()
+
+    def reconfigure(self, func):
+        """Change the configuration when no check is running, then do a check
+
+        :param func: called as func(config) from the worker thread
+        """
+        with self.cond:
+            self.reconfigures.append(func)
+            self.triggered = True
+            self.cond.notify()
+
+    def state(self):
+        """What the worker is doing, as a dictionary"""
+        with self.cond:
+            due = self.next_check()
+            return {
+                "running": self.running,
+                "next_check": due,
+                "next_check_utc": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(due)),
+                "pending": sorted(self.pending),
+                "forced": sorted(self.forced),
+            }
+
+    def changed(self, codes, master):
+        """Files have changed locally. Changes while a task is running are ignored as they're most likely
+        made by the task.
+
+        :param codes: session codes with changed schedule or drudg output files
+        :param master: True if a master file changed
+        """
+        with self.cond:
+            if self.running:
+                return
+            if master:
+                self.triggered = True
+            if self.local_task:
+                self.pending.update(codes)
+            self.cond.notify()
+
+    def join(self):
+        """Wait for the worker to stop"""
+        if self.thread:
+            # with a timeout, as on Python 2 a join without one can't be interrupted by Ctrl-C
+            while self.thread.is_alive():
+                self.thread.join(1)
+
+    def deadline(self, local_file, interval_h):
+        """When a file is next due for a check on the servers"""
+        entry = self.config.check_state.get(local_file)
+        if not entry:
+            # never checked
+            return 0
+        # entry.checked is the time of the last attempt, successful or not
+        return entry.checked + interval_h * 3600
+
+    def update_deadlines(self, sessions):
+        """Work out when each file is next due from the times they were last checked
+
+        :param sessions: the sessions from the last check
+        """
+        cnf = self.config
+        queue = []
+        masters = []
+        if cnf.GetMaster:
+            masters.append("{}/master{:02d}.txt".format(cnf.SchedDir, cnf.year - 2000))
+        if cnf.GetMasterIntensive:
+            masters.append(
+                "{}/master{:02d}-int.txt".format(cnf.SchedDir, cnf.year - 2000)
+            )
+        for local_file in masters:
+            queue.append((self.deadline(local_file, cnf.MasterCheckTime), local_file))
+        now = datetime.utcnow()
+        for ses in sessions or []:
+            # Only the first local type is checked, or the first type in the list if there isn't one
+            local_file = "{}/{}.{}".format(cnf.SchedDir, ses.code, cnf.SchedTypes[0])
+            for sched_type in cnf.SchedTypes:
+                name = "{}/{}.{}".format(cnf.SchedDir, ses.code, sched_type)
+                if path.exists(name):
+                    local_file = name
+                    break
+            interval = check_interval(cnf, ses, local_file, now)
+            queue.append((self.deadline(local_file, interval), ses.code))
+        heapq.heapify(queue)
+        with self.cond:
+            self.queue = queue
+        if queue:
+            logging.debug(
+                "Next file due for a check: {} at {}".format(
+                    queue[0][1],
+                    time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(queue[0][0])),
+                )
+            )
+
+    def next_check(self):
+        """The time of the next check"""
+        # Never wait longer than the shortest check interval, so new sessions are noticed
+        due = self.last_run + 3600 * min(
+            self.config.ScheduleCheckTime, self.config.MasterCheckTime
+        )
+        if self.queue:
+            due = min(due, self.queue[0][0])
+        return max(due + self.margin_s, self.last_run + self.min_wait_s)
+
+    def run(self):
+        """The worker thread: wait for the next deadline (or a trigger or a local change) then do a check"""
+        self.last_run = time.time()
+        while True:
+            with self.cond:
+                logged = False
+                while not (self.stopping or self.triggered or self.pending):
+                    wait = self.next_check() - time.time()
+                    if wait <= 0:
+                        self.triggered = True
+                        break
+                    if not logged:
+                        logging.info(
+                            "Next check in {}".format(
+                                time.strftime("%H:%M:%S", time.gmtime(wait))
+                            )
+                        )
+                        logged = True
+                    self.cond.wait(wait)
+                if self.stopping:
+                    break
+                # a full check covers any local changes too
+                full = self.triggered
+                codes = self.pending
+                forced = self.forced
+                reconfigures = self.reconfigures
+                self.triggered = False
+                self.pending = set()
+                self.forced = set()
+                self.reconfigures = []
+                self.running = True
+            for func in reconfigures:
+                try:
+                    func(self.config)
+                except Exception:
+                    logging.exception("Changing the configuration failed")
+            sessions = None
+            try:
+                if full:
+                    self.config.force_sessions = forced
+                    sessions = self.task(self.config)
+                else:
+                    self.local_task(self.config, codes)
+            except Exception:
+                logging.exception("The schedule check failed")
+            with self.cond:
+                self.running = False
+            if full:
+                self.last_run = time.time()
+                if sessions is not None:
+                    self.update_deadlines(sessions)
+            if self.watcher:
+                self.watcher.scan()
+        logging.debug("The sched_check thread has stopped")
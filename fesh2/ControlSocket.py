@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+import errno
+import json
+import logging
+import os
+import select
+import socket
+import threading
+from os import path
+
+
+class ControlServer:
+    """ A Unix socket that a running fesh2 daemon listens on, so other processes (e.g. fesh2 --check) can
+    get its status or ask it to do something without reading the config, master files and directories
+    themselves.
+
+    Each connection carries one request and one response, both a JSON object on a single line. Requests
+    are passed to a handler function, which returns the response. Requests are handled one at a time in
+    the server's own thread.
+    """
+
+    # Give up on a client that doesn't send its request in this time (sec)
+    timeout_s = 10
+
+    def __init__(self, filename, handler):
+        """
+        :param filename: the socket file name
+        :param handler: called as handler(request) with the request (a dictionary). Returns the response
+                        (a dictionary)
+        """
+        self.filename = filename
+        self.handler = handler
+        self.sock = None
+        self.stopping = threading.Event()
+        # used to wake the thread when stopping
+        (self.wake_r, self.wake_w) = os.pipe()
+        self.thread = None
+
+    def start(self):
+        """Start listening in a separate thread. Returns False if the socket can't be used."""
+        if path.exists(self.filename):
+            if send_request(self.filename, {"command": "ping"}) is not None:
+                logging.warning(
+                    "Another fesh2 instance is listening on {}. Not starting the control socket.".format(
+                        self.filename
+                    )
+                )
+                return False
+            # left behind by an instance that didn't stop cleanly
+            try:
+                os.remove(self.filename)
+            except OSError as e:
+                logging.warning(
+                    "Can't remove the old control socket {}: {}".format(self.filename, e)
+                )
+                return False
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # The socket is made with the permissions it needs (the FS users, oper and prog, share a group), so
+        # no-one else can connect before they could be changed
+        old_umask = os.umask(0o117)
+        try:
+            self.sock.bind(self.filename)
+            self.sock.listen(5)
+        except (OSError, socket.error) as e:
+            logging.warning(
+                "Can't start the control socket {}: {}".format(self.filename, e)
+            )
+            self.sock.close()
+            self.sock = None
+            return False
+        finally:
+            os.umask(old_umask)
+        logging.info("Listening for requests on {}".format(self.filename))
+        self.thread = threading.Thread(name="control", target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def stop(self):
+        self.stopping.set()
+        os.write(self.wake_w, b"x")
+        if self.thread:
+            self.thread.join()
+        if self.sock:
+            self.sock.close()
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def run(self):
+        fds = [self.sock, self.wake_r]
+        while not self.stopping.is_set():
+            try:
+                (ready, _, _) = select.select(fds, [], [])
+            except (OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.stopping.is_set():
+                break
+            try:
+                (conn, _) = self.sock.accept()
+            except (OSError, socket.error) as e:
+                logging.debug("Control socket accept failed: {}".format(e))
+                continue
+            try:
+                self.serve(conn)
+            except Exception:
+                logging.exception("Error handling a control request")
+            finally:
+                conn.close()
+
+    def serve(self, conn):
+        """Read one request from a connection and send the response"""
+        conn.settimeout(self.timeout_s)
+        try:
+            request = json.loads(read_line(conn).decode("utf-8"))
+        except (OSError, socket.error, ValueError) as e:
+            send_line(conn, {"ok": False, "error": "Bad request: {}".format(e)})
+            return
+        if not isinstance(request, dict):
+            send_line(conn, {"ok": False, "error": "The request must be a JSON object"})
+            return
+        if request.get("command") == "ping":
+            response = {"ok": True}
+        else:
+            response = self.handler(request)
+        send_line(conn, response)
+
+
+def read_line(conn):
+    """Read up to the end of the first line from a socket"""
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def send_line(conn, message):
+    """Send a dictionary as a line of JSON"""
+    conn.sendall((json.dumps(message) + "\n").encode("utf-8"))
+
+
+def send_request(filename, request, timeout=10):
+    """
+    Send a request to a fesh2 daemon's control socket
+
+    :param filename: the socket file name
+    :param request: the request (a dictionary with at least a "command")
+    :param timeout: how long to wait for the response (sec)
+    :return: the response (a dictionary), or None if there's no daemon listening
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(filename)
+        send_line(sock, request)
+        return json.loads(read_line(sock).decode("utf-8"))
+    except (OSError, socket.error, ValueError):
+        return None
+    finally:
+        sock.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+import os
+from os import path
+
+try:
+    from os import scandir
+except ImportError:
+    # Python < 3.5
+    scandir = None
+
+
+class DirSnapshot:
+    """ The contents of directories, read once and then used to answer all the questions about which files
+    exist and when they were modified. Each directory is read with one scandir call the first time a file in
+    it is asked about, and a file is only stat'ed the first time its modification time is needed. This
+    saves a lot of system calls on NFS-mounted directories.
+
+    The snapshot isn't updated when files change, so call invalidate() after changing files in the
+    directories.
+    """
+
+    def __init__(self):
+        # directory -> {name: DirEntry (or None if scandir isn't available)}
+        self.dirs = {}
+        # full path -> stat result
+        self.stats = {}
+
+    def entries(self, directory):
+        """The names in a directory (an empty dictionary if it can't be read)"""
+        directory = directory.rstrip("/") or "/"
+        # local variables rather than looking in self.dirs again, in case another thread calls invalidate
+        entries = self.dirs.get(directory)
+        if entries is None:
+            try:
+                if scandir:
+                    entries = dict((entry.name, entry) for entry in scandir(directory))
+                else:
+                    entries = dict((name, None) for name in os.listdir(directory))
+            except OSError:
+                entries = {}
+            self.dirs[directory] = entries
+        return entries
+
+    def exists(self, filename):
+        """Does the file exist?"""
+        (directory, name) = path.split(filename)
+        return name in self.entries(directory)
+
+    def stat(self, filename):
+        """The stat result for a file, or None if it doesn't exist"""
+        (directory, name) = path.split(filename)
+        entries = self.entries(directory)
+        if name not in entries:
+            return None
+        stinfo = self.stats.get(filename)
+        if stinfo is None:
+            entry = entries[name]
+            try:
+                if entry is not None:
+                    stinfo = entry.stat()
+                else:
+                    stinfo = os.stat(filename)
+            except OSError:
+                # removed since the directory was read
+                return None
+            self.stats[filename] = stinfo
+        return stinfo
+
+    def mtime(self, filename):
+        """The modification time of a file, or None if it doesn't exist"""
+        stinfo = self.stat(filename)
+        if stinfo is None:
+            return None
+        return stinfo.st_mtime
+
+    def refresh(self, filenames):
+        """Look at some files again, e.g. once we hold the lock on them and another process may have changed
+        them since the directory was read"""
+        for filename in filenames:
+            (directory, name) = path.split(filename)
+            entries = self.entries(directory)
+            try:
+                self.stats[filename] = os.stat(filename)
+                entries[name] = None
+            except OSError:
+                entries.pop(name, None)
+                self.stats.pop(filename, None)
+
+    def invalidate(self):
+        """Forget everything, so the directories are read again"""
+        self.dirs = {}
+        self.stats = {}
+
+
+def file_exists(filename, snapshot=None):
+    """path.exists, using the snapshot if there is one"""
+    if snapshot is not None:
+        return snapshot.exists(filename)
+    return path.exists(filename)
+
+
+def file_mtime(filename, snapshot=None):
+    """The modification time of a file (or None if it doesn't exist), using the snapshot if there is one"""
+    if snapshot is not None:
+        return snapshot.mtime(filename)
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
@@ -1,10 +1,108 @@
 #!/usr/bin/env python3
+import hashlib
 import os
 import pexpect
 import re
 import logging
+import shutil
+import subprocess
+import tempfile
+import threading
 import time
 from os import path
+
+from fesh2.AtomicFile import replace, temp_file
+from fesh2.DirSnapshot import file_exists, file_mtime
+from fesh2.FileManifest import connect, file_sha256
+
+# Prompts drudg may give when making the SNP and PRC files, depending on skedf.ctl, the equipment and
+# whether the output files already exist. The main menu prompt is first.
+prompts = ['\r\n \?',
+           'purge existing',
+           'Enter TPI period in centiseconds',
+           'Enter in cont_cal action',
+           'Enter in cont_cal_polarity',
+           'Enter in vsi_align']
+prompt_names = [None, 'purge', 'tpi', 'cont_cal', 'cont_cal_polarity', 'vsi_align']
+
+
+class DrudgProfiles:
+    """ The prompts drudg gives when making the SNP and PRC files (menu options 3 and 12) for each drudg
+    executable, station and schedule type, and the directories it writes them to. These are recorded by the
+    pexpect driver and used by the batch driver to answer the prompts in advance. Whether drudg asks to purge
+    an existing file depends on the file being there, so the batch driver checks that for itself.
+
+    They are kept in the database in the schedule directory, so the batch driver can be used by later fesh2
+    runs (e.g. with --once) and after a restart, not just by the process that recorded them.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: where to keep the database (usually the schedule directory)
+        """
+        self.lock = threading.Lock()
+        self.profiles = {}
+        self.db = connect(directory)
+        with self.lock, self.db:
+            columns = [
+                row[1] for row in self.db.execute("PRAGMA table_info(drudg_profiles)")
+            ]
+            if columns and "snp_dir" not in columns:
+                # made by an older fesh2 without the output directories. The profiles will be recorded again.
+                self.db.execute("DROP TABLE drudg_profiles")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS drudg_profiles ("
+                "drudg TEXT, station TEXT, sched_type TEXT, snp TEXT, prc TEXT, snp_dir TEXT, prc_dir TEXT, "
+                "PRIMARY KEY (drudg, station, sched_type))"
+            )
+        self.load()
+
+    def load(self):
+        """Read the profiles from the database (other fesh2 instances may have recorded some)"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT drudg, station, sched_type, snp, prc, snp_dir, prc_dir FROM drudg_profiles"
+            ).fetchall()
+            # the prompts are stored as space-separated names
+            self.profiles = dict(
+                ((drudg, station, sched_type), (snp.split(), prc.split(), snp_dir, prc_dir))
+                for (drudg, station, sched_type, snp, prc, snp_dir, prc_dir) in rows
+            )
+
+    def get(self, key):
+        """The (SNP prompts, PRC prompts, SNP directory, PRC directory) for a (drudg executable, station,
+        schedule type), or None. The directories are where drudg writes the files, relative to the directory
+        it's run in."""
+        with self.lock:
+            return self.profiles.get(key)
+
+    def record(self, key, profile):
+        """Keep the prompts seen by a pexpect run"""
+        with self.lock:
+            if self.profiles.get(key) == profile:
+                return
+            self.profiles[key] = profile
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO drudg_profiles VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    tuple(key) + (" ".join(profile[0]), " ".join(profile[1])) + tuple(profile[2:]),
+                )
+
+    def forget(self, key):
+        """Remove a profile that didn't match what drudg did, so it's recorded again"""
+        with self.lock:
+            self.profiles.pop(key, None)
+            with self.db:
+                self.db.execute(
+                    "DELETE FROM drudg_profiles WHERE drudg = ? AND station = ? AND sched_type = ?",
+                    tuple(key),
+                )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
 class Drudg:
     """ Tasks for managing interactions with Drudg"""
 
@@ -18,6 +116,8 @@ class Drudg:
         """
         # Default timeout time (sec)
         self.timeout_s = 3
+        # Timeout for a whole drudg run with the batch driver (sec)
+        self.batch_timeout_s = 60
         self.drudg_exec = which_drudg
         self.sched_dir = sched_dir
         self.proc_dir = proc_dir
@@ -26,7 +126,7 @@ class Drudg:
         self.snap_dir = snap_dir
         pass
 
-    def check_drudg_output_time(self, sched_dir, snap_dir, proc_dir, sched_type, code, station):
+    def check_drudg_output_time(self, sched_dir, snap_dir, proc_dir, sched_type, code, station, snapshot=None):
         """checking if the SNP and PRC files exist and are newer than the schedule file.
         Returns: True if the SNP/PRC files are the same date or later than the SKD
                  False if SKD is newer than SNP/PRC
@@ -35,21 +135,25 @@ class Drudg:
         :param proc_dir: directory where the procedure files are kept
         :param code: observation code (sched file is <code>.skd or <code>.vex)
         :param station: Two-letter lower-case station abbreviation
+        :param snapshot: DirSnapshot to look up the files in (optional)
         """
         found = True
         location = {}
         directory = {'snp': snap_dir, 'prc': proc_dir}
         for extension in ['snp', 'prc']:
             location[extension] = '{}/{}{}.{}'.format(directory[extension],code,station,extension)
-            found = path.exists(location[extension]) and found
+            found = file_exists(location[extension], snapshot) and found
         # If NOT found then the files don't exist
         if not found:
             return False
         # If found = True then both files exist
         sched_filename = "{}/{}.{}".format(sched_dir, code, sched_type)
-        sched_mtime = os.stat(sched_filename).st_mtime
-        snp_mtime = os.stat(location['snp']).st_mtime
-        prc_mtime = os.stat(location['prc']).st_mtime
+        sched_mtime = file_mtime(sched_filename, snapshot)
+        snp_mtime = file_mtime(location['snp'], snapshot)
+        prc_mtime = file_mtime(location['prc'], snapshot)
+        if None in (sched_mtime, snp_mtime, prc_mtime):
+            # removed while we were looking
+            return False
         if (snp_mtime >= sched_mtime) and (prc_mtime >= sched_mtime):
             # We are up to date
             return True
@@ -79,9 +183,27 @@ class Drudg:
             self.unexpected_response(errmsg, child)
             return False
 
-    def godrudg(self,station,code,conf):
+    def godrudg(self,station,code,conf,work_dir=None):
+        """Run drudg for one station. Drudg is run in work_dir (if given) so files it writes to its working
+        directory don't collide with other drudg runs at the same time.
+
+        If conf.DrudgDriver is 'batch' the batch driver is tried first and the pexpect driver is used if it
+        fails.
+        """
+        if conf.DrudgDriver == 'batch':
+            result = self.godrudg_batch(station, code, conf, work_dir)
+            if result[0]:
+                return result
+            logging.info("Running drudg for {} in {} interactively instead".format(station, code))
+        return self.godrudg_pexpect(station, code, conf, work_dir)
+
+    def profile_key(self, station):
+        return (self.drudg_exec, station, self.sched_type)
+
+    def godrudg_pexpect(self,station,code,conf,work_dir=None):
+        """Run drudg for one station, answering each prompt as it comes"""
         schedfile = '{}/{}.{}'.format(self.sched_dir,code,self.sched_type)
-        child = pexpect.spawn('{} {}'.format(self.drudg_exec,schedfile))
+        child = pexpect.spawn('{} {}'.format(self.drudg_exec,schedfile), cwd=work_dir)
         # verbose output for pexpect. Comment to turn off:
         # child.logfile = sys.stdout.buffer
         pattern = ['which station .*all\) \? ', '\r\n \?']
@@ -98,11 +220,16 @@ class Drudg:
 
         # Make SNAP File
         child.sendline('3')
-        outfile_snp = self.expect_drudg_prompts(child,conf)
+        seen_snp = []
+        outfile_snp = self.expect_drudg_prompts(child,conf,seen_snp)
         # Make PRC File. Depending on how skedf.ctl is set up, the user may be prompted for
         # a TPI period and/or a cont cal action
         child.sendline('12')
-        outfile_prc = self.expect_drudg_prompts(child,conf)
+        seen_prc = []
+        outfile_prc = self.expect_drudg_prompts(child,conf,seen_prc)
+        if conf.drudg_profiles and outfile_snp and outfile_prc:
+            conf.drudg_profiles.record(self.profile_key(station), (
+                seen_snp, seen_prc, path.dirname(outfile_snp), path.dirname(outfile_prc)))
         # Change output dest
         child.sendline('9')
         child.expect('else enter in filename or PRINT.\r\n', timeout=self.timeout_s)
@@ -126,14 +253,24 @@ class Drudg:
 
         child.sendline('0')
         child.expect('DRUDG DONE', timeout=self.timeout_s)
+        child.close()
 
+        return self.place_outputs(station, code, outfile_snp, outfile_prc, outfile_lst, work_dir)
+
+    def place_outputs(self, station, code, outfile_snp, outfile_prc, outfile_lst, work_dir):
+        """Move the SNP and PRC files drudg made to the right directories and set their times"""
+        schedfile = '{}/{}.{}'.format(self.sched_dir,code,self.sched_type)
         # Make sure the output files go to the right directories.
         # The LST file should be fine because we specify location during Drudg.
+        # Relative file names are relative to the directory drudg was run in.
+        if work_dir:
+            outfile_snp = path.join(work_dir, outfile_snp)
+            outfile_prc = path.join(work_dir, outfile_prc)
         outfile_snp_target = "{}/{}{}.snp".format(self.snap_dir,code,station)
-        os.rename(outfile_snp, outfile_snp_target)
+        shutil.move(outfile_snp, outfile_snp_target)
         outfile_snp = outfile_snp_target
         outfile_prc_target = "{}/{}{}.prc".format(self.proc_dir,code,station)
-        os.rename(outfile_prc, outfile_prc_target)
+        shutil.move(outfile_prc, outfile_prc_target)
         outfile_prc = outfile_prc_target
         logging.debug("outfiles = {}, {}, {}".format(outfile_snp,outfile_prc,outfile_lst))
 
@@ -146,9 +283,118 @@ class Drudg:
         self.set_file_times_anow(outfile_prc,modtime)
         self.set_file_times_anow(outfile_lst,modtime)
 
-        child.close()
         return(True,outfile_snp,outfile_prc,outfile_lst)
 
+    def answer(self, name, conf):
+        """The answer to one of the conditional drudg prompts"""
+        value = {'purge': 'y',
+                 'tpi': conf.TpiPeriod,
+                 'cont_cal': conf.ContCalAction,
+                 'cont_cal_polarity': conf.ContCalPolarity,
+                 'vsi_align': conf.VsiAlign}[name]
+        return '{}'.format(value)
+
+    def expected_prompts(self, seen, outfile, work_dir):
+        """The prompts drudg will give when making outfile, from those seen on the last pexpect run. It asks
+        whether to purge the file if it's already there, which may not have been the case then."""
+        prompts = [name for name in seen if name != 'purge']
+        if path.exists(path.join(work_dir or '', outfile)):
+            position = seen.index('purge') if 'purge' in seen else 0
+            prompts.insert(position, 'purge')
+        return prompts
+
+    def batch_script(self, station, outfile_lst, prompts, conf):
+        """All the input for a drudg run: select the station, make the SNP (3) and PRC (12) files, set the
+        LST file name (9), make the LST summary (5) and quit (0)."""
+        (prompts_snp, prompts_prc) = prompts
+        lines = [station, '3']
+        lines.extend(self.answer(name, conf) for name in prompts_snp)
+        lines.append('12')
+        lines.extend(self.answer(name, conf) for name in prompts_prc)
+        lines.extend(['9', outfile_lst, '', '', '', '5', '0'])
+        return '\n'.join(lines) + '\n'
+
+    def godrudg_batch(self,station,code,conf,work_dir=None):
+        """Run drudg for one station, sending all the input in one go and checking the output afterwards.
+
+        The prompts drudg will give for the TPI period, cont cal etc. are taken from the last pexpect run
+        for the station. Existing output files are left where they are and drudg is told to purge them, as
+        the pexpect driver does. Returns (False, None, None, None) if there isn't a profile yet or drudg
+        didn't prompt as expected.
+        """
+        profile = None
+        if conf.drudg_profiles:
+            profile = conf.drudg_profiles.get(self.profile_key(station))
+        if profile is None:
+            logging.debug("No drudg prompt profile for {} yet".format(station))
+            return (False, None, None, None)
+
+        schedfile = '{}/{}.{}'.format(self.sched_dir,code,self.sched_type)
+        outfile_lst = '{}/{}{}.lst'.format(self.lst_dir,code,station)
+        (seen_snp, seen_prc, snp_dir, prc_dir) = profile
+        prompts = (
+            self.expected_prompts(seen_snp, path.join(snp_dir, '{}{}.snp'.format(code, station)), work_dir),
+            self.expected_prompts(seen_prc, path.join(prc_dir, '{}{}.prc'.format(code, station)), work_dir),
+        )
+
+        script = self.batch_script(station, outfile_lst, prompts, conf)
+        (transcript, found) = self.run_batch(schedfile, script, work_dir)
+        ok = False
+        if transcript is None:
+            logging.warning("Drudg didn't finish within {} s".format(self.batch_timeout_s))
+        elif 'DRUDG DONE' not in transcript:
+            logging.warning("Drudg didn't finish for {} in {}".format(station, code))
+        elif found is None or tuple(found[2]) != prompts:
+            logging.warning("Drudg gave different prompts to the ones expected for {} in {}".format(
+                station, code))
+        else:
+            ok = True
+
+        if not ok:
+            # forget the profile so it's recorded again by the pexpect driver
+            conf.drudg_profiles.forget(self.profile_key(station))
+            return (False, None, None, None)
+        (outfile_snp, outfile_prc) = found[:2]
+        return self.place_outputs(station, code, outfile_snp, outfile_prc, outfile_lst, work_dir)
+
+    def run_batch(self, schedfile, script, work_dir):
+        """Run drudg with the script as its input. Returns the output and what was found in it (see
+        parse_transcript), or (None, None) if drudg didn't finish in time."""
+        proc = subprocess.Popen([self.drudg_exec, schedfile], cwd=work_dir, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        timer = threading.Timer(self.batch_timeout_s, proc.kill)
+        timer.start()
+        try:
+            (output, _) = proc.communicate(script.encode())
+        finally:
+            timed_out = not timer.is_alive()
+            timer.cancel()
+        if timed_out:
+            return (None, None)
+        transcript = output.decode('utf-8', 'replace')
+        logging.debug("Drudg output:\n{}".format(transcript))
+        return (transcript, self.parse_transcript(transcript))
+
+    def parse_transcript(self, transcript):
+        """Find the SNP and PRC file names and the prompts given while they were made in the output of a
+        batch drudg run. Returns (snp file, prc file, (snp prompts, prc prompts)) or None if the output isn't
+        as expected."""
+        # the output of each menu option follows a menu prompt
+        parts = re.split(r'\r?\n \?', transcript)
+        if len(parts) < 3:
+            return None
+        seen = []
+        for part in parts[1:3]:
+            found = []
+            for (name, pattern) in zip(prompt_names[1:], prompts[1:]):
+                found.extend((m.start(), name) for m in re.finditer(pattern, part))
+            seen.append([name for (pos, name) in sorted(found)])
+        match_snp = re.search(r'From file\:\s\S*\sTo\s\S*\s\S*\s(\S*)', parts[1])
+        match_prc = re.search(r'PROCEDURE LIBRARY FILE\s(\S*)', parts[2])
+        if not (match_snp and match_prc):
+            return None
+        return (match_snp.group(1).strip(), match_prc.group(1).strip(), tuple(seen))
+
     def set_file_times_anow(self, local_file, modTime):
         """Change the access time of the file to now and the modification time to modTime."""
         atime = time.time()
@@ -158,24 +404,19 @@ class Drudg:
         os.utime(local_file, (atime, modTime))
         return True
 
-    def expect_drudg_prompts(self, child, conf):
+    def expect_drudg_prompts(self, child, conf, seen=None):
         # Looking for a case where we may have to submit a response to a
-        # question from Drudg.
+        # question from Drudg. The names of the prompts are added to seen.
 
         # may return an output file name
         outfile = None
 
-        # Array of possible prompts:
-        prompts = ['\r\n \?',
-                   'purge existing',
-                   'Enter TPI period in centiseconds',
-                   'Enter in cont_cal action',
-                   'Enter in cont_cal_polarity',
-                   'Enter in vsi_align']
         done = False
         while not done:
             # look for a prompt...
             i = child.expect(prompts, timeout=self.timeout_s)
+            if i > 0 and seen is not None:
+                seen.append(prompt_names[i])
             # and deal with the output...
             if i==0:
                 # back to the main_task drudg prompt
@@ -218,4 +459,115 @@ class Drudg:
                 logging.debug("group(1) = {}".format(match.group(1)))
                 outfile = re.sub(('\\\\[r|n]'),' ',match.group(1)).strip()
 
-        return outfile
\ No newline at end of file
+        return outfile
+
+class DrudgCache:
+    """ Copies of the SNP, PRC and LST files made by drudg, keyed by everything that affects them: the
+    contents of the schedule file, the station, the answers given to drudg's prompts, the drudg executable
+    and its control files.
+    If drudg has already been run with the same key the files can be copied back instead of running it
+    again, e.g. after a backup has been restored or a schedule has been downloaded again without changing.
+
+    Each entry is a directory in the cache directory named by its key.
+    """
+
+    # Name of the cache directory. It's kept in the schedule directory
+    dirname = ".drudg-cache"
+    # Entries not used for this long are removed by prune() (days)
+    max_age_days = 60
+    # drudg's control files: the station equipment (rack, recorder) and the skedf.ctl settings change what
+    # it makes
+    control_files = ["/usr2/control/skedf.ctl", "/usr2/control/equip.ctl"]
+    # Hashes of the drudg executable and control files, keyed by (path, size, mtime)
+    file_hashes = {}
+
+    def __init__(self, directory):
+        """
+        :param directory: where to keep the cache directory (usually the schedule directory)
+        """
+        self.directory = path.join(directory, self.dirname)
+        if not path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def file_hash(self, filename):
+        """The hash of a file drudg uses (the executable or a control file), so a new version of drudg or a
+        change to the station's set up doesn't use old files. Empty if the file doesn't exist."""
+        try:
+            stinfo = os.stat(filename)
+        except OSError:
+            return ""
+        key = (filename, stinfo.st_size, stinfo.st_mtime)
+        if key not in self.file_hashes:
+            self.file_hashes[key] = file_sha256(filename)
+        return self.file_hashes[key]
+
+    def key(self, sched_hash, station, conf):
+        """The cache key for a drudg run
+
+        :param sched_hash: SHA-256 hash of the schedule file
+        :param station: Two-letter lower-case station abbreviation
+        :param conf: the configuration (for the drudg executable and the answers to its prompts)
+        """
+        parts = [
+            sched_hash,
+            station,
+            conf.TpiPeriod,
+            conf.ContCalAction,
+            conf.ContCalPolarity,
+            conf.VsiAlign,
+            self.file_hash(conf.DrudgBinary),
+        ]
+        parts.extend(self.file_hash(ctl) for ctl in self.control_files)
+        text = "\n".join("{}".format(part).lower() for part in parts)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def restore(self, key, outfiles):
+        """Copy the cached SNP, PRC and LST files to outfiles. Returns False if they aren't in the cache. Each
+        file is replaced in one step, so the FS never sees part of one."""
+        entry = path.join(self.directory, key)
+        cached = [path.join(entry, ext) for ext in ["snp", "prc", "lst"]]
+        if not all(path.exists(f) for f in cached):
+            return False
+        for (src, dst) in zip(cached, outfiles):
+            (fd, tmp) = temp_file(dst)
+            try:
+                with os.fdopen(fd, "wb") as fdst, open(src, "rb") as fsrc:
+                    shutil.copyfileobj(fsrc, fdst)
+                replace(tmp, dst)
+            finally:
+                if path.exists(tmp):
+                    os.remove(tmp)
+        # mark it as used
+        os.utime(entry, None)
+        logging.debug("Restored drudg output {} from the cache".format(key))
+        return True
+
+    def store(self, key, outfiles):
+        """Copy the SNP, PRC and LST files drudg made into the cache"""
+        entry = path.join(self.directory, key)
+        if path.isdir(entry):
+            return
+        # Fill a temporary directory and rename it so other processes never see part of an entry
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+        try:
+            for (src, ext) in zip(outfiles, ["snp", "prc", "lst"]):
+                shutil.copyfile(src, path.join(tmp, ext))
+            os.rename(tmp, entry)
+        except OSError as e:
+            # probably stored by someone else at the same time
+            logging.debug("Couldn't store drudg output in the cache: {}".format(e))
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def prune(self):
+        """Remove entries that haven't been used for max_age_days"""
+        cutoff = time.time() - self.max_age_days * 86400
+        for name in os.listdir(self.directory):
+            entry = path.join(self.directory, name)
+            try:
+                mtime = os.stat(entry).st_mtime
+            except OSError:
+                # removed by another fesh2 instance
+                continue
+            if mtime < cutoff:
+                logging.debug("Removing old drudg output {} from the cache".format(name))
+                shutil.rmtree(entry, ignore_errors=True)
@@ -42,10 +42,15 @@ class Config:
         )
         self.config._interpolation = ExtendedInterpolation()
 
+        self.BackupKeep = 10
         self.ContCalAction = "off"
         self.ContCalPolarity = "none"
+        self.ControlSocket = "/usr2/sched/.fesh2.sock"
         self.DoDrudg = True
         self.DrudgBinary = "/usr2/fs/bin/drudg"
+        self.DrudgCache = True
+        self.DrudgDriver = "batch"
+        self.DrudgWorkers = 4
         # self.FsDir = "/usr2/fs"
         self.GetMaster = True
         self.GetMasterIntensive = True
@@ -56,10 +61,16 @@ class Config:
         self.NetrcFile = ""
         self.CookiesFile = ""
         self.CurlSecLevel1 = False
+        self.MaxDownloads = 4
+        self.ProbeServers = True
         self.ProcDir = "/usr2/proc"
         self.SchedDir = "/usr2/sched"
         self.SchedTypes = ["vex", "skd"]
         self.ScheduleCheckTime = 1.0
+        self.SharedCache = False
+        self.SharedCacheDir = ""
+        self.ServerHealth = True
+        self.WatchFiles = True
         self.Servers = [
             "https://cddis.nasa.gov/archive/vlbi",
             "ftp://ivs.bkg.bund.de/pub/vlbi",
@@ -77,7 +88,10 @@ class Config:
         self.all_stations = False
         self.check = False
         self.ConfigFile = None
+        self.control = None  # a command to send to the running fesh2
         self.current = False
+        self.force_sessions = set()  # download schedules for these sessions in the next check
+        self.format = "text"  # format of the --check output
         self.g = None  # Just look for schedules from this session
         self.master_update = False  # Force a download of the master file(s)
         self.once = False
@@ -86,6 +100,56 @@ class Config:
         self.year = 2020
 
         self.logger = None
+        # curl handles kept between checks (SchedServer.CurlPool)
+        self.curl_pool = None
+        # hashes of the master and schedule files (FileManifest.Manifest)
+        self.manifest = None
+        # when files were last checked on the servers (FileManifest.CheckState)
+        self.check_state = None
+        # locks on the files shared with other fesh2 instances (FileLocks.FileLocks)
+        self.locks = None
+        # files fetched by all fesh2 instances (SharedCache.SharedCache)
+        self.shared_cache = None
+        # how well each server has been doing (ServerHealth.ServerHealth)
+        self.server_health = None
+        # backups of replaced schedule files (BackupFile.BackupFile)
+        self.backups = None
+        # copies of drudg output (Drudgery.DrudgCache)
+        self.drudg_cache = None
+        # the prompts drudg gives for each station (Drudgery.DrudgProfiles)
+        self.drudg_profiles = None
+        # watches the local directories when running as a daemon (FileWatcher.FileWatcher)
+        self.file_watcher = None
+        # directory contents for the check underway (DirSnapshot.DirSnapshot)
+        self.snapshot = None
+        # the status after the last check (from build_status)
+        self.status = None
+
+    # Attributes that are kept when the configuration is reloaded: the objects made while running and the
+    # command-line options that only apply to the first check or the way fesh2 was started
+    runtime_attributes = [
+        "logger",
+        "curl_pool",
+        "manifest",
+        "check_state",
+        "locks",
+        "backups",
+        "shared_cache",
+        "server_health",
+        "drudg_cache",
+        "drudg_profiles",
+        "file_watcher",
+        "snapshot",
+        "status",
+        "force_sessions",
+        "force_master_update",
+        "force_sched_update",
+        "check",
+        "control",
+        "format",
+        "run_once",
+        "quiet",
+    ]
 
     def load(self, arg):
         # arg is an Args instance
@@ -112,13 +176,29 @@ class Config:
         self.MasterCheckTime = arg.args.MasterCheckTime
         self.ScheduleCheckTime = arg.args.ScheduleCheckTime
         self.LookAheadTimeDays = arg.args.LookAheadTimeDays
+        self.BackupKeep = arg.args.BackupKeep
+        self.WatchFiles = arg.args.WatchFiles
+        self.ControlSocket = arg.args.ControlSocket.strip("'\\\"")
+        if not self.ControlSocket:
+            # in the schedule directory, which only the FS users can get to
+            self.ControlSocket = "{}/.fesh2.sock".format(self.SchedDir)
+        elif self.ControlSocket.lower() == "none":
+            self.ControlSocket = ""
 
         self.NetrcFile = arg.args.NetrcFile.strip("'\\\"")
         self.CookiesFile = arg.args.CookiesFile.strip("'\\\"")
         self.CurlSecLevel1 = arg.args.CurlSecLevel1
+        self.MaxDownloads = arg.args.MaxDownloads
+        self.ProbeServers = arg.args.ProbeServers
+        self.SharedCache = arg.args.SharedCache
+        self.SharedCacheDir = arg.args.SharedCacheDir.strip("'\\\"")
+        self.ServerHealth = arg.args.ServerHealth
 
         self.DoDrudg = arg.args.DoDrudg
         self.DrudgBinary = arg.args.DrudgBinary
+        self.DrudgCache = arg.args.DrudgCache
+        self.DrudgDriver = arg.args.DrudgDriver
+        self.DrudgWorkers = arg.args.DrudgWorkers
 
         self.GetMaster = arg.args.GetMaster
         self.GetMasterIntensive = arg.args.GetMasterIntensive
@@ -130,6 +210,8 @@ class Config:
         self.run_once = arg.args.once
         self.all_stations = arg.args.all
         self.check = arg.args.check
+        self.format = arg.args.format
+        self.control = arg.args.control
         self.quiet = arg.args.quiet
         self.year = arg.args.year
         self.TpiPeriod = arg.args.TpiPeriod
@@ -138,6 +220,12 @@ class Config:
         self.ContCalPolarity = arg.args.ContCalPolarity
         self.update = arg.args.update
 
+    def update_from(self, other):
+        """Take the settings from another (newly loaded) Config, keeping runtime_attributes"""
+        for (name, value) in vars(other).items():
+            if name not in self.runtime_attributes:
+                setattr(self, name, value)
+
     def check_config(self):
         # Check the configuration
 
@@ -165,6 +253,23 @@ class Config:
                 "Config file must specify at least one station in [Station] section"
             )
 
+        if self.MaxDownloads < 1:
+            raise Exception("MaxDownloads must be at least 1 ([Curl] section)")
+
+        if self.SharedCache and not self.SharedCacheDir:
+            raise Exception("SharedCache needs SharedCacheDir to be set ([Curl] section)")
+
+        if self.BackupKeep < 0:
+            raise Exception("BackupKeep can't be negative ([Station] section)")
+
+        if self.DrudgDriver not in ["batch", "pexpect"]:
+            raise Exception(
+                "DrudgDriver must be 'batch' or 'pexpect' ([Drudg] section)"
+            )
+
+        if self.DrudgWorkers < 1:
+            raise Exception("DrudgWorkers must be at least 1 ([Drudg] section)")
+
         for s in self.Stations:
             if len(s) != 2:
                 msg = 'Station name length wrong: "{}". Should be two characters.'.format(
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+import fcntl
+import logging
+import os
+import time
+from contextlib import contextmanager
+from os import path
+
+
+class FileLocks:
+    """ Locks on the things fesh2 instances change: a master file, the schedule file of a session or the
+    drudg output for a station in a session. Each has its own lock file, so instances (and threads) working
+    on different sessions or stations don't wait for each other.
+
+    The locks are flock()s. Waiting is done in the kernel, which wakes the waiter as soon as the lock is
+    released. A lock can be exclusive (to change the files) or shared (to read them). When more than one
+    lock is needed, take them in the order master, schedule, drudg so instances can't deadlock.
+    """
+
+    # Remove lock files that haven't been used for this long (days)
+    max_age_days = 30
+
+    def __init__(self, directory):
+        """
+        :param directory: where to keep the lock files. It's made if it doesn't exist.
+        """
+        self.directory = directory
+        if not path.isdir(directory):
+            os.makedirs(directory)
+
+    def lock_file(self, name):
+        return path.join(self.directory, "{}.lock".format(name))
+
+    @contextmanager
+    def locked(self, name, shared=False):
+        """Hold a lock, waiting for it if another instance or thread has it. Gives True if we had to wait, in
+        which case the files may have been changed.
+
+        :param name: what's being locked, e.g. "master21.txt", "r4951.sched" or "r4951hb.drudg"
+        :param shared: take a shared lock rather than an exclusive one
+        """
+        lock_file = self.lock_file(name)
+        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        waited = False
+        while True:
+            # flock doesn't need write access, so the lock files can be shared by users
+            fd = os.open(lock_file, os.O_RDONLY | os.O_CREAT, 0o666)
+            try:
+                try:
+                    fcntl.flock(fd, mode | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    logging.info(
+                        "Waiting for another fesh2 instance to finish with {}".format(name)
+                    )
+                    fcntl.flock(fd, mode)
+                    waited = True
+            except BaseException:
+                # e.g. interrupted while waiting
+                os.close(fd)
+                raise
+            if same_file(fd, lock_file):
+                break
+            # prune removed the file while we were opening or waiting for it, so anyone else opening it now
+            # gets a new file. Lock that one instead.
+            os.close(fd)
+            waited = True
+        try:
+            try:
+                # so prune can tell the lock is in use
+                os.utime(lock_file, None)
+            except OSError:
+                # someone else's file
+                pass
+            try:
+                yield waited
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def prune(self):
+        """Remove lock files that haven't been used for max_age_days. A file is only removed while we hold
+        its lock, and anyone who had opened it finds it's gone once they get the lock (see locked)."""
+        cutoff = time.time() - self.max_age_days * 86400
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            lock_file = path.join(self.directory, name)
+            try:
+                if not name.endswith(".lock") or os.stat(lock_file).st_mtime >= cutoff:
+                    continue
+                fd = os.open(lock_file, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                # leave it if it's in use
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if same_file(fd, lock_file) and os.fstat(fd).st_mtime < cutoff:
+                    os.remove(lock_file)
+            except (IOError, OSError):
+                pass
+            finally:
+                os.close(fd)
+
+
+def same_file(fd, filename):
+    """Is the open file fd still the file called filename?"""
+    try:
+        stinfo = os.stat(filename)
+    except OSError:
+        return False
+    fdinfo = os.fstat(fd)
+    return (fdinfo.st_dev, fdinfo.st_ino) == (stinfo.st_dev, stinfo.st_ino)
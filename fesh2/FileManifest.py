@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from os import path
+
+# Name of the manifest database. It's kept in the schedule directory
+manifest_filename = ".fesh2.db"
+
+# What we know about a file
+ManifestEntry = namedtuple(
+    "ManifestEntry",
+    [
+        "path",
+        "sha256",
+        "size",
+        "mtime",
+        "etag",
+        "last_modified",
+        "server_time",
+        "checked",
+    ],
+)
+
+
+def connect(directory):
+    """Open the database in the given directory. The connection can be used from any thread, but the
+    caller must serialise access to it."""
+    filename = "{}/{}".format(directory, manifest_filename)
+    return sqlite3.connect(filename, timeout=30, check_same_thread=False)
+
+
+def file_sha256(filename):
+    """Return the SHA-256 hash of a file's contents as a hex string"""
+    sha = hashlib.sha256()
+    with open(filename, mode="rb") as fd:
+        for block in iter(lambda: fd.read(65536), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class Manifest:
+    """ A record of the master and schedule files we have: their content hash and size, what the server
+    told us about them (ETag, Last-Modified, file time) and when the entry was recorded. Used to decide if a
+    downloaded file really is different to the one we have without keeping and comparing copies.
+
+    The manifest is a sqlite database so it can be shared by threads and by other fesh2 processes using the
+    same schedule directory.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: where to keep the manifest (usually the schedule directory)
+        """
+        self.lock = threading.Lock()
+        self.db = connect(directory)
+        with self.lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS manifest ("
+                "path TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, mtime REAL, etag TEXT, "
+                "last_modified TEXT, server_time REAL, checked REAL)"
+            )
+
+    def get(self, filename):
+        """Return the ManifestEntry for a file, or None if we don't have one"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT {} FROM manifest WHERE path = ?".format(
+                    ", ".join(ManifestEntry._fields)
+                ),
+                (filename,),
+            ).fetchone()
+        if row:
+            return ManifestEntry(*row)
+        return None
+
+    def record(
+        self,
+        filename,
+        sha256,
+        etag="",
+        last_modified="",
+        server_time=0,
+        checked=None,
+    ):
+        """Record a file that has just been written. The size and modification time are taken from the file."""
+        stinfo = os.stat(filename)
+        if checked is None:
+            checked = time.time()
+        logging.debug("Manifest: {} has hash {}".format(filename, sha256))
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO manifest ({}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)".format(
+                    ", ".join(ManifestEntry._fields)
+                ),
+                (
+                    filename,
+                    sha256,
+                    stinfo.st_size,
+                    stinfo.st_mtime,
+                    etag,
+                    last_modified,
+                    server_time,
+                    checked,
+                ),
+            )
+
+    def sha256(self, filename):
+        """Return the SHA-256 hash of a file, or None if it doesn't exist. The hash in the manifest is used if
+        the size and modification time of the file haven't changed since it was recorded, otherwise the file
+        is read and the manifest updated."""
+        if not path.exists(filename):
+            return None
+        stinfo = os.stat(filename)
+        entry = self.get(filename)
+        if entry and entry.size == stinfo.st_size and entry.mtime == stinfo.st_mtime:
+            return entry.sha256
+        sha256 = file_sha256(filename)
+        if entry:
+            self.record(
+                filename,
+                sha256,
+                entry.etag,
+                entry.last_modified,
+                entry.server_time,
+                entry.checked,
+            )
+        else:
+            self.record(filename, sha256, checked=0)
+        return sha256
+
+    def server_time(self, filename):
+        """The file time the server reported for the version of the file we have, or 0 if it isn't known or
+        the file has changed since."""
+        entry = self.get(filename)
+        if not entry or not path.exists(filename):
+            return 0
+        stinfo = os.stat(filename)
+        if entry.size == stinfo.st_size and entry.mtime == stinfo.st_mtime:
+            return entry.server_time
+        return 0
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+# The outcome of the last check of a file on the servers
+CheckEntry = namedtuple("CheckEntry", ["path", "checked", "succeeded", "result", "server"])
+
+
+class CheckState:
+    """ When each master and schedule file was last checked on the servers, what happened and which server
+    the file came from. This replaces using the access time of the local files, which isn't reliable on
+    noatime, relatime or NFS mounts.
+
+    The whole table is read by load() at the start of each check cycle so lookups don't touch the database.
+    Updates are written straight through.
+    """
+
+    # values for CheckEntry.result
+    NEW = "new"
+    UNCHANGED = "unchanged"
+    FAILED = "failed"
+
+    def __init__(self, directory):
+        """
+        :param directory: where to keep the database (usually the schedule directory)
+        """
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.db = connect(directory)
+        with self.lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS checks ("
+                "path TEXT PRIMARY KEY, checked REAL, succeeded REAL, result TEXT, server TEXT)"
+            )
+        self.load()
+
+    def load(self):
+        """Read the state of all files from the database"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT {} FROM checks".format(", ".join(CheckEntry._fields))
+            ).fetchall()
+            self.entries = dict((row[0], CheckEntry(*row)) for row in rows)
+
+    def refresh(self, filenames):
+        """Read the state of some files from the database again, e.g. once we hold the lock on them and
+        another fesh2 instance may have checked them since load()"""
+        with self.lock:
+            for filename in filenames:
+                row = self.db.execute(
+                    "SELECT {} FROM checks WHERE path = ?".format(
+                        ", ".join(CheckEntry._fields)
+                    ),
+                    (filename,),
+                ).fetchone()
+                if row:
+                    self.entries[filename] = CheckEntry(*row)
+                else:
+                    self.entries.pop(filename, None)
+
+    def get(self, filename):
+        """Return the CheckEntry for a file or None if it's never been checked"""
+        return self.entries.get(filename)
+
+    def last_checked(self, filename):
+        """The time of the last successful check of the file on the servers, or 0 if there hasn't been one"""
+        entry = self.entries.get(filename)
+        if entry:
+            return entry.succeeded
+        return 0
+
+    def record(self, filename, result, server="", when=None):
+        """Record the outcome of a check of a file on the servers"""
+        if when is None:
+            when = time.time()
+        with self.lock:
+            previous = self.entries.get(filename)
+            if result != self.FAILED:
+                succeeded = when
+            elif previous:
+                succeeded = previous.succeeded
+            else:
+                succeeded = 0
+            entry = CheckEntry(filename, when, succeeded, result, server)
+            self.entries[filename] = entry
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO checks ({}) VALUES (?, ?, ?, ?, ?)".format(
+                        ", ".join(CheckEntry._fields)
+                    ),
+                    entry,
+                )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import re
+import select
+import struct
+import threading
+from os import path
+
+from fesh2.DirSnapshot import DirSnapshot
+
+# inotify event flags (from sys/inotify.h)
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# the events we're interested in
+IN_WATCH = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+# struct inotify_event header: wd, mask, cookie, len
+event_header = struct.Struct("iIII")
+
+# The files we watch: master files, schedule files and drudg output
+master_regex = re.compile(r"^master\d\d(-int)?\.txt$")
+sched_regex = re.compile(r"^(?P<code>[a-z0-9]+)\.(skd|vex)$")
+drudg_regex = re.compile(r"^(?P<code>[a-z0-9]+)(?P<station>[a-z0-9]{2})\.(snp|prc|lst)$")
+
+
+def classify(name):
+    """What a file is: ('master', None, None), ('sched', code, None), ('drudg', code, station) or None if
+    we're not interested in it"""
+    if master_regex.match(name):
+        return ("master", None, None)
+    match = sched_regex.match(name)
+    if match:
+        return ("sched", match.group("code"), None)
+    match = drudg_regex.match(name)
+    if match:
+        return ("drudg", match.group("code"), match.group("station"))
+    return None
+
+
+class Inotify:
+    """ A minimal ctypes interface to Linux inotify """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.add_watch = libc.inotify_add_watch
+        self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        # non-blocking, as both the watcher thread and sync() read it
+        self.fd = libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        # watch descriptor -> directory
+        self.dirs = {}
+
+    def watch(self, directory):
+        wd = self.add_watch(self.fd, directory.encode(), IN_WATCH)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), directory)
+        self.dirs[wd] = directory
+
+    def read(self):
+        """Read the waiting events. Returns a list of (directory, name, mask)."""
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                # someone else read them
+                return []
+            raise
+        events = []
+        i = 0
+        while i + event_header.size <= len(data):
+            (wd, mask, cookie, length) = event_header.unpack_from(data, i)
+            i += event_header.size
+            name = data[i : i + length].rstrip(b"\0").decode("utf-8", "replace")
+            i += length
+            events.append((self.dirs.get(wd), name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher:
+    """ Watches the schedule, procedure, SNAP and LST directories for changes made outside fesh2's own
+    checks, e.g. an operator replacing a schedule file or removing a SNP file, or another fesh2 instance
+    downloading a new master file. The size and modification time of each file of interest are kept in a
+    table, and real changes are passed to a callback as a set of session codes plus a flag for the master
+    files.
+
+    inotify is used where it's available. Otherwise the directories are scanned every poll_s seconds. With
+    inotify the table is kept current, so checks can look up the files in it (see snapshot) rather than
+    reading the directories again.
+    """
+
+    # How often to scan the directories if inotify isn't available (sec)
+    poll_s = 60
+    # Wait this long after a change for others that go with it before calling the callback (sec)
+    settle_s = 2
+
+    def __init__(self, directories, callback):
+        """
+        :param directories: the directories to watch
+        :param callback: called as callback(codes, master) from the watcher thread, where codes is a set of
+                         session codes with changed files and master is True if a master file changed
+        """
+        self.directories = []
+        for directory in directories:
+            directory = path.abspath(directory)
+            if directory not in self.directories and path.isdir(directory):
+                self.directories.append(directory)
+        self.callback = callback
+        # (size, mtime) of each file, keyed by full path
+        self.files = {}
+        # files changed since the callback was last called, waiting for the changes to settle. A scan (or
+        # sync) takes them as seen.
+        self.pending = set()
+        self.lock = threading.Lock()
+        # held while reading and applying inotify events, so sync() sees all the events read so far
+        self.read_lock = threading.Lock()
+        self.stopping = threading.Event()
+        # used to wake the inotify thread when stopping
+        (self.wake_r, self.wake_w) = os.pipe()
+        self.inotify = None
+        self.thread = None
+
+    def stat(self, filename):
+        """The (size, mtime) of a file from the table, or None if it doesn't exist"""
+        return self.files.get(path.abspath(filename))
+
+    def watched(self, filename):
+        """Is the file one whose state is kept in the table?"""
+        (directory, name) = path.split(path.abspath(filename))
+        return directory in self.directories and classify(name) is not None
+
+    def snapshot(self):
+        """A DirSnapshot for a check. If inotify is being used it answers from the table for the files being
+        watched (see WatchedSnapshot). Otherwise the table may be out of date, so it's a plain DirSnapshot."""
+        if not self.inotify:
+            return DirSnapshot()
+        self.sync()
+        return WatchedSnapshot(self)
+
+    def sync(self):
+        """Bring the table up to date with the inotify events waiting to be read, e.g. after fesh2 has changed
+        files itself. Like scan, the changes aren't passed to the callback."""
+        with self.read_lock:
+            (changed, overflow) = self.apply(self.inotify.read())
+            with self.lock:
+                self.pending = set()
+        if overflow:
+            self.scan()
+
+    def apply(self, events):
+        """Update the table for a list of inotify events. Returns the files that changed and whether some
+        events were lost."""
+        changed = set()
+        overflow = False
+        for (directory, name, mask) in events:
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+            elif directory and classify(name):
+                filename = path.join(directory, name)
+                if self.update(filename):
+                    changed.add(filename)
+        return (changed, overflow)
+
+    def scan(self):
+        """Read the state of all the files of interest. Returns the files that changed since the last scan."""
+        files = {}
+        for directory in self.directories:
+            try:
+                names = os.listdir(directory)
+            except OSError as e:
+                logging.warning("Can't read directory {}: {}".format(directory, e))
+                continue
+            for name in names:
+                if classify(name):
+                    filename = path.join(directory, name)
+                    try:
+                        stinfo = os.stat(filename)
+                    except OSError:
+                        continue
+                    files[filename] = (stinfo.st_size, stinfo.st_mtime)
+        with self.lock:
+            changed = set(
+                f
+                for f in set(files) | set(self.files)
+                if files.get(f) != self.files.get(f)
+            )
+            self.files = files
+            self.pending = set()
+        return changed
+
+    def update(self, filename):
+        """Update the table for one file. Returns True if it changed."""
+        try:
+            stinfo = os.stat(filename)
+            state = (stinfo.st_size, stinfo.st_mtime)
+        except OSError:
+            state = None
+        with self.lock:
+            if state == self.files.get(filename):
+                return False
+            if state is None:
+                del self.files[filename]
+            else:
+                self.files[filename] = state
+        return True
+
+    def start(self):
+        """Start watching in a separate thread"""
+        self.scan()
+        try:
+            self.inotify = Inotify()
+            for directory in self.directories:
+                self.inotify.watch(directory)
+            target = self.run_inotify
+            logging.info(
+                "Watching {} for changes".format(", ".join(self.directories))
+            )
+        except (OSError, AttributeError) as e:
+            # not Linux, or out of watches
+            logging.info(
+                "Can't use inotify ({}). Checking {} for changes every {} s".format(
+                    e, ", ".join(self.directories), self.poll_s
+                )
+            )
+            if self.inotify:
+                self.inotify.close()
+                self.inotify = None
+            target = self.run_poll
+        self.thread = threading.Thread(name="file_watcher", target=target)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        os.write(self.wake_w, b"x")
+        if self.thread:
+            self.thread.join()
+        if self.inotify:
+            self.inotify.close()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def notify(self, changed):
+        """Pass the changed files to the callback"""
+        codes = set()
+        master = False
+        for filename in changed:
+            kind = classify(path.basename(filename))
+            if not kind:
+                continue
+            if kind[0] == "master":
+                master = True
+            else:
+                codes.add(kind[1])
+        if codes or master:
+            logging.debug(
+                "Files changed: {}".format(", ".join(sorted(changed)))
+            )
+            try:
+                self.callback(codes, master)
+            except Exception:
+                logging.exception("Error handling changed files")
+
+    def run_inotify(self):
+        fds = [self.inotify.fd, self.wake_r]
+        while not self.stopping.is_set():
+            # wait for something to happen
+            try:
+                (ready, _, _) = select.select(fds, [], [])
+            except (OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            overflow = False
+            # collect the events that come together. The table is updated straight away, but the callback
+            # waits for the changes to settle.
+            while self.inotify.fd in ready and not self.stopping.is_set():
+                with self.read_lock:
+                    (files, lost) = self.apply(self.inotify.read())
+                    with self.lock:
+                        self.pending |= files
+                overflow = overflow or lost
+                (ready, _, _) = select.select(fds, [], [], self.settle_s)
+            if self.stopping.is_set():
+                break
+            with self.lock:
+                changed = self.pending
+                self.pending = set()
+            if overflow:
+                # some events were lost so look at everything
+                changed |= self.scan()
+            self.notify(changed)
+
+    def run_poll(self):
+        while not self.stopping.wait(self.poll_s):
+            self.notify(self.scan())
+
+
+class WatchedSnapshot(DirSnapshot):
+    """ A DirSnapshot that looks up the files a FileWatcher is watching in its table, so the directories
+    don't have to be read and the files stat'ed again. Other files (e.g. <sched>.new) are looked up as usual.
+    invalidate() and refresh() bring the table up to date with the files fesh2 has changed itself.
+    """
+
+    def __init__(self, watcher):
+        DirSnapshot.__init__(self)
+        self.watcher = watcher
+
+    def exists(self, filename):
+        if self.watcher.watched(filename):
+            return self.watcher.stat(filename) is not None
+        return DirSnapshot.exists(self, filename)
+
+    def mtime(self, filename):
+        if self.watcher.watched(filename):
+            state = self.watcher.stat(filename)
+            if state is None:
+                return None
+            return state[1]
+        return DirSnapshot.mtime(self, filename)
+
+    def refresh(self, filenames):
+        for filename in filenames:
+            if self.watcher.watched(filename):
+                self.watcher.update(path.abspath(filename))
+        DirSnapshot.refresh(self, filenames)
+
+    def invalidate(self):
+        self.watcher.sync()
+        DirSnapshot.invalidate(self)
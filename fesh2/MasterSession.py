@@ -1,42 +1,464 @@
 #!/usr/bin/env python3
+import json
+import logging
+import os
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta
+from os import path
 
+from fesh2.AtomicFile import replace, temp_file
+from fesh2.FileManifest import file_sha256
+
+# Version of the cached master file index. Change this if the Session class or the index
+# format changes so that old indexes are ignored.
+INDEX_VERSION = 4
+
+# Session times are kept in the index as seconds since this
+EPOCH = datetime(1970, 1, 1)
+
+# Parsed master files, kept between checks: {master file: (key, sessions)}
+_master_cache = {}
+# The SessionIndex of the last set of master files loaded: (keys, index)
+_index_cache = (None, None)
+
+
+# Station codes are interned as bit positions so sets of stations can be stored and compared as
+# integer bitmasks. The mapping is fixed (each of the two characters is a base-36 digit) so masks
+# mean the same thing in every process and in cached master indexes. Characters other than 0-9 and
+# a-z share the last position.
+STATION_CHARS = "0123456789abcdefghijklmnopqrstuvwxyz"
+_station_bits = {}
+
+
+def station_bit(code):
+    """The bit position for a two-character station code"""
+    code = code.lower()
+    bit = _station_bits.get(code)
+    if bit is None:
+        n = len(STATION_CHARS) + 1
+        digits = [STATION_CHARS.find(c) for c in code[:2]]
+        digits = [len(STATION_CHARS) if d < 0 else d for d in digits]
+        bit = digits[0] * n + digits[1]
+        _station_bits[code] = bit
+    return bit
+
+
+def station_mask(codes):
+    """The bitmask for a collection of station codes"""
+    mask = 0
+    for code in codes:
+        mask |= 1 << station_bit(code)
+    return mask
+
+
+def mask_stations(mask):
+    """The set of station codes in a bitmask"""
+    n = len(STATION_CHARS) + 1
+    chars = STATION_CHARS + "?"
+    stations = set()
+    # only visit the bits that are set
+    while mask:
+        low = mask & -mask
+        mask ^= low
+        bit = low.bit_length() - 1
+        stations.add(chars[bit // n] + chars[bit % n])
+    return stations
+
+
+def parse_stations(text):
+    """The bitmask for a string of concatenated two-letter station codes (e.g. HbKeYg)"""
+    mask = 0
+    for i in range(int(len(text) / 2)):
+        mask |= 1 << station_bit(text[2 * i : 2 * i + 2])
+    return mask
+
+
+class Session(object):
+    """ A session from a master file.
+
+    Only the fields used to select sessions (code, start and end times and stations) are decoded when the
+    line is read. The rest are decoded from the line when they're used. Participating and removed stations
+    are kept as bitmasks (see station_mask).
+    """
+
+    __slots__ = (
+        "line",
+        "code",
+        "start",
+        "end",
+        "station_mask",
+        "removed_mask",
+        "our_stns_in_exp",
+    )
 
-class Session:
     def __init__(self, s, year):
-        d = s.strip(' \n|').split('|')
-        self.name = d[0].strip()
+        self.line = s.strip(" \n|")
+        d = self.line.split("|")
         self.code = d[1].strip().lower()
 
         self.start = datetime.strptime("%d %s %s" % (year, d[2], d[4]), "%Y %b%d %H:%M")
         self.end = self.start + timedelta(0, int(d[5]) * 60 * 60, 0)
 
-        sts = d[6].split(' ')
-        self.stations = set()
-        sin = sts
+        # participating stations, then the removed stations after a '-'
+        sts = d[6].split(" ")
+        self.station_mask = parse_stations(sts[0])
+        self.removed_mask = 0
         if len(sts) > 1:
-            sin = sts[0]
+            self.removed_mask = parse_stations(sts[1].strip("-"))
 
-        for i in range(int(len(sin) / 2)):
-            self.stations.add(sin[2 * i:2 * i + 2].lower())
+        self.our_stns_in_exp = []
 
-        self.stations_removed = set()
-        if len(sts) > 1:
-            sout = sts[1].strip('-')
-            for i in range(int(len(sout) / 2)):
-                self.stations_removed.add(sout[2 * i:2 * i + 2].lower())
-
-        self.scheduler = d[7]
-        self.correlator = d[8]
-        self.status = d[9]
-        self.pf = d[10]
-        self.dbc = d[11]
-        self.submit = d[12]
-        self.delay = d[13]
-        if len(d) >= 15:
-            self.mk4num = d[14]
-        else:
-            self.mk4num = 0
+    @classmethod
+    def from_index(cls, fields):
+        """A Session from the fields saved in a master index (see index_fields), without parsing the line"""
+        ses = cls.__new__(cls)
+        (ses.line, ses.code, start, end, ses.station_mask, ses.removed_mask) = fields
+        ses.start = EPOCH + timedelta(seconds=start)
+        ses.end = EPOCH + timedelta(seconds=end)
+        ses.our_stns_in_exp = []
+        return ses
 
-        self.our_stns_in_exp = []
+    def index_fields(self):
+        """The decoded fields to save in a master index"""
+        return [
+            self.line,
+            self.code,
+            int((self.start - EPOCH).total_seconds()),
+            int((self.end - EPOCH).total_seconds()),
+            self.station_mask,
+            self.removed_mask,
+        ]
+
+    def field(self, i, default=""):
+        """The i'th field of the master file line, or default if there isn't one"""
+        d = self.line.split("|")
+        if len(d) > i:
+            return d[i]
+        return default
+
+    @property
+    def name(self):
+        return self.field(0).strip()
+
+    @property
+    def stations(self):
+        return mask_stations(self.station_mask)
+
+    @property
+    def stations_removed(self):
+        return mask_stations(self.removed_mask)
+
+    @property
+    def scheduler(self):
+        return self.field(7)
+
+    @property
+    def correlator(self):
+        return self.field(8)
+
+    @property
+    def status(self):
+        return self.field(9)
+
+    @property
+    def pf(self):
+        return self.field(10)
+
+    @property
+    def dbc(self):
+        return self.field(11)
+
+    @property
+    def submit(self):
+        return self.field(12)
+
+    @property
+    def delay(self):
+        return self.field(13)
+
+    @property
+    def mk4num(self):
+        return self.field(14, 0)
+
+
+def master_index_filename(filename):
+    """The name of the cached index for a master file. It's kept next to the master file."""
+    (directory, name) = path.split(filename)
+    return path.join(directory, ".{}.idx.json".format(name))
+
+
+def parse_master(filename, year):
+    """
+    Reads a master file and returns its sessions sorted by start time
+
+    :param filename: The master file (including full path)
+    :type filename: string
+    :param year: the year of the master schedule
+    :type year: int
+    :return: the sessions in the file
+    :rtype: list of Session
+    """
+    sessions = []
+    with open(filename, mode="r") as fd:
+        for line in fd:
+            if line.startswith("|"):
+                # line starts with a |, so it's a session
+                sessions.append(Session(line, year))
+    sessions.sort(key=lambda i: i.start)
+    return sessions
+
+
+def master_key(filename, year):
+    """Identifies a version of a parsed master file. If this changes, the file must be parsed again."""
+    stinfo = os.stat(filename)
+    return (INDEX_VERSION, year, stinfo.st_size, stinfo.st_mtime)
+
+
+def read_master_index(index_file, filename, year):
+    """
+    Returns the sessions saved in the index of a master file, or None if there isn't a usable one: it
+    can't be read or decoded, or it doesn't match the size, modification time and contents of the master
+    file. The index is JSON, so a damaged or forged one can't do more than give the wrong sessions.
+    """
+    if not path.exists(index_file):
+        return None
+    try:
+        with open(index_file) as fh:
+            index = json.load(fh)
+        stinfo = os.stat(filename)
+        if (index["version"], index["year"], index["size"], index["mtime"]) != (
+            INDEX_VERSION,
+            year,
+            stinfo.st_size,
+            stinfo.st_mtime,
+        ):
+            return None
+        if index["sha256"] != file_sha256(filename):
+            return None
+        return [Session.from_index(fields) for fields in index["sessions"]]
+    except Exception as e:
+        logging.debug("Couldn't read master index {}: {}".format(index_file, e))
+        return None
+
+
+def write_master_index(index_file, filename, year, sessions):
+    """Saves the sessions parsed from a master file in its index"""
+    stinfo = os.stat(filename)
+    index = {
+        "version": INDEX_VERSION,
+        "year": year,
+        "size": stinfo.st_size,
+        "mtime": stinfo.st_mtime,
+        "sha256": file_sha256(filename),
+        "sessions": [ses.index_fields() for ses in sessions],
+    }
+    # write the index to a temporary file and rename so readers never see part of one
+    tmp = None
+    try:
+        (fd, tmp) = temp_file(index_file)
+        with os.fdopen(fd, "w") as fh:
+            json.dump(index, fh)
+        replace(tmp, index_file)
+    except (IOError, OSError) as e:
+        logging.debug("Couldn't write master index {}: {}".format(index_file, e))
+        if tmp and path.exists(tmp):
+            os.remove(tmp)
+
+
+def load_master(filename, year):
+    """
+    Returns the sessions in a master file sorted by start time, only parsing the file if it has
+    changed. Parsed files are kept in memory and in an index file next to the master file, so
+    they're only re-read when the master file is updated.
+
+    :param filename: The master file (including full path)
+    :type filename: string
+    :param year: the year of the master schedule
+    :type year: int
+    :return: the sessions in the file
+    :rtype: list of Session
+    """
+    key = master_key(filename, year)
+    if filename in _master_cache and _master_cache[filename][0] == key:
+        return _master_cache[filename][1]
+
+    index_file = master_index_filename(filename)
+    sessions = read_master_index(index_file, filename, year)
+    if sessions is None:
+        logging.debug("Parsing master file {}".format(filename))
+        sessions = parse_master(filename, year)
+        write_master_index(index_file, filename, year, sessions)
+    _master_cache[filename] = (key, sessions)
+    return sessions
+
+
+def load_master_index(files, year):
+    """
+    Returns a SessionIndex of the sessions in a list of master files. The index is only rebuilt if
+    one of the files has changed since the last call.
+
+    :param files: The master files (including full path)
+    :type files: list of strings
+    :param year: the year of the master schedules
+    :type year: int
+    :return: the sessions in the files
+    :rtype: SessionIndex
+    """
+    global _index_cache
+    keys = [(filename, master_key(filename, year)) for filename in files]
+    if _index_cache[0] == keys:
+        return _index_cache[1]
+    sessions = []
+    for filename in files:
+        sessions.extend(load_master(filename, year))
+    index = SessionIndex(sessions)
+    _index_cache = (keys, index)
+    return index
+
+
+class SessionIndex:
+    """ Sessions sorted by start time, with lookups by time range, station and session code.
+
+    Time range queries use a binary search on the start times so they don't have to look at every session
+    in the year. Each station has a list of the (positions of the) sessions it's in, so station queries only
+    look at those sessions.
+    """
+
+    def __init__(self, sessions):
+        """
+        :param sessions: The sessions to index, in any order
+        :type sessions: list of Session
+        """
+        self.sessions = sorted(sessions, key=lambda i: i.start)
+        self.starts = [ses.start for ses in self.sessions]
+        # No session that started earlier than this before a given time can still be running
+        self.max_duration = timedelta(0)
+        # positions in self.sessions of the sessions for each station and each code
+        self.by_station = {}
+        self.by_code = {}
+        for (i, ses) in enumerate(self.sessions):
+            self.max_duration = max(self.max_duration, ses.end - ses.start)
+            for stn in ses.stations:
+                self.by_station.setdefault(stn, []).append(i)
+            self.by_code.setdefault(ses.code, []).append(i)
+        self.masks = [ses.station_mask for ses in self.sessions]
+        self.removed_masks = [ses.removed_mask for ses in self.sessions]
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def matching(self, lo, hi, stations=None, all_stations=False):
+        """
+        Positions of sessions between lo and hi (excluding hi) in start order that include any of the
+        stations, or all of them if all_stations is set. All sessions in the range if stations is None.
+        """
+        if stations is None:
+            return range(lo, hi)
+        stations = set(stn.lower() for stn in stations)
+        if not stations:
+            return []
+        mask = station_mask(stations)
+        masks = self.masks
+        if all_stations:
+            # only the sessions of the station in the fewest sessions need to be checked
+            posting = min(
+                (self.by_station.get(stn, []) for stn in stations), key=len
+            )
+            candidates = posting[bisect_left(posting, lo) : bisect_left(posting, hi)]
+            return [i for i in candidates if masks[i] & mask == mask]
+        if len(stations) == 1:
+            posting = self.by_station.get(stations.pop(), [])
+            return posting[bisect_left(posting, lo) : bisect_left(posting, hi)]
+        return [i for i in range(lo, hi) if masks[i] & mask]
+
+    def with_codes(self, codes):
+        """Sessions with any of the given codes, in start order"""
+        positions = set()
+        for code in codes:
+            positions.update(self.by_code.get(code.lower(), []))
+        return [self.sessions[i] for i in sorted(positions)]
+
+    def running(self, now, stations=None, all_stations=False):
+        """Sessions under way at the time now"""
+        lo = bisect_left(self.starts, now - self.max_duration)
+        hi = bisect_right(self.starts, now)
+        return [
+            self.sessions[i]
+            for i in self.matching(lo, hi, stations, all_stations)
+            if now < self.sessions[i].end
+        ]
+
+    def starting(self, begin, end, stations=None, all_stations=False):
+        """Sessions starting at or after begin and before end"""
+        lo = bisect_left(self.starts, begin)
+        hi = bisect_left(self.starts, end)
+        return [
+            self.sessions[i] for i in self.matching(lo, hi, stations, all_stations)
+        ]
+
+    def upcoming(self, now, n=None, stations=None, all_stations=False):
+        """The first n sessions (all if n is None) that are running at the time now or start later"""
+        lo = bisect_left(self.starts, now - self.max_duration)
+        sessions = []
+        for i in self.matching(lo, len(self.sessions), stations, all_stations):
+            ses = self.sessions[i]
+            if ses.start <= now < ses.end or ses.start >= now:
+                sessions.append(ses)
+                if n is not None and len(sessions) >= n:
+                    break
+        return sessions
+
+    def window(self, now, look_ahead, stations=None, all_stations=False):
+        """Sessions running at the time now or starting before now + look_ahead (a timedelta)"""
+        running = self.running(now, stations, all_stations)
+        # sessions starting exactly at 'now' can be in both lists
+        starting = [
+            ses
+            for ses in self.starting(now, now + look_ahead, stations, all_stations)
+            if not (ses.start <= now < ses.end)
+        ]
+        return running + starting
+
+    def query(
+        self, stations, all_stations=False, removed=False, begin=None, end=None
+    ):
+        """
+        Sessions with any (or all, if all_stations is set) of the stations, optionally limited to sessions
+        starting at or after begin and before end. If removed is set, the stations removed from sessions are
+        matched instead of the participating ones.
+        """
+        lo = 0 if begin is None else bisect_left(self.starts, begin)
+        hi = len(self.sessions) if end is None else bisect_left(self.starts, end)
+        if not removed:
+            return [
+                self.sessions[i] for i in self.matching(lo, hi, stations, all_stations)
+            ]
+        mask = station_mask(stations)
+        if all_stations:
+            return [
+                self.sessions[i]
+                for i in range(lo, hi)
+                if self.removed_masks[i] & mask == mask
+            ]
+        return [self.sessions[i] for i in range(lo, hi) if self.removed_masks[i] & mask]
 
+    def sessions_by_station(self, stations, begin=None, end=None):
+        """
+        Matches many stations against the sessions in one pass. Returns a dictionary of the sessions
+        (in start order) for each station, optionally limited to sessions starting at or after begin and
+        before end.
+        """
+        lo = 0 if begin is None else bisect_left(self.starts, begin)
+        hi = len(self.sessions) if end is None else bisect_left(self.starts, end)
+        stations = set(stn.lower() for stn in stations)
+        bits = dict((station_bit(stn), stn) for stn in stations)
+        mask = station_mask(stations)
+        result = dict((stn, []) for stn in stations)
+        for i in range(lo, hi):
+            common = self.masks[i] & mask
+            while common:
+                # lowest set bit
+                low = common & -common
+                result[bits[low.bit_length() - 1]].append(self.sessions[i])
+                common ^= low
+        return result
@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
 import sys
+import hashlib
 from io import BytesIO
 import pycurl
 import logging
 import os
 import time
 import re
+import threading
 from os import path
+from fesh2.AtomicFile import copy_file, replace, temp_file
+from fesh2.DirSnapshot import file_exists
+from fesh2.FileManifest import file_sha256
+from fesh2.SharedCache import CacheEntry
 
 
 def file_progress(download_t, download_d, upload_t, upload_d):
@@ -48,6 +54,65 @@ def file_progress(download_t, download_d, upload_t, upload_d):
     sys.stdout.flush()
 
 
+# Transfer results that mean the file isn't on the server (yet): HTTP not found, and curl's access denied
+# (usually a directory that doesn't exist yet), couldn't retrieve (FTP) and remote file not found errors
+not_found_status = [404, 9, 19, 78]
+
+
+def transfer_status(status):
+    """Interpret the result of a curl transfer.
+
+    Parameters
+    ----------
+    status : integer
+        The curl error number if the transfer raised an error, otherwise the
+        server response code
+
+    Returns
+    -------
+    success: bool
+        True if we reached the server and it told us about the file
+    got_file: bool
+        True if the file contents were transferred
+    """
+    success = False
+    got_file = False
+    if status == 200 or status == 226:
+        # 200 = Action successfully completed (FTP) 226 = "Closing data connection. Requested file action
+        # successful (for example, file transfer or file abort)." (FTP) Got a file
+        logging.debug("Got file from the server. Return status: {}".format(status))
+        success = True
+        got_file = True
+    elif status == 213:
+        # 213 = "File status" (FTP)
+        # file isn't newer but we did get a time
+        success = True
+    elif status == 304:
+        # got an empty file because it hasn't changed
+        logging.info(
+            "The server file hasn't changed. Return status: {}".format(status)
+        )
+        success = True
+    elif status == 35:
+        logging.warning("Failed to connect to server. The SSL handshake failed.")
+        logging.warning(
+            "This may be caused by a known problem that affects recent Debian linux distributions"
+        )
+        logging.warning("Try adding CurlSecLevel1 to fesh2.config")
+    elif status == 28:
+        logging.warning("Failed to get file from server due to timeout.")
+    elif status == 9:
+        logging.warning(
+            "Failed to get file from server. Access denied. It's likely the directory does not "
+            "exist yet."
+        )
+    else:
+        logging.warning(
+            "Failed to get file from server. Return status = {}".format(status)
+        )
+    return success, got_file
+
+
 def set_file_times_anow(local_file, modTime):
     """Change the access time of the file to now. This is used to decide if
     the file needs checking the next time this routine is run. Note the
@@ -63,56 +128,188 @@ def set_file_times_anow(local_file, modTime):
     return True
 
 
+class CurlPool(object):
+    """ Long-lived curl handles, kept per server between checks.
+
+    Handles in the pool share DNS results and TLS sessions through a pycurl.CurlShare, so repeated
+    requests to the same server can skip the look ups and handshakes. Open connections are only shared
+    if share_connections is set: libcurl doesn't support sharing its connection cache between handles
+    in use by different threads at the same time, so that's only safe if one check runs at a time
+    (MaxDownloads = 1). The pool is safe to use from several threads.
+    """
+
+    def __init__(self, max_idle=4, health=None, share_connections=False):
+        """
+        :param max_idle: The number of idle handles to keep for each server
+        :param health: a ServerHealth.ServerHealth to record the transfers in (optional)
+        :param share_connections: share open connections between the handles. Only set this if the
+                                  handles won't be used by more than one thread at a time.
+        """
+        self.max_idle = max_idle
+        self.health = health
+        self.lock = threading.Lock()
+        self.idle = {}
+        # timings of the last transfer from each server, keyed by server URL
+        self.timings = {}
+        self.share = pycurl.CurlShare()
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        # connection sharing needs libcurl >= 7.57
+        if share_connections and hasattr(pycurl, "LOCK_DATA_CONNECT"):
+            try:
+                self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
+            except pycurl.error:
+                logging.debug("Curl connection cache sharing is not supported")
+
+    def acquire(self, server_url):
+        """Get a handle for the server. It will have no options set, other than the share."""
+        with self.lock:
+            handles = self.idle.get(server_url)
+            if handles:
+                return handles.pop()
+        curl = pycurl.Curl()
+        curl.setopt(curl.SHARE, self.share)
+        return curl
+
+    def release(self, server_url, curl):
+        """Return a handle to the pool when the transfer is finished"""
+        # reset clears the options but keeps the share, connections and caches
+        curl.reset()
+        with self.lock:
+            handles = self.idle.setdefault(server_url, [])
+            if len(handles) < self.max_idle:
+                handles.append(curl)
+                return
+        curl.close()
+
+    def record(self, server_url, curl, success):
+        """Keep the timings of a finished transfer, before the handle is reset. success means the server
+        answered, even if it doesn't have the file. Returns the result to pass to save_results."""
+        timing = {
+            "time": time.time(),
+            "success": success,
+            "connect_s": curl.getinfo(pycurl.CONNECT_TIME),
+            "total_s": curl.getinfo(pycurl.TOTAL_TIME),
+        }
+        with self.lock:
+            self.timings[server_url] = timing
+        speed = 0
+        if curl.getinfo(pycurl.SIZE_DOWNLOAD) > 0:
+            speed = curl.getinfo(pycurl.SPEED_DOWNLOAD)
+        return (server_url, success, timing["connect_s"], timing["total_s"], speed)
+
+    def save_results(self, results):
+        """Record the results of a set of transfers (from record) in the server health, all at once"""
+        if self.health:
+            self.health.record(results)
+
+    def latencies(self):
+        """The timings of the last transfer from each server (a dictionary keyed by server URL)"""
+        with self.lock:
+            return dict((url, dict(timing)) for (url, timing) in self.timings.items())
+
+    def close(self):
+        """Close all the handles in the pool"""
+        with self.lock:
+            for handles in self.idle.values():
+                for curl in handles:
+                    curl.close()
+            self.idle = {}
+        self.share.close()
+
+
 class SchedServer(object):
     """ Tasks common to all interactions with the CDDIS schedule file server"""
 
-    def __init__(self, local_dir):
+    def __init__(self, local_dir, pool=None, manifest=None, check_state=None, cache=None):
         self.transfer_done = False
         self.b_obj = BytesIO()
-        self.curl = pycurl.Curl()
+        # handle for fetches from a single server. Fetches from several servers use handles from the
+        # pool if there is one, so this isn't needed.
+        self.curl = None
+        if not pool:
+            self.curl = pycurl.Curl()
         self.url_prefix = ""
         self.local_dir = local_dir
+        # a CurlPool to take handles from for concurrent fetches (optional)
+        self.pool = pool
+        # a FileManifest.Manifest of file hashes (optional)
+        self.manifest = manifest
+        # a FileManifest.CheckState recording when files were checked (optional). If not given, the
+        # access times of the local files are used by get_file.
+        self.check_state = check_state
+        # a SharedCache.SharedCache of fetches made by all fesh2 instances (optional)
+        self.cache = cache
+        # the server that answered the last get_file_servers request
+        self.server_used = ""
+        # the result of the last fetch to share through the cache (see fetch_file_servers)
+        self.latest = None
+        # curl settings, filled in by curl_setup
+        self.netrc_file = ""
+        self.cookie_file = ""
+        self.sec_level = False
+        self.quiet = True
 
     def curl_setup(self, netrc_file, cookie_file, sec_level, quiet):
         logging.debug("Setting up curl....")
+        # keep the settings so the same setup can be applied to other handles
+        # (e.g. those used for concurrent downloads from several servers)
+        self.netrc_file = netrc_file
+        self.cookie_file = cookie_file
+        self.sec_level = sec_level
+        self.quiet = quiet
+        if self.curl:
+            self.configure_handle(self.curl, quiet)
+
+            # Write bytes that are utf-8 encoded
+            self.curl.setopt(self.curl.WRITEDATA, self.b_obj)
+
+        logging.debug("Curl is configured.")
+
+        return True
+
+    def configure_handle(self, curl, progress=False):
+        """Apply the settings given to curl_setup to a curl handle
+
+        Parameters
+        ----------
+        curl : pycurl.Curl
+            the handle to configure
+        progress : bool
+            Show a progress bar for transfers made with this handle
+        """
         # cookies and username/password
 
         # netrc_file is the .netrc file
         # cookie_file is the .urs_cookies file
-        self.curl.setopt(self.curl.NETRC_FILE, netrc_file)
-        self.curl.setopt(self.curl.NETRC, True)  # needed?
-        self.curl.setopt(self.curl.COOKIEFILE, cookie_file)
-        self.curl.setopt(self.curl.COOKIEJAR, cookie_file)
-        if sec_level:
+        curl.setopt(curl.NETRC_FILE, self.netrc_file)
+        curl.setopt(curl.NETRC, True)  # needed?
+        curl.setopt(curl.COOKIEFILE, self.cookie_file)
+        curl.setopt(curl.COOKIEJAR, self.cookie_file)
+        if self.sec_level:
             logging.debug("Setting seclevel=1")
-            self.curl.setopt(self.curl.SSL_CIPHER_LIST, "DEFAULT:@SECLEVEL=1")
+            curl.setopt(curl.SSL_CIPHER_LIST, "DEFAULT:@SECLEVEL=1")
         else:
             logging.debug("Not setting seclevel")
         # follow redirects
-        self.curl.setopt(self.curl.FOLLOWLOCATION, True)
+        curl.setopt(curl.FOLLOWLOCATION, True)
 
         # we want the date of the file (Unixtime)
-        self.curl.setopt(self.curl.OPT_FILETIME, True)
-
-        # Write bytes that are utf-8 encoded
-        self.curl.setopt(self.curl.WRITEDATA, self.b_obj)
+        curl.setopt(curl.OPT_FILETIME, True)
 
         # progress callback
-        if not quiet:
-            self.curl.setopt(self.curl.NOPROGRESS, False)
-            self.curl.setopt(self.curl.XFERINFOFUNCTION, file_progress)
+        if progress:
+            curl.setopt(curl.NOPROGRESS, False)
+            curl.setopt(curl.XFERINFOFUNCTION, file_progress)
 
         # give up if can't connect to server in 10 sec
-        self.curl.setopt(self.curl.CONNECTTIMEOUT, 10)
+        curl.setopt(curl.CONNECTTIMEOUT, 10)
         # give up if entire operation takes more than 60 sec
-        self.curl.setopt(self.curl.TIMEOUT, 60)
-
-        logging.debug("Curl is configured.")
-
-        return True
+        curl.setopt(curl.TIMEOUT, 60)
 
     def curl_close(self):
-        self.curl.close()
+        if self.curl:
+            self.curl.close()
 
     def get_file_time_server(self, url):
         self.curl.setopt(self.curl.URL, url)
@@ -200,7 +397,10 @@ class SchedServer(object):
             if path.exists(dotnew_file):
                 check_file = dotnew_file
             stinfo = os.stat(check_file)
-            file_access_time_local = stinfo.st_atime
+            if self.check_state:
+                file_access_time_local = self.check_state.last_checked(local_file)
+            else:
+                file_access_time_local = stinfo.st_atime
             file_mod_time_local = stinfo.st_mtime
             # date = datetime.utcnow()
             now = time.time()
@@ -227,6 +427,14 @@ class SchedServer(object):
                 url, local_file, quiet
             )
             # set it's modification and access times
+            if self.check_state:
+                if not success:
+                    result = self.check_state.FAILED
+                elif file_mod_time_server > file_mod_time_local:
+                    result = self.check_state.NEW
+                else:
+                    result = self.check_state.UNCHANGED
+                self.check_state.record(local_file, result, server_url)
             if not success:
                 logging.warning("Could not get {} from the server".format(filename))
                 # Don't update the access time because we couldn't get to the file
@@ -264,8 +472,8 @@ class SchedServer(object):
         self.curl.setopt(self.curl.HEADER, False)
 
         # write to a temporary file, keep it if it contains whet we want
-        local_file_temp = "{}_temp".format(local_file)
-        with open(local_file_temp, mode="wb") as fd:
+        (fd_temp, local_file_temp) = temp_file(local_file)
+        with os.fdopen(fd_temp, "wb") as fd:
             self.curl.setopt(self.curl.WRITEDATA, fd)
             logging.info("Requesting file from server at {}...".format(url))
             #            self.curl.setopt(self.curl.VERBOSE, True)
@@ -284,69 +492,519 @@ class SchedServer(object):
             else:
                 # HTTP response code, e.g. 200.
                 status = self.curl.getinfo(self.curl.RESPONSE_CODE)
-            success = False
-            if status == 200 or status == 226:
-                # 200 = Action successfully completed (FTP) 226 = "Closing data connection. Requested file action
-                # successful (for example, file transfer or file abort)." (FTP) Got a file
-                logging.debug(
-                    "Got file from the server. Return status: {}".format(status)
-                )
-                # delete old file
-                if path.exists(local_file):
-                    os.remove(local_file)
-                # change temporary file name to the correct name
-                os.rename(local_file_temp, local_file)
+            (success, got_file) = transfer_status(status)
+            if got_file:
+                # change temporary file name to the correct name, replacing the old file in one step
+                replace(local_file_temp, local_file)
+            if success and status != 304:
                 # Get the content stored in the BytesIO object (in byte characters)
                 (size_download, file_time) = self.report_file_stats()
-                success = True
-            elif status == 213:
-                # 213 = "File status" (FTP)
-                (size_download, file_time) = self.report_file_stats()
-                # file isn't newer but we did get a time
-                success = True
-            elif status == 304:
-                # got an empty file because it hasn't changed
+            else:
+                file_time = 0
+        # finished with the temporary file now
+        if path.exists(local_file_temp):
+            os.remove(local_file_temp)
+
+        return success, file_time
+
+
+    def get_file_servers(
+        self,
+        server_urls,
+        url_path,
+        filename,
+        local_dir,
+        force,
+        quiet=False,
+        probe=False,
+        backup=None,
+        fresh_s=0,
+    ):
+        """Download a file from all the servers at the same time and keep the newest copy
+
+        The transfers are run concurrently with a pycurl.CurlMulti so the time taken is set by
+        the fastest server rather than the sum of all of them. Each server's copy goes to
+        its own temporary file and the one with the latest server modification time
+        (INFO_FILETIME) replaces the local file if it is newer than the local copy.
+
+        If probe is set and there's a local copy, the servers are first asked for just the
+        time and size of the file (a HEAD request for http, MDTM/SIZE for ftp) and the file is
+        only downloaded from the server with the newest version, if it has changed. FTP
+        servers ignore the if-modified-since condition, so without a probe they always send
+        the whole file.
+
+        Downloads are hashed as they arrive. If the newest copy has the same content as the
+        local one (some servers report unreliable file times) it isn't treated as new and the
+        local file is left alone.
+
+        Parameters
+        ----------
+        server_urls : list of strings
+            the top directories (e.g. https://cddis.nasa.gov/archive/vlbi) of the servers to check
+        url_path : string
+            the path from the top directory to the directory containing the file
+        filename : string
+            the filename to get, excluding the URL prefix.
+        local_dir: string
+            Local directory where the file will go
+        force : bool
+            Download the file regardless of the modification time of the local copy
+        probe : bool
+            Check the file time and size on the servers before downloading
+        backup : function
+            Called with the name of the local file just before it is replaced by a file with
+            different content
+        fresh_s : float
+            If there's a shared cache, use the result of a fetch by any fesh2 instance made within
+            this time (sec) instead of contacting the servers, unless the download is forced
+
+        Returns
+        -------
+        success: bool
+            True if at least one server was checked successfully
+        new: bool
+            True if a new file was retrieved
+        """
+        if not self.cache:
+            return self.fetch_file_servers(
+                server_urls, url_path, filename, local_dir, force, quiet, probe, backup
+            )
+        # One instance at a time fetches the file. The others wait and use its result.
+        with self.cache.locked(filename):
+            if not force:
+                entry = self.cache.get(filename, fresh_s)
+                if entry:
+                    return self.use_cached(entry, local_dir, backup)
+            (success, new) = self.fetch_file_servers(
+                server_urls, url_path, filename, local_dir, force, quiet, probe, backup
+            )
+            if self.latest:
+                self.cache.store(*self.latest)
+        return success, new
+
+    def use_cached(self, entry, local_dir, backup=None):
+        """Use the result of a fetch by another fesh2 instance (a SharedCache.CacheEntry) as if we'd fetched
+        the file ourselves. Returns success and new flags as for get_file_servers."""
+        local_file = "{}/{}".format(local_dir, entry.name)
+        self.server_used = entry.server
+        age_txt = "{:.0f} min".format((time.time() - entry.fetched) / 60)
+        if not entry.exists:
+            logging.info(
+                "{} wasn't on the servers when it was checked {} ago. Not checking again yet.".format(
+                    entry.name, age_txt
+                )
+            )
+            return False, False
+        logging.info("{} was fetched from {} {} ago".format(entry.name, entry.server, age_txt))
+        # If there's a .new file (an unprocessed sched file) that's the latest one we have
+        check_file = local_file
+        if path.exists("{}.new".format(local_file)):
+            check_file = "{}.new".format(local_file)
+        if path.exists(check_file):
+            if self.manifest:
+                sha256_local = self.manifest.sha256(check_file)
+            else:
+                sha256_local = file_sha256(check_file)
+            if sha256_local == entry.sha256 or entry.file_time <= os.stat(check_file).st_mtime:
+                logging.info("We already have the latest version of this file")
+                return True, False
+        logging.info("Got a new file from the shared cache")
+        # same as a download: a temporary copy replaces the local file
+        (fd, tmp) = temp_file(local_file)
+        os.close(fd)
+        os.remove(tmp)
+        # a copy rather than a link, as the cache is shared with other instances' directories
+        copy_file(self.cache.data_file(entry.name), tmp)
+        try:
+            set_file_times_anow(tmp, entry.file_time)
+            if backup and path.exists(local_file):
+                backup(local_file)
+            replace(tmp, local_file)
+        finally:
+            if path.exists(tmp):
+                os.remove(tmp)
+        if self.manifest:
+            self.manifest.record(
+                local_file, entry.sha256, entry.etag, entry.last_modified, entry.file_time
+            )
+        return True, True
+
+    def fetch_file_servers(
+        self,
+        server_urls,
+        url_path,
+        filename,
+        local_dir,
+        force,
+        quiet=False,
+        probe=False,
+        backup=None,
+    ):
+        """Does the work of get_file_servers, without the shared cache. self.latest is set to the arguments
+        for SharedCache.store to share the result, or None if it shouldn't be shared."""
+        local_file = "{}/{}".format(local_dir, filename)
+        self.latest = None
+
+        if not path.exists(local_file) or force:
+            if force:
+                logging.info("Download of {} has been forced.".format(filename))
+            else:
                 logging.info(
-                    "The server file hasn't changed. Return status: {}".format(status)
+                    "The file {} was not found locally. Forcing a download attempt.".format(
+                        filename
+                    )
                 )
-                # delete temporary file
-                file_time = 0
-                success = True
-            elif status == 35:
-                logging.warning(
-                    "Failed to connect to server. The SSL handshake failed."
+            file_mod_time_local = 0
+            file_size_local = -1
+            check_file = local_file
+        else:
+            # We have a local copy. If there's a .new file (an unprocessed sched file)
+            # we want the stats on that
+            check_file = local_file
+            dotnew_file = "{}.new".format(local_file)
+            if path.exists(dotnew_file):
+                check_file = dotnew_file
+            stinfo = os.stat(check_file)
+            file_mod_time_local = stinfo.st_mtime
+            file_size_local = stinfo.st_size
+            if self.manifest:
+                # The file time on the server may be later than the local one if the server
+                # sent us a file with a new time but the same content
+                file_mod_time_local = max(
+                    file_mod_time_local, self.manifest.server_time(check_file)
                 )
-                logging.warning(
-                    "This may be caused by a known problem that affects recent Debian linux distributions"
+            logging.info("Setting up transactions to get the file only if it's new")
+
+        urls = [
+            (server_url, "{}/{}/{}".format(server_url, url_path, filename))
+            for server_url in server_urls
+        ]
+        probes = []
+        if probe and file_mod_time_local > 0:
+            probes = [Transfer(server_url, url, None) for (server_url, url) in urls]
+            for transfer in probes:
+                logging.info("Requesting file info from server at {}...".format(transfer.url))
+            self.run_transfers(probes, file_mod_time_local, False)
+            # Servers that didn't tell us the file time have to be asked for the file
+            etag_local = ""
+            entry = self.manifest.get(check_file) if self.manifest else None
+            if entry and entry.size == file_size_local:
+                etag_local = entry.etag
+            changed = [
+                t
+                for t in probes
+                if t.success
+                and not (etag_local and t.etag == etag_local)
+                and (
+                    t.file_time <= 0
+                    or t.file_time > file_mod_time_local
+                    or (
+                        t.file_time >= int(file_mod_time_local)
+                        and 0 <= t.size != file_size_local
+                    )
                 )
-                logging.warning("Try adding CurlSecLevel1 to fesh2.config")
-                file_time = 0
-            elif status == 28:
-                logging.warning("Failed to get file from server due to timeout.")
-                file_time = 0
-            elif status == 9:
-                logging.warning(
-                    "Failed to get file from server. Access denied. It's likely the directory does not "
-                    "exist yet."
+            ]
+            newer = [t for t in changed if t.file_time > 0]
+            unknown = [t for t in changed if t.file_time <= 0]
+            if newer:
+                # just the newest copy. For equal times, the first server in the list wins.
+                newer = [max(newer, key=lambda t: t.file_time)]
+            urls = [(t.server_url, t.url) for t in newer + unknown]
+            if not urls:
+                logging.info(
+                    "The file hasn't changed on the servers. Not downloading."
                 )
-                file_time = 0
+
+        # Only show a progress bar if there's a single transfer, otherwise they write over each other
+        progress = not quiet and len(urls) == 1
+        transfers = [Transfer(server_url, url, local_file) for (server_url, url) in urls]
+        for transfer in transfers:
+            logging.info("Requesting file from server at {}...".format(transfer.url))
+        self.run_transfers(transfers, file_mod_time_local, progress)
+
+        success = any(t.success for t in probes + transfers)
+        # The newest copy. For equal times, the first server in the list wins.
+        candidates = [t for t in transfers if t.got_file]
+        best = None
+        if candidates:
+            best = max(candidates, key=lambda t: t.file_time)
+
+        if best and path.exists(check_file):
+            # Is the content actually different?
+            if self.manifest:
+                sha256_local = self.manifest.sha256(check_file)
             else:
-                logging.warning(
-                    "Failed to get file from server. Return status = {}".format(status)
+                sha256_local = file_sha256(check_file)
+            if best.sha256 == sha256_local:
+                if force:
+                    logging.info(
+                        "The newly downloaded file is identical in content to the one we "
+                        "already have. The forced update was unnecessary."
+                    )
+                else:
+                    logging.info(
+                        "The newly downloaded file is identical in content to the one we "
+                        "already have. The server may be reporting an incorrect modification "
+                        "time."
+                    )
+                if self.manifest:
+                    # remember the server time so we don't download it again
+                    self.manifest.record(
+                        check_file,
+                        best.sha256,
+                        best.etag,
+                        best.last_modified,
+                        best.file_time,
+                    )
+                best = None
+
+        # Which server we got the answer from
+        self.server_used = ""
+        answered = [t for t in probes + transfers if t.success]
+        if answered:
+            self.server_used = answered[0].server_url
+
+        new = False
+        if best and (best.file_time > file_mod_time_local or not path.exists(local_file)):
+            logging.info("Got a new file from {}".format(best.server_url))
+            self.server_used = best.server_url
+            file_time = best.file_time
+            if file_time <= 0:
+                # The server didn't tell us the time of the file
+                file_time = time.time()
+            # set the times before the file appears under its own name
+            set_file_times_anow(best.temp_file, file_time)
+            if backup and path.exists(local_file):
+                backup(local_file)
+            # replace the old file in one step. The old file itself isn't changed, so the backup
+            # can be a link to it.
+            replace(best.temp_file, local_file)
+            if self.manifest:
+                self.manifest.record(
+                    local_file,
+                    best.sha256,
+                    best.etag,
+                    best.last_modified,
+                    best.file_time,
                 )
-                file_time = 0
-        # finished with the temporary file now
-        if path.exists(local_file_temp):
-            os.remove(local_file_temp)
+            new = True
+        elif success:
+            if path.exists(local_file):
+                logging.info("We already have the latest version of this file")
+        else:
+            logging.warning("Could not get {} from any server".format(filename))
 
-        return success, file_time
+        # What to share with other fesh2 instances
+        now = time.time()
+        if new:
+            self.latest = (
+                CacheEntry(
+                    filename,
+                    now,
+                    True,
+                    best.server_url,
+                    file_time,
+                    best.sha256,
+                    best.etag,
+                    best.last_modified,
+                ),
+                local_file,
+            )
+        elif success and path.exists(check_file):
+            # the latest version is the one we have
+            entry = self.manifest.get(check_file) if self.manifest else None
+            if self.manifest:
+                sha256 = self.manifest.sha256(check_file)
+            else:
+                sha256 = file_sha256(check_file)
+            self.latest = (
+                CacheEntry(
+                    filename,
+                    now,
+                    True,
+                    self.server_used,
+                    os.stat(check_file).st_mtime,
+                    sha256,
+                    entry.etag if entry else "",
+                    entry.last_modified if entry else "",
+                ),
+                check_file,
+            )
+        elif not success and transfers and all(
+            t.status in not_found_status for t in transfers
+        ):
+            # it isn't on any of the servers yet
+            self.latest = (
+                CacheEntry(filename, now, False, "", 0, "", "", ""),
+                None,
+            )
+
+        # finished with the temporary files now
+        for transfer in transfers:
+            if transfer.temp_file and path.exists(transfer.temp_file):
+                os.remove(transfer.temp_file)
+
+        return success, new
+
+    def run_transfers(self, transfers, file_mod_time_local, progress):
+        """Run a list of Transfers concurrently on a pycurl.CurlMulti and record their results"""
+        if not transfers:
+            return
+        multi = pycurl.CurlMulti()
+        for transfer in transfers:
+            if self.pool:
+                curl = self.pool.acquire(transfer.server_url)
+            else:
+                curl = pycurl.Curl()
+            self.configure_handle(curl, progress)
+            transfer.start(curl, file_mod_time_local)
+            multi.add_handle(curl)
+
+        run_multi(multi)
+
+        # collect the results
+        curl_errors = {}
+        while True:
+            (num_queued, ok_list, err_list) = multi.info_read()
+            for (curl, errno, errmsg) in err_list:
+                logging.debug("Curl exception {}: {}".format(errno, errmsg))
+                curl_errors[id(curl)] = errno
+            if num_queued == 0:
+                break
+        if progress:
+            print("")
+        results = []
+        for transfer in transfers:
+            multi.remove_handle(transfer.curl)
+            transfer.finish(curl_errors.get(id(transfer.curl), 0))
+            if self.pool:
+                # a file that isn't there yet doesn't mean there's anything wrong with the server
+                answered = transfer.success or transfer.status in not_found_status
+                results.append(
+                    self.pool.record(transfer.server_url, transfer.curl, answered)
+                )
+                self.pool.release(transfer.server_url, transfer.curl)
+            else:
+                transfer.curl.close()
+        multi.close()
+        if self.pool:
+            # one database write for all the transfers, rather than one each
+            self.pool.save_results(results)
+
+
+def run_multi(multi):
+    """Run all the transfers on a pycurl.CurlMulti until they are complete"""
+    num_handles = 1
+    while num_handles:
+        while True:
+            (ret, num_handles) = multi.perform()
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        if num_handles:
+            multi.select(1.0)
+
+
+class Transfer(object):
+    """ A request for one file from one server, run as part of a concurrent fetch. The file is written to
+    a temporary file next to local_file. If there's no local_file, then it's a probe for the file time and
+    size only."""
+
+    def __init__(self, server_url, url, local_file):
+        self.server_url = server_url
+        self.url = url
+        self.local_file = local_file
+        # made when the transfer starts
+        self.temp_file = None
+        self.curl = None
+        self.fd = None
+        self.status = 0
+        self.success = False
+        self.got_file = False
+        self.file_time = 0
+        self.size = -1
+        self.sha256 = None
+        self.sha = hashlib.sha256()
+        self.etag = ""
+        self.last_modified = ""
+
+    def write(self, data):
+        """curl write callback: save the data and add it to the hash"""
+        self.fd.write(data)
+        self.sha.update(data)
+
+    def header(self, line):
+        """curl header callback: keep the ETag and Last-Modified headers of the final response"""
+        line = line.decode("iso-8859-1").strip()
+        if line.startswith("HTTP/"):
+            # a new response (e.g. after a redirect)
+            self.etag = ""
+            self.last_modified = ""
+        elif ":" in line:
+            (name, value) = line.split(":", 1)
+            name = name.strip().lower()
+            if name == "etag":
+                self.etag = value.strip()
+            elif name == "last-modified":
+                self.last_modified = value.strip()
+
+    def start(self, curl, file_mod_time_local):
+        """Set up the curl handle for the transfer. Only ask for the file if it has been
+        modified after file_mod_time_local (if it's non-zero)"""
+        self.curl = curl
+        url = self.url
+        if "ftps://" in url:
+            url = re.sub("ftps://", "ftp://", url)
+            curl.setopt(curl.USE_SSL, True)
+        curl.setopt(curl.URL, url)
+        curl.setopt(curl.HEADER, False)
+        curl.setopt(curl.HEADERFUNCTION, self.header)
+        if not self.local_file:
+            # Just get the header info, not the actual file
+            curl.setopt(curl.NOBODY, True)
+            return
+        curl.setopt(curl.NOBODY, False)
+        if file_mod_time_local > 0:
+            curl.setopt(curl.TIMEVALUE, int(file_mod_time_local))
+            curl.setopt(curl.TIMECONDITION, curl.TIMECONDITION_IFMODSINCE)
+        # write to a temporary file, keep it if it contains whet we want
+        (fd, self.temp_file) = temp_file(self.local_file)
+        self.fd = os.fdopen(fd, "wb")
+        curl.setopt(curl.WRITEFUNCTION, self.write)
+
+    def finish(self, ret):
+        """Record the outcome of the transfer. ret is the curl error number (0 if none)"""
+        if self.fd:
+            self.fd.close()
+            self.sha256 = self.sha.hexdigest()
+        if ret > 0:
+            self.status = ret
+        else:
+            # HTTP response code, e.g. 200.
+            self.status = self.curl.getinfo(self.curl.RESPONSE_CODE)
+        logging.debug("{} returned status {}".format(self.url, self.status))
+        if not self.local_file:
+            # A probe. FTP servers reply to the last command curl sends (e.g. 350 for REST), so
+            # anything without a curl error or HTTP error code is fine.
+            self.success = ret == 0 and self.status < 400
+            if not self.success:
+                transfer_status(self.status)
+        else:
+            (self.success, self.got_file) = transfer_status(self.status)
+        if self.success and self.status != 304:
+            self.file_time = self.curl.getinfo(self.curl.INFO_FILETIME)
+            self.size = int(self.curl.getinfo(self.curl.CONTENT_LENGTH_DOWNLOAD))
+            logging.debug(
+                "download size = {}, file time = {}".format(self.size, self.file_time)
+            )
 
 
 class MasterServer(SchedServer):
     """ Managing access to the Master schedule file. Inherits from SchedServer"""
 
-    def __init__(self, local_dir):
-        super(MasterServer, self).__init__(local_dir)
+    def __init__(self, local_dir, pool=None, manifest=None, check_state=None, cache=None):
+        super(MasterServer, self).__init__(
+            local_dir, pool, manifest, check_state, cache
+        )
         self.url_prefix = "ivscontrol"
         self.master_file_name = ""
         self.master_file_intensive_name = ""
@@ -389,16 +1047,48 @@ class MasterServer(SchedServer):
         )
         return success, new
 
+    def get_master_servers(
+        self,
+        server_urls,
+        year,
+        local_dir,
+        force,
+        intensive=False,
+        quiet=False,
+        probe=False,
+        fresh_s=0,
+    ):
+        """Check all the servers at once for the master schedule for the specified year
+        and keep the newest version. Returns success and new flags as for get_master.
+        A fetch by another fesh2 instance within fresh_s seconds is used if there's a shared cache."""
+        if not intensive:
+            self.master_file_name = "master{:02d}.txt".format(year - 2000)
+        else:
+            self.master_file_name = "master{:02d}-int.txt".format(year - 2000)
+        (success, new) = self.get_file_servers(
+            server_urls,
+            self.url_prefix,
+            self.master_file_name,
+            local_dir,
+            force,
+            quiet,
+            probe,
+            fresh_s=fresh_s,
+        )
+        return success, new
+
 
 class SchedFileServer(SchedServer):
     """ Managing access to schedule files (SKD or VEX). Inherits from SchedServer"""
 
-    def __init__(self, local_dir):
+    def __init__(self, local_dir, pool=None, manifest=None, check_state=None, cache=None):
         """
         https://cddis.nasa.gov/archive/vlbi/ivsdata/aux/<year>/<sess>
         e.g. https://cddis.nasa.gov/archive/vlbi/ivsdata/aux/2020/aua063
         """
-        super(SchedFileServer, self).__init__(local_dir)
+        super(SchedFileServer, self).__init__(
+            local_dir, pool, manifest, check_state, cache
+        )
         self.url_prefix = "ivsdata/aux"
         self.sched_file_name = ""
 
@@ -431,12 +1121,44 @@ class SchedFileServer(SchedServer):
         )
         return success, new
 
+    def get_sched_servers(
+        self,
+        server_urls,
+        code,
+        sched_type,
+        year,
+        local_dir,
+        force,
+        quiet=False,
+        probe=False,
+        backup=None,
+        fresh_s=0,
+    ):
+        """Check all the servers at once for the schedule for the specified session
+        and keep the newest version. Returns success and new flags as for get_sched.
+        backup is called with the local file name before it's replaced, and a fetch by another
+        fesh2 instance within fresh_s seconds is used if there's a shared cache (see get_file_servers)"""
+        self.sched_file_name = "{}.{}".format(code, sched_type)
+        url_path = "{}/{}/{}".format(self.url_prefix, year, code)
+        (success, new) = self.get_file_servers(
+            server_urls,
+            url_path,
+            self.sched_file_name,
+            local_dir,
+            force,
+            quiet,
+            probe,
+            backup,
+            fresh_s,
+        )
+        return success, new
+
     def check_exists_sched(self, code, config):
         """ Given an obs code and directory, look for supported schedule files and return
             True if the file exists and the type (either vex or skd)"""
         for ty in config.SchedTypes:
             local_file = "{}/{}.{}".format(config.SchedDir, code, ty)
-            if path.exists(local_file):
+            if file_exists(local_file, config.snapshot):
                 return True, ty
         # If we get here then the schedule file wasn't found
         return False, ""
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from fesh2.FileManifest import connect
+from fesh2.StatusFile import utc_text
+
+# What we know about a server: how many transfers have been made, how many have failed in a row, the
+# (exponentially weighted) success rate, connect time, time to answer and download speed, and until when
+# it's being skipped
+ServerEntry = namedtuple(
+    "ServerEntry",
+    [
+        "url",
+        "attempts",
+        "failures",
+        "success_rate",
+        "connect_s",
+        "response_s",
+        "speed",
+        "last_success",
+        "last_failure",
+        "retry_after",
+    ],
+)
+
+
+class ServerHealth:
+    """ How well each server has been doing, from the transfers made by all fesh2 instances using the same
+    schedule directory. It's kept in the database there, so it's remembered when fesh2 is restarted.
+
+    Servers are tried best first: the ones that answer quickly and reliably. For equal file times the
+    first server wins, so that's the one files come from. A server that fails failures_to_skip times in a
+    row isn't used for backoff_s, doubling for each failure after that up to max_backoff_s, rather than
+    holding up every check until curl times out. It's then tried again, and one success puts it back in
+    use. If all the servers are being skipped, they are all tried.
+    """
+
+    # weight of the latest transfer in the averages
+    weight = 0.3
+    # consecutive failures before a server is skipped
+    failures_to_skip = 2
+    # how long to skip a server for (sec), doubling with each failure
+    backoff_s = 600
+    max_backoff_s = 12 * 3600
+
+    def __init__(self, directory):
+        """
+        :param directory: where to keep the database (usually the schedule directory)
+        """
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.db = connect(directory)
+        with self.lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS servers ("
+                "url TEXT PRIMARY KEY, attempts INTEGER, failures INTEGER, success_rate REAL, "
+                "connect_s REAL, response_s REAL, speed REAL, last_success REAL, last_failure REAL, "
+                "retry_after REAL)"
+            )
+        self.load()
+
+    def load(self):
+        """Read the state of all servers from the database (other instances may have used them)"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT {} FROM servers".format(", ".join(ServerEntry._fields))
+            ).fetchall()
+            self.entries = dict((row[0], ServerEntry(*row)) for row in rows)
+
+    def get(self, url):
+        """The ServerEntry for a server, or None if it's never been used"""
+        return self.entries.get(url)
+
+    def average(self, old, new):
+        if old is None:
+            return new
+        return (1 - self.weight) * old + self.weight * new
+
+    def record(self, results):
+        """Record the outcomes of a set of transfers (e.g. those run together by SchedServer.run_transfers),
+        in one database transaction
+
+        :param results: (url, success, connect_s, response_s, speed) for each transfer. url is the server URL
+                        (as in config.Servers). success means the server answered (a file that isn't there
+                        yet is still an answer). connect_s is the time to connect (sec), 0 if an existing
+                        connection was used. response_s is the time for the whole transfer (sec). speed is
+                        the download speed (bytes/sec), 0 if nothing was downloaded.
+        """
+        if not results:
+            return
+        now = time.time()
+        with self.lock:
+            # read the latest state in the same transaction, as other instances may be updating it
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for result in results:
+                    entry = self.update(self.read(result[0]), now, *result[1:])
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO servers ({}) VALUES ({})".format(
+                            ", ".join(ServerEntry._fields),
+                            ", ".join(["?"] * len(ServerEntry._fields)),
+                        ),
+                        entry,
+                    )
+                    self.entries[entry.url] = entry
+                self.db.commit()
+            except Exception:
+                self.db.rollback()
+                raise
+
+    def read(self, url):
+        """The ServerEntry for a server from the database. Call with the lock held."""
+        row = self.db.execute(
+            "SELECT {} FROM servers WHERE url = ?".format(", ".join(ServerEntry._fields)),
+            (url,),
+        ).fetchone()
+        if row:
+            return ServerEntry(*row)
+        return ServerEntry(url, 0, 0, None, None, None, None, 0, 0, 0)
+
+    def update(self, entry, now, success, connect_s, response_s, speed):
+        """A ServerEntry updated with the outcome of a transfer (see record)"""
+        entry = entry._replace(
+            attempts=entry.attempts + 1,
+            success_rate=self.average(entry.success_rate, 1.0 if success else 0.0),
+        )
+        if success:
+            entry = entry._replace(
+                failures=0,
+                response_s=self.average(entry.response_s, response_s),
+                last_success=now,
+                retry_after=0,
+            )
+            if connect_s > 0:
+                entry = entry._replace(connect_s=self.average(entry.connect_s, connect_s))
+            if speed > 0:
+                entry = entry._replace(speed=self.average(entry.speed, speed))
+            return entry
+        entry = entry._replace(failures=entry.failures + 1, last_failure=now)
+        if entry.failures >= self.failures_to_skip:
+            backoff = min(
+                self.backoff_s * 2 ** (entry.failures - self.failures_to_skip),
+                self.max_backoff_s,
+            )
+            skipping = entry.retry_after > now
+            entry = entry._replace(retry_after=now + backoff)
+            if not skipping:
+                logging.warning(
+                    "{} has failed {} times in a row. Not using it until {}".format(
+                        entry.url, entry.failures, utc_text(entry.retry_after)
+                    )
+                )
+        return entry
+
+    def score(self, url):
+        """The expected time for the server to answer (sec), allowing for failures. 0 if it's never been
+        used, so new servers are tried."""
+        entry = self.entries.get(url)
+        if not entry:
+            return 0
+        if entry.response_s is None:
+            # it's never answered
+            return float("inf")
+        return entry.response_s / max(entry.success_rate, 0.05)
+
+    def skipped(self, url, now=None):
+        """Is the server being skipped after failing?"""
+        if now is None:
+            now = time.time()
+        entry = self.entries.get(url)
+        return entry is not None and entry.retry_after > now
+
+    def rank(self, urls):
+        """The servers in the order to try them, best first, without those that are being skipped (unless
+        that's all of them)"""
+        now = time.time()
+        order = dict((url, i) for (i, url) in enumerate(urls))
+        ranked = sorted(urls, key=lambda url: (self.score(url), order[url]))
+        use = [url for url in ranked if not self.skipped(url, now)]
+        for url in ranked:
+            if url not in use:
+                logging.debug(
+                    "Skipping {} until {}".format(url, utc_text(self.entries[url].retry_after))
+                )
+        if not use:
+            logging.debug("All the servers have been failing. Trying them all.")
+            return ranked
+        return use
+
+    def summary(self):
+        """The state of each server for the status file (a dictionary keyed by server URL)"""
+        now = time.time()
+        servers = {}
+        with self.lock:
+            entries = list(self.entries.values())
+        for entry in entries:
+            last_success = entry.last_success or None
+            skipped_until = entry.retry_after if entry.retry_after > now else None
+            servers[entry.url] = {
+                "attempts": entry.attempts,
+                "failures": entry.failures,
+                "success_rate": entry.success_rate,
+                "mean_connect_s": entry.connect_s,
+                "mean_response_s": entry.response_s,
+                "mean_speed": entry.speed,
+                "last_success": last_success,
+                "last_success_utc": utc_text(last_success),
+                "skipped_until": skipped_until,
+                "skipped_until_utc": utc_text(skipped_until),
+            }
+        return servers
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+from os import path
+
+from fesh2.AtomicFile import copy_file, replace, temp_file
+from fesh2.FileLocks import FileLocks
+from fesh2.FileManifest import file_sha256
+
+# The result of the last fetch of a file from the servers, by any fesh2 instance
+CacheEntry = namedtuple(
+    "CacheEntry",
+    [
+        "name",
+        "fetched",
+        "exists",
+        "server",
+        "file_time",
+        "sha256",
+        "etag",
+        "last_modified",
+    ],
+)
+
+
+class SharedCache:
+    """ The results of fetching master and schedule files from the servers, shared by all the fesh2
+    instances using the same cache directory. For each file there's a copy of the latest version (unless
+    the servers don't have it yet), a JSON record of when it was fetched and what the servers said, and a
+    lock file.
+
+    An instance takes the lock for a file before contacting the servers, so if several instances want the
+    same file at once, one fetches it and the others wait and then use its result, as long as it's more
+    recent than their own check interval. Different files can be fetched in parallel.
+    """
+
+    # Remove files that haven't been fetched for this long (days)
+    max_age_days = 30
+
+    def __init__(self, directory):
+        """
+        :param directory: the cache directory. It's made if it doesn't exist.
+        """
+        self.directory = directory
+        if not path.isdir(directory):
+            os.makedirs(directory)
+        self.locks = FileLocks(directory)
+
+    def data_file(self, name):
+        return path.join(self.directory, name)
+
+    def info_file(self, name):
+        return path.join(self.directory, "{}.json".format(name))
+
+    def locked(self, name):
+        """Hold the lock for a file (waiting for other instances to release it)"""
+        return self.locks.locked(name)
+
+    def get(self, name, max_age_s):
+        """The CacheEntry for a file if it was fetched within the last max_age_s seconds, otherwise None.
+        Call with the lock held."""
+        try:
+            with open(self.info_file(name)) as fh:
+                info = json.load(fh)
+            # the size and modification time of the copy when it was stored
+            data_stat = (info.pop("data_size", None), info.pop("data_mtime", None))
+            entry = CacheEntry(**info)
+        except (IOError, OSError, ValueError, TypeError):
+            return None
+        if time.time() - entry.fetched > max_age_s:
+            return None
+        if entry.exists:
+            # make sure the copy is still the one that was fetched. Like Manifest.sha256, the stored hash is
+            # trusted if the size and modification time haven't changed.
+            data_file = self.data_file(name)
+            try:
+                stinfo = os.stat(data_file)
+            except OSError:
+                return None
+            if data_stat != (stinfo.st_size, stinfo.st_mtime):
+                if file_sha256(data_file) != entry.sha256:
+                    return None
+        return entry
+
+    def store(self, entry, local_file=None):
+        """Record the result of a fetch. local_file is the file with the content the servers sent, if they had
+        it. Call with the lock held."""
+        data_file = self.data_file(entry.name)
+        info = entry._asdict()
+        try:
+            if entry.exists:
+                (fd, tmp) = temp_file(data_file)
+                os.close(fd)
+                os.remove(tmp)
+                copy_file(local_file, tmp)
+                replace(tmp, data_file)
+                stinfo = os.stat(data_file)
+                info["data_size"] = stinfo.st_size
+                info["data_mtime"] = stinfo.st_mtime
+            elif path.exists(data_file):
+                os.remove(data_file)
+            (fd, tmp) = temp_file(self.info_file(entry.name))
+            with os.fdopen(fd, "w") as fh:
+                json.dump(info, fh, indent=1)
+            replace(tmp, self.info_file(entry.name))
+        except (IOError, OSError) as e:
+            logging.warning(
+                "Couldn't save {} in the shared cache: {}".format(entry.name, e)
+            )
+
+    def prune(self):
+        """Remove files that haven't been fetched for max_age_days"""
+        self.locks.prune()
+        cutoff = time.time() - self.max_age_days * 86400
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            filename = path.join(self.directory, name)
+            try:
+                if name.endswith(".json"):
+                    # the time of the record is the time of the last fetch
+                    if os.stat(filename).st_mtime < cutoff:
+                        base = name[: -len(".json")]
+                        os.remove(filename)
+                        if path.exists(self.data_file(base)):
+                            os.remove(self.data_file(base))
+                elif name.startswith("."):
+                    # temporary files left by instances that stopped while writing
+                    if os.stat(filename).st_mtime < cutoff:
+                        os.remove(filename)
+            except OSError:
+                pass
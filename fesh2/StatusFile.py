@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import json
+import logging
+import os
+import tempfile
+import time
+from os import path
+
+# Name of the status file. It's kept in the log directory
+status_filename = "fesh2_status.json"
+
+
+def status_file_name(config):
+    return "{}/{}".format(config.LogDir, status_filename)
+
+
+def utc_text(t):
+    """A time.time() value as UTC text for the status file, or None"""
+    if t is None:
+        return None
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(t))
+
+
+def write_status(filename, status):
+    """Write the status (a dictionary) to a JSON file. The file is replaced in one go so readers never see
+    part of it."""
+    directory = path.dirname(filename) or "."
+    (fd, tmp) = tempfile.mkstemp(prefix=".fesh2_status", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as fh:
+            json.dump(status, fh, indent=1)
+        # readable by everyone, like the log file
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, filename)
+    except (IOError, OSError) as e:
+        logging.warning("Couldn't write the status file {}: {}".format(filename, e))
+        if path.exists(tmp):
+            os.remove(tmp)
+
+
+def read_status(filename):
+    """Read the status written by write_status. Returns None if there isn't one."""
+    try:
+        with open(filename) as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def find_last_line(filename, text, block_size=65536):
+    """The last line of a file containing text, or None if there isn't one. The file is read backwards a
+    block at a time so only the end of a large log file is usually read."""
+    needle = text.encode()
+    with open(filename, "rb") as fh:
+        fh.seek(0, os.SEEK_END)
+        pos = fh.tell()
+        # the start of a line that continues in the block after
+        partial = b""
+        while pos > 0:
+            size = min(block_size, pos)
+            pos -= size
+            fh.seek(pos)
+            lines = (fh.read(size) + partial).split(b"\n")
+            if pos > 0:
+                # the first line may start in the block before
+                partial = lines.pop(0)
+            for line in reversed(lines):
+                if needle in line:
+                    return line.decode("utf-8", "replace")
+    return None
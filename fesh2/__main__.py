@@ -2,29 +2,51 @@
 from __future__ import print_function
 
 # Inspired by nobs and fesh
-import errno
-import filecmp
-from collections import OrderedDict
+import calendar
+import json
+from collections import OrderedDict, namedtuple
 
 import configargparse
 import datetime
 import logging
 import os
 import sys
-import threading
 import time
 import string
 import signal
 import re
-import fcntl
 import shutil
+import tempfile
 
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from logging.handlers import RotatingFileHandler
 
 from fesh2.FeshConfig import Config
-from fesh2.MasterSession import Session
-from fesh2.Drudgery import Drudg
+from fesh2.AtomicFile import copy_replace, replace
+from fesh2.BackupFile import BackupFile
+from fesh2.MasterSession import (
+    load_master,
+    load_master_index,
+    station_mask,
+    mask_stations,
+)
+from fesh2.CheckScheduler import CheckScheduler, check_interval
+from fesh2.ControlSocket import ControlServer, send_request
+from fesh2.DirSnapshot import DirSnapshot, file_exists
+from fesh2.Drudgery import Drudg, DrudgCache, DrudgProfiles
+from fesh2.FileWatcher import FileWatcher
+from fesh2.StatusFile import (
+    status_file_name,
+    utc_text,
+    write_status,
+    read_status,
+    find_last_line,
+)
+from fesh2.FileLocks import FileLocks
+from fesh2.FileManifest import Manifest, CheckState
+from fesh2.ServerHealth import ServerHealth
+from fesh2.SharedCache import SharedCache
 from fesh2 import SchedServer
 from os import path
 from datetime import datetime, timedelta
@@ -53,19 +75,31 @@ def main_task(config):
 
     :param config: Configuration parameters
     :type config: Config Class
-    :return: none
-    :rtype: none
+    :return: the sessions that were considered
+    :rtype: list of Session class
     """
 
-    """
-    Lock out other fesh2 instances from manipulating files. 
-    Wait here until the lock file is unlocked so multiple instances of fesh2 don't
-    attempt to drudg files at the same time. Go ahead though if config.check is set because it doesn't
-    change local files.
-    """
-    lock = Locker()
+    # Other fesh2 instances may be running at the same time. Each master file, session schedule and drudg
+    # output is locked while it's being worked on (see FileLocks), so they only wait for each other if they
+    # want the same files. A status report (config.check) doesn't change anything, so doesn't lock, and
+    # doesn't use the state set up by setup_state.
+
+    if not config.check:
+        # Get the latest record of when files were checked (another fesh2 instance may have
+        # checked some)
+        config.check_state.load()
+        if config.server_health:
+            config.server_health.load()
+    # Read the local directories once for this check, unless they're being watched and the watcher already
+    # knows about the files
+    if config.file_watcher:
+        config.snapshot = config.file_watcher.snapshot()
+    else:
+        config.snapshot = DirSnapshot()
     if not config.check:
-        lock.lock()
+        config.locks.prune()
+        if config.shared_cache:
+            config.shared_cache.prune()
 
     # --------------------------------------------------------------------------
     if not config.check:
@@ -79,81 +113,93 @@ def main_task(config):
     # --------------------------------------------------------------------------
     # Read in the Master File
     # Make a list of master files to process
-    mstrs = []
-    if config.GetMaster:
-        local_file = "{}/master{:02d}.txt".format(config.SchedDir, config.year - 2000)
-        if path.exists(local_file):
-            mstrs.append(local_file)
-    if config.GetMasterIntensive:
-        local_file = "{}/master{:02d}-int.txt".format(
-            config.SchedDir, config.year - 2000
-        )
-        if path.exists(local_file):
-            mstrs.append(local_file)
+    mstrs = master_files(config)
     if not mstrs:
         # No Master files obtained
         msg = "No Master file(s) found. Exiting"
         logging.error(msg)
         raise Exception(msg)
 
-    # list of all sessions in time order
-    sessions_queue_ses = read_master(mstrs, config.year, config.Stations)
+    # all sessions, indexed by time, station and code
+    index = load_master_index(mstrs, config.year)
     # which session(s) we process depends on arguments and config. After this section we'll
     # end up with a list of sessions requiring processing in sessions_to_process
-    sessions_to_process = []
     if config.g:
-        # if config.g is set then we want a specific session regardless of time or anything else
-        sessions_to_process = list(
-            filter(lambda i: i.code in config.g, sessions_queue_ses)
-        )
+        # if config.g is set then we want a specific session regardless of time or anything else.
+        # More than one can be given, separated by commas or spaces.
+        sessions_to_process = index.with_codes(re.split(r"[\s,]+", config.g.strip()))
     else:
         now = datetime.utcnow()
-        for ses in sessions_queue_ses:
-            if config.current and (ses.start <= now < ses.end or ses.start >= now):
-                # If:
-                #       1. we don't want a session with all our stations in it AND at least one of our stations in in the session
-                #    OR:
-                #       2. we want a session with all our stations in it AND this session satisfies that requirement
-                #    THEN:
-                #       We found it, so stop searching through the master schedule
-                if (not config.all_stations and ses.our_stns_in_exp != set()) or (
-                    config.all_stations and ses.our_stns_in_exp == set(config.Stations)
-                ):
-                    # if config.current is set then get the current or next session
-                    sessions_to_process = [ses]
-                    # now break out of the for loop
-                    break
-            elif (ses.start <= now < ses.end) or (
-                now <= ses.start < now + timedelta(days=config.LookAheadTimeDays)
-            ):
-                # only consider scheds within the lookahead time
-                # If:
-                #       1. we don't want a session with all our stations in it AND at least one of our stations in in the session
-                #    OR:
-                #       2. we want a session with all our stations in it AND this session satisfies that requirement
-                #    THEN:
-                #       We found it, so stop searching through the master schedule
-                if (not config.all_stations and ses.our_stns_in_exp != set()) or (
-                    config.all_stations and ses.our_stns_in_exp == set(config.Stations)
-                ):
-                    sessions_to_process.append(ses)
+        # We want sessions with at least one of our stations in them, or if config.all_stations
+        # is set, sessions with all our stations in them
+        if config.current:
+            # if config.current is set then get the current or next session
+            sessions_to_process = index.upcoming(
+                now, 1, config.Stations, config.all_stations
+            )
+        else:
+            # only consider scheds within the lookahead time
+            sessions_to_process = index.window(
+                now,
+                timedelta(days=config.LookAheadTimeDays),
+                config.Stations,
+                config.all_stations,
+            )
+    if config.force_sessions:
+        # sessions whose schedules have been asked for through the control socket are checked even
+        # if they wouldn't be otherwise
+        codes = set(ses.code for ses in sessions_to_process)
+        forced = index.with_codes(sorted(config.force_sessions - codes))
+        unknown = config.force_sessions - codes - set(ses.code for ses in forced)
+        if unknown:
+            logging.warning(
+                "Sessions not found in the master file(s): {}".format(
+                    ", ".join(sorted(unknown))
+                )
+            )
+        sessions_to_process = list(sessions_to_process) + forced
+    # tag the sessions with which of our stations are in them
+    our_mask = station_mask(config.Stations)
+    for ses in sessions_to_process:
+        ses.our_stns_in_exp = mask_stations(ses.station_mask & our_mask)
     # sessions_to_process should now be filled
 
+    # What happened to each session, for the status file
+    outcomes = OrderedDict()
     # If sessions_to_process is not empty then we found a session satisfying the input criteria
     if not sessions_to_process:
         logging.warning("No sessions were found that satisfy the criteria")
     else:
+        # Check the schedule files for all the sessions in one pass
+        results = check_scheds(sessions_to_process, config)
+        if not config.check:
+            # schedule files may have changed
+            config.snapshot.invalidate()
         # Process each session in the list
-        for ses in sessions_to_process:
-            (got_sched_file, new, sched_type, ok_to_drudg) = check_sched(ses, config)
+        jobs = []
+        for (ses, result) in zip(sessions_to_process, results):
+            (got_sched_file, new, sched_type, ok_to_drudg) = result
             # got_sched_file is True if we got the file
             # new = True if it's newer than the old one (if there was one)
+            outcomes[ses.code] = {
+                "got_sched_file": got_sched_file,
+                "new": new,
+                "sched_type": sched_type,
+                "ok_to_drudg": ok_to_drudg,
+                "drudg": {},
+            }
             if not config.check:
                 # Drudg the schedule
                 if ok_to_drudg:
-                    drudg_session(ses, config, got_sched_file, new, sched_type)
+                    jobs.extend(drudg_jobs(ses, config, got_sched_file, new, sched_type))
                 else:
                     logging.info("Skipping Drudg for this session")
+        # Run drudg for all the sessions and stations together
+        if jobs:
+            drudg_results = run_drudg_jobs(jobs, config)
+            config.snapshot.invalidate()
+            for (job, drudg_result) in zip(jobs, drudg_results):
+                outcomes[job.ses.code]["drudg"][job.station] = drudg_result[0]
 
     if not config.check:
         # If forced downloads were set, unset them now
@@ -167,10 +213,47 @@ def main_task(config):
                 "A forced Master schedule download was set. This has now been attempted so stopping the force."
             )
             config.force_master_update = False
-    # show a summary of the sessions
-    show_summary(config, mstrs, sessions_to_process)
+        if config.force_sessions:
+            logging.info(
+                "Schedule downloads were requested for {}. These have now been attempted.".format(
+                    ", ".join(sorted(config.force_sessions))
+                )
+            )
+            config.force_sessions = set()
     # Record the time of the last update (only if we're not doing a status check)
     sched_check_text = "** Schedule check completed **"
+    now_s = time.time()
+    previous = read_status(status_file_name(config)) or {}
+    # server timings are kept from earlier checks for servers that weren't used in this one
+    servers = previous.get("servers", {})
+    if not config.check:
+        last_check = now_s
+        servers.update(config.curl_pool.latencies())
+        if config.server_health:
+            for (url, health) in config.server_health.summary().items():
+                servers.setdefault(url, {}).update(health)
+    else:
+        # find the time of the last check, from the status file if there is one
+        last_check = previous.get("last_check")
+        if last_check is None:
+            # otherwise find the last sched_check_text in the log file (reading from the end)
+            lastfound = find_last_line(
+                logging.Logger.root.handlers[0].baseFilename, sched_check_text
+            )
+            if lastfound:
+                sp = re.split('\s|\.',lastfound)
+                dt = datetime.strptime("{} {}".format(sp[0], sp[1]), "%Y-%m-%d %H:%M:%S")
+                last_check = calendar.timegm(dt.timetuple())
+    status = build_status(
+        config, mstrs, sessions_to_process, outcomes, last_check, servers, now_s
+    )
+    # kept for the control socket
+    config.status = status
+    # show a summary of the sessions
+    if config.check and config.format == "json":
+        print(json.dumps(status, indent=1))
+    else:
+        show_summary(config, status)
     if not config.check:
         # get the current level
         lgr = logging.getLogger()
@@ -181,31 +264,88 @@ def main_task(config):
         logging.info(sched_check_text)
         # revert log level
         lgr.setLevel(llevel)
+        # and record the status in the status file
+        write_status(status_file_name(config), status)
     else:
-        # read the log file and find the time of the last sched_check_text
-        lastfound = None
-        with open(logging.Logger.root.handlers[0].baseFilename) as fh:
-            data = fh.readlines()
-        for line in data:
-            if sched_check_text in line:
-                lastfound = line
-        if lastfound:
-            sp = re.split('\s|\.',lastfound)
-            dt = datetime.strptime("{} {}".format(sp[0], sp[1]), "%Y-%m-%d %H:%M:%S")
-            delta = (datetime.utcnow() - dt).total_seconds()
-            delta_h = int((delta - delta % 3600) / 3600)
-            delta_m = int((delta - (3600 * delta_h)) / 60)
-            logging.info(
-                "Schedules were last checked {:02d}:{:02d} ago (HH:MM)".format(
-                    delta_h, delta_m
-                )
-            )
+        log_last_check(last_check, now_s)
 
-    # release the lock file and tidy up
-    if not config.check:
-        lock.unlock()
-    lock.close()
-    del lock
+    # tidy up
+    config.snapshot = None
+    return sessions_to_process
+
+
+def log_last_check(last_check, now_s=None):
+    """
+    Logs how long ago the schedules were last checked
+
+    :param last_check: time of the last check (time.time() value), or None if it isn't known
+    :type last_check: float
+    :param now_s: the current time (time.time() value, default is now)
+    :type now_s: float
+    """
+    if last_check is None:
+        return
+    if now_s is None:
+        now_s = time.time()
+    delta = now_s - last_check
+    delta_h = int((delta - delta % 3600) / 3600)
+    delta_m = int((delta - (3600 * delta_h)) / 60)
+    logging.info(
+        "Schedules were last checked {:02d}:{:02d} ago (HH:MM)".format(
+            delta_h, delta_m
+        )
+    )
+
+
+def master_files(config):
+    """
+    The local master files we use (if they exist)
+
+    :param config: configuration parameters (from the config file)
+    :type config: Config class
+    :return: master file names
+    :rtype: list of strings
+    """
+    mstrs = []
+    if config.GetMaster:
+        local_file = "{}/master{:02d}.txt".format(config.SchedDir, config.year - 2000)
+        if path.exists(local_file):
+            mstrs.append(local_file)
+    if config.GetMasterIntensive:
+        local_file = "{}/master{:02d}-int.txt".format(
+            config.SchedDir, config.year - 2000
+        )
+        if path.exists(local_file):
+            mstrs.append(local_file)
+    return mstrs
+
+
+def process_local_changes(config, codes):
+    """
+    Runs drudg where it's needed for sessions with files that have been changed locally (e.g. an operator
+    has replaced a schedule file or removed a SNP file). The servers aren't checked.
+
+    :param config: configuration parameters (from the config file)
+    :type config: Config class
+    :param codes: the codes of the sessions with changed files
+    :type codes: set of strings
+    """
+    index = load_master_index(master_files(config), config.year)
+    our_mask = station_mask(config.Stations)
+    sched_server = SchedServer.SchedFileServer(config.SchedDir, config.curl_pool)
+    jobs = []
+    for ses in index.with_codes(codes):
+        ses.our_stns_in_exp = mask_stations(ses.station_mask & our_mask)
+        if not ses.our_stns_in_exp:
+            continue
+        (got_sched_file, sched_type) = sched_server.check_exists_sched(
+            ses.code, config
+        )
+        if got_sched_file:
+            logging.info("Files for {} have changed locally".format(ses.code))
+            jobs.extend(drudg_jobs(ses, config, True, False, sched_type))
+    # drudg_station locks each schedule and station
+    run_drudg_jobs(jobs, config)
 
 
 def check_master(cnf, intensive=False):
@@ -221,7 +361,6 @@ def check_master(cnf, intensive=False):
     :rtype: boolean
     """
 
-    new_sched = False
     if not intensive:
         cnf.logger.info(
             "Checking IVS 24h session Master File master{:02d}.txt".format(
@@ -237,14 +376,32 @@ def check_master(cnf, intensive=False):
         )
         local_file = "{}/master{:02d}-int.txt".format(cnf.SchedDir, cnf.year - 2000)
     cnf.logger.debug("Local file is {}".format(local_file))
+    # hold the lock on the master file while it's checked, so two instances don't both fetch it
+    with cnf.locks.locked(path.basename(local_file)):
+        # another instance may have checked it since the check state was loaded
+        cnf.check_state.refresh([local_file])
+        return check_master_locked(cnf, intensive, local_file)
+
+
+def check_master_locked(cnf, intensive, local_file):
+    """
+    The body of check_master, called with the lock on the master file held
+
+    :param cnf: configuration parameters (from the config file)
+    :type cnf: Config class
+    :param intensive: Are we looking for an Intensive master file?
+    :type intensive: boolean
+    :param local_file: the local master file name (including the path)
+    :type local_file: string
+    :return: Has a new version been retrieved?
+    :rtype: boolean
+    """
+    new_sched = False
     now = time.time()
-    if path.exists(local_file):
-        stinfo = os.stat(local_file)
-        file_access_time_local = stinfo.st_atime
-    else:
-        file_access_time_local = now
-    timed_out = (now - 60 * 60 * cnf.MasterCheckTime) > file_access_time_local
     file_exists = path.exists(local_file)
+    timed_out = file_exists and (
+        now - 60 * 60 * cnf.MasterCheckTime
+    ) > cnf.check_state.last_checked(local_file)
     if timed_out or not file_exists or cnf.force_master_update:
         # we've waited long enough or the file doesn't exist locally or a download has been forced
         if timed_out:
@@ -254,18 +411,24 @@ def check_master(cnf, intensive=False):
         if cnf.force_sched_update:
             cnf.logger.info("A download has been forced")
         # for each server, try to retrieve the file
-        master_server = SchedServer.MasterServer(cnf.SchedDir)
+        master_server = SchedServer.MasterServer(
+            cnf.SchedDir, cnf.curl_pool, cnf.manifest, cnf.check_state, cnf.shared_cache
+        )
         master_server.curl_setup(cnf.NetrcFile, cnf.CookiesFile, cnf.CurlSecLevel1, cnf.quiet)
-        force = cnf.force_master_update
-        for server_url in cnf.Servers:
-            cnf.logger.info("Checking Master file(s) at {}".format(server_url))
-            (success, new_sched) = master_server.get_master(
-                server_url, cnf.year, cnf.SchedDir, force, 0, intensive, cnf.quiet
-            )
-            if force and success and new_sched:
-                # We had a forced download and got the file. Now we only need to download from another server if it's
-                # newer there. So set the force flag to False.
-                force = False
+        # check all the servers at once and keep the most recent version
+        servers = servers_to_try(cnf)
+        cnf.logger.info("Checking Master file(s) at {}".format(", ".join(servers)))
+        (success, new_sched) = master_server.get_master_servers(
+            servers,
+            cnf.year,
+            cnf.SchedDir,
+            cnf.force_master_update,
+            intensive,
+            cnf.quiet,
+            cnf.ProbeServers,
+            60 * 60 * cnf.MasterCheckTime,
+        )
+        record_check(cnf, local_file, success, new_sched, master_server.server_used)
         master_server.curl_close()
     else:
         cnf.logger.info(
@@ -277,7 +440,46 @@ def check_master(cnf, intensive=False):
     return new_sched
 
 
-def check_sched(ses, config):
+def record_check(config, local_file, success, new, server):
+    """
+    Records the outcome of checking the servers for a file in config.check_state
+
+    :param config: configuration parameters (from the config file)
+    :type config: Config class
+    :param local_file: the local file name (including the path)
+    :type local_file: string
+    :param success: Did a server respond?
+    :type success: boolean
+    :param new: Did we get a new version of the file?
+    :type new: boolean
+    :param server: The server the result came from
+    :type server: string
+    """
+    if not success:
+        result = CheckState.FAILED
+    elif new:
+        result = CheckState.NEW
+    else:
+        result = CheckState.UNCHANGED
+    config.check_state.record(local_file, result, server)
+
+
+def servers_to_try(config):
+    """
+    The servers to ask for a file: config.Servers, best first and without any that are being left out after
+    failing, if ServerHealth is set
+
+    :param config: configuration parameters (from the config file)
+    :type config: Config class
+    :return: server URLs
+    :rtype: list of strings
+    """
+    if not config.server_health:
+        return config.Servers
+    return config.server_health.rank(config.Servers)
+
+
+def check_sched(ses, config, quiet=None):
     """
     For a given session, decides if the schedule file needs checking, interrogates the server(s) and gets the most
     recent one if it hasn't been downloaded yet or has been updated.
@@ -286,18 +488,102 @@ def check_sched(ses, config):
     :type ses: Session class
     :param config: configuration parameters (from the config file)
     :type config: Config class
+    :param quiet: Suppress progress bars (default is config.quiet)
+    :type quiet: boolean
     :return: got_sched_file: Did we get a file?,
     new: Is it new?
     sched_type: file type (vex or skd)
     :rtype: boolean, boolean, string
     """
+    if config.check:
+        # a status report doesn't change anything, so doesn't need the lock
+        check = plan_sched_check(ses, config)
+        return finish_sched_check(check, config)
+    # The session's schedule is locked from the decision to check it until the result has been dealt with
+    # (backups, .new files), so another fesh2 instance can't change it in between
+    with config.locks.locked("{}.sched".format(ses.code)):
+        # another instance may have checked or changed the files since we last looked
+        sched_files = [
+            "{}/{}.{}".format(config.SchedDir, ses.code, type)
+            for type in config.SchedTypes
+        ]
+        config.check_state.refresh(sched_files)
+        if config.snapshot:
+            config.snapshot.refresh(sched_files)
+        check = plan_sched_check(ses, config)
+        if check.download:
+            fetch_sched(check, config, quiet)
+        return finish_sched_check(check, config)
+
+
+def check_scheds(sessions, config):
+    """
+    Does the same as check_sched for a list of sessions, up to MaxDownloads at a time. Each session is
+    locked while it's checked, so other fesh2 instances can check different sessions at the same time.
 
+    :param sessions: The sessions to be processed
+    :type sessions: list of Session class
+    :param config: configuration parameters (from the config file)
+    :type config: Config class
+    :return: (got_sched_file, new, sched_type, ok_to_drudg) for each session, as returned by check_sched
+    :rtype: list of tuples
+    """
+    if config.check:
+        return [check_sched(ses, config) for ses in sessions]
+    # progress bars from simultaneous downloads would write over each other
+    quiet = config.quiet or len(sessions) > 1
+    with ThreadPoolExecutor(max_workers=config.MaxDownloads) as pool:
+        # list() so that any exception in a worker is raised here
+        return list(pool.map(partial(check_sched, config=config, quiet=quiet), sessions))
+
+
+class SchedCheck:
+    """
+    The state of a schedule file check for one session. Filled in by plan_sched_check, fetch_sched and
+    finish_sched_check in turn.
+    """
+
+    def __init__(self, ses):
+        self.ses = ses
+        # schedule file types to look for, in priority order
+        self.types = []
+        # the type of the local schedule file (if there is one)
+        self.sched_type = ""
+        self.got_sched_file = False
+        self.new = False
+        # Change this to false if there's a new schedule file because the user should check
+        # and drudg by hand.
+        self.ok_to_drudg = True
+        # Do we have a local copy of the schedule file?
+        self.file_exists = False
+        # Has it been longer than ScheduleCheckTime since the servers were checked?
+        self.timed_out = False
+        # The time between checks of the servers for this session (hours)
+        self.interval = 0
+        # Has a download been forced (for all sessions or just this one)?
+        self.forced = False
+        # Should we contact the servers?
+        self.download = False
+        # A copy of the local schedule file made before it was replaced by a new version
+        self.backup_file_name = ""
+        # Results from the servers for the last type checked
+        self.got_sched_file_from_server = False
+        self.new_from_server = False
+
+
+def plan_sched_check(ses, config):
+    """
+    Works out which schedule files need to be requested from the servers for a session.
+
+    :param ses: The session to be processed
+    :type ses: Session class
+    :param config: configuration parameters (from the config file)
+    :type config: Config class
+    :return: the plan for the session
+    :rtype: SchedCheck class
+    """
     now = datetime.utcnow()
-    new = False
-    got_sched_file = False
-    # Change this to false if there's a new schedule file because the user should check
-    # and drudg by hand.
-    ok_to_drudg = True
+    check = SchedCheck(ses)
     # Is the session current, the next one, or a specific one?
     if not config.check:
         logging.info(
@@ -312,179 +598,189 @@ def check_sched(ses, config):
         # it's in the future
         logging.debug("This session is in the future")
 
-    # set up for Schedule File operations
-    if not config.check:
-        config.logger.info(
-            "Getting schedule file for {} if it's available...".format(ses.code)
-        )
-    # For each schedule type, go through the servers and check for them if they haven't
-    sched_server = SchedServer.SchedFileServer(config.SchedDir)
-    sched_server.curl_setup(config.NetrcFile, config.CookiesFile, config.CurlSecLevel1, config.quiet)
     # do we have either a vex or skd file locally? If yes, then just check that type
-    (got_sched_file, sched_type) = sched_server.check_exists_sched(ses.code, config)
-    types = []
-
-    if got_sched_file:
+    sched_server = SchedServer.SchedFileServer(config.SchedDir, config.curl_pool)
+    (check.got_sched_file, check.sched_type) = sched_server.check_exists_sched(
+        ses.code, config
+    )
+    if check.got_sched_file:
         # we have a local copy (downloaded previously), so just check this type
-        types.append(sched_type)
+        check.types = [check.sched_type]
     else:
         # we don't have any local files, so check all types
-        types = config.SchedTypes
-    # now go through the valid different types
-    config.logger.debug("Checking file types {}".format(types))
-    for type in types:
-        # name of the local file:
-        local_file = "{}/{}.{}".format(config.SchedDir, ses.code, type)
-        config.logger.debug("Local file is {}".format(local_file))
-        now_s = time.time()
-        # get the last file access time (if it exists)
-        if path.exists(local_file):
-            stinfo = os.stat(local_file)
-            file_access_time_local = stinfo.st_atime
-        else:
-            file_access_time_local = now_s
-        # Should we check?
-        timed_out = (
-            now_s - 60 * 60 * config.ScheduleCheckTime
-        ) > file_access_time_local
+        check.types = config.SchedTypes
+    config.logger.debug("Checking file types {}".format(check.types))
 
-        if not config.check:
-            # If we just want a status report, don't access the servers
-            file_exists = path.exists(local_file)
-            if file_exists:
-                # A local copy of the schedule file already exists
-                # Make a backup copy of it
-                bf = BackupFile()
-                backup_file_name = bf.backup_file(local_file)
-            if timed_out or not file_exists or config.force_sched_update:
-                # we've waited long enough or the file doesn't exist locally or a download
-                # has been forced
-                if timed_out:
-                    config.logger.info(
-                        "It's been longer than the schedule check interval"
-                    )
-                if not file_exists:
-                    config.logger.info("File doesn't exist locally")
-                if config.force_sched_update:
-                    config.logger.info("A download has been forced")
-                # for each server, try to retrieve the file
-                force = config.force_sched_update
-                for server_url in config.Servers:
-                    # get the schedule. Set check_delta_hours=0 to make sure we get the latest version
-                    # regardless of server
-                    (
-                        got_sched_file_from_server,
-                        new_from_server,
-                    ) = sched_server.get_sched(
-                        server_url,
-                        ses.code,
-                        type,
-                        config.year,
-                        config.SchedDir,
-                        force,
-                        config.quiet,
-                        check_delta_hours=0,
-                    )
-                    if force and got_sched_file_from_server and new_from_server:
-                        # We had a forced download and got the file. Now we only need to download
-                        # from another server if it's
-                        # newer there. So set the force flag to False.
-                        force = False
-
-                    if got_sched_file_from_server:
-                        got_sched_file = True
-                    if new_from_server:
-                        new = True
-                # We've been through all the servers
-                # did we get a file and is it new and did we have a previous version?
-                if got_sched_file and new and file_exists:
-                    if not config.update:
-                        # We think, based on the file mod times on the server and locally,
-                        # that there's a new schedule file called <sched>.skd that's newer
-                        # than the backup, called <sched>.skd.bak.N. However, sometimes the mod
-                        # time is unreliable (have seen this on curl FILETIME requests for CDDIS).
-                        # So do a secondary check where we compare file contents. If they are identical
-                        # then it isn't a new file and the backup file should be renamed to <sched>.skd.
-                        # Else all is well
-                        if filecmp.cmp(local_file, backup_file_name, shallow=False):
-                            if config.force_sched_update:
-                                config.logger.info("The newly downloaded file is identical in content to the one we "
-                                                   "already have. The forced update was unnecessary.")
-                            else:
-                                config.logger.info("The newly downloaded file is identical in content to the one we "
-                                                   "already have. The server may be reporting an incorrect modification "
-                                                   "time.")
-                            shutil.move(
-                                backup_file_name, local_file
-                            )  # mv <sched.skd.bak.N> <sched.skd>
-                            # We shouldn't need to run drudg again.
-                            ok_to_drudg = False
-                        else:
-                            # Tell the user that there's a new schedule file but don't
-                            # Drudg it. Call the new one <sched>.new, the old one <sched>
-                            # which should be the same as backup_file_name
-                            ok_to_drudg = False
-                            new_file_name = "{}.new".format(local_file)
-                            shutil.move(
-                                local_file, new_file_name
-                            )  # mv <sched.skd> <sched.skd.new>
-                            shutil.copy2(
-                                backup_file_name, local_file
-                            )  # cp <sched.skd.bak.N> <sched.skd>
-                            send_warning_new_sched(
-                                backup_file_name, local_file, new_file_name, config
-                            )
-                    else:
-                        # Update is forced
-                        ok_to_drudg = True
-                        # if there's a .new file, we don't need it any more
-                        new_file_name = "{}.new".format(local_file)
-                        if path.exists(new_file_name):
-                            os.remove(new_file_name)
-
-                elif file_exists:
-                    if not new_from_server:
-                        # We didn't get a new schedule file. So remove the backup file
-                        if path.exists(backup_file_name):
-                            os.remove(backup_file_name)
-                    elif path.exists(backup_file_name):
-                        config.logger.info(
-                            "Made a backup of the file to {}".format(backup_file_name)
-                        )
+    if config.check:
+        # If we just want a status report, don't access the servers
+        return check
 
-            else:
-                if not timed_out:
-                    config.logger.info(
-                        "It's less than {} h since the last schedule check. Not checking.".format(
-                            config.ScheduleCheckTime
-                        )
-                    )
-                # We didn't get a new schedule file. So remove the backup file
-                if path.exists(backup_file_name):
-                    os.remove(backup_file_name)
-
-            if got_sched_file:
-                # Got the file, don't keep looking down the prioritised list of types
-                sched_type = type
-                break
+    config.logger.info(
+        "Getting schedule file for {} if it's available...".format(ses.code)
+    )
+    # There's at most one local file, and that's the only type we'll check
+    local_file = "{}/{}.{}".format(config.SchedDir, ses.code, check.types[0])
+    config.logger.debug("Local file is {}".format(local_file))
+    check.file_exists = file_exists(local_file, config.snapshot)
+    # Should we check? Sessions that are close get checked more often
+    interval = check_interval(config, ses, local_file, now)
+    check.interval = interval
+    now_s = time.time()
+    if check.file_exists:
+        check.timed_out = (
+            now_s - 60 * 60 * interval
+        ) > config.check_state.last_checked(local_file)
+    else:
+        # it hasn't been released yet (or it's never been checked)
+        entry = config.check_state.get(local_file)
+        check.timed_out = not entry or (now_s - 60 * 60 * interval) > entry.checked
+
+    check.forced = config.force_sched_update or ses.code in config.force_sessions
+    if check.timed_out or check.forced:
+        # we've waited long enough (or the file has never been checked) or a download
+        # has been forced
+        if check.timed_out:
+            config.logger.info("It's been longer than the schedule check interval")
+        if not check.file_exists:
+            config.logger.info("File doesn't exist locally")
+        if check.forced:
+            config.logger.info("A download has been forced")
+        check.download = True
+    else:
+        config.logger.info(
+            "It's less than {:.1f} h since the last schedule check. Not checking.".format(
+                interval
+            )
+        )
+    return check
+
+
+def fetch_sched(check, config, quiet=None):
+    """
+    Gets the schedule file for a planned check from the servers. Goes through the schedule file types in
+    priority order and stops at the first one found. Safe to run in a worker thread as it only touches the
+    files of its own session.
+
+    :param check: The plan from plan_sched_check
+    :type check: SchedCheck class
+    :param config: configuration parameters (from the config file)
+    :type config: Config class
+    :param quiet: Suppress progress bars (default is config.quiet)
+    :type quiet: boolean
+    """
+    if quiet is None:
+        quiet = config.quiet
+    sched_server = SchedServer.SchedFileServer(
+        config.SchedDir,
+        config.curl_pool,
+        config.manifest,
+        config.check_state,
+        config.shared_cache,
+    )
+    sched_server.curl_setup(
+        config.NetrcFile, config.CookiesFile, config.CurlSecLevel1, quiet
+    )
+
+    def make_backup(local_file):
+        # The local schedule file is about to be replaced by one with different content
+        check.backup_file_name = config.backups.backup_file(local_file)
+
+    for type in check.types:
+        # check all the servers at once and keep the most recent version
+        (
+            check.got_sched_file_from_server,
+            check.new_from_server,
+        ) = sched_server.get_sched_servers(
+            servers_to_try(config),
+            check.ses.code,
+            type,
+            config.year,
+            config.SchedDir,
+            check.forced,
+            quiet,
+            config.ProbeServers,
+            make_backup,
+            60 * 60 * check.interval,
+        )
+        record_check(
+            config,
+            "{}/{}.{}".format(config.SchedDir, check.ses.code, type),
+            check.got_sched_file_from_server,
+            check.new_from_server,
+            sched_server.server_used,
+        )
+        if check.got_sched_file_from_server:
+            check.got_sched_file = True
+        if check.new_from_server:
+            check.new = True
+        if check.got_sched_file:
+            # Got the file, don't keep looking down the prioritised list of types
+            check.sched_type = type
+            break
     sched_server.curl_close()
 
+
+def finish_sched_check(check, config):
+    """
+    Processes the results of a schedule check: if a new version of a schedule file we already had was
+    downloaded, renames it to <sched>.new for the user to deal with unless an update was requested.
+
+    :param check: The plan from plan_sched_check, after fetch_sched if a download was needed
+    :type check: SchedCheck class
+    :param config: configuration parameters (from the config file)
+    :type config: Config class
+    :return: got_sched_file: Did we get a file?,
+    new: Is it new?
+    sched_type: file type (vex or skd)
+    ok_to_drudg: Should the file be drudged?
+    :rtype: boolean, boolean, string, boolean
+    """
+    ses = check.ses
+    backup_file_name = check.backup_file_name
+    if not config.check and check.file_exists and check.got_sched_file and check.new:
+        # We got a file with different content to the previous version, which has been
+        # backed up to <sched>.skd.bak.N
+        local_file = "{}/{}.{}".format(config.SchedDir, ses.code, check.sched_type)
+        if not config.update:
+            # Tell the user that there's a new schedule file but don't
+            # Drudg it. Call the new one <sched>.new, the old one <sched>
+            # which should be the same as backup_file_name
+            check.ok_to_drudg = False
+            # Each file is replaced in one step so there's always a complete <sched.skd>. They are
+            # copies (reflinks where possible), not links, so changing one doesn't change the others.
+            new_file_name = "{}.new".format(local_file)
+            copy_replace(local_file, new_file_name)  # cp <sched.skd> <sched.skd.new>
+            copy_replace(backup_file_name, local_file)  # cp <sched.skd.bak.N> <sched.skd>
+            send_warning_new_sched(
+                backup_file_name, local_file, new_file_name, config
+            )
+        else:
+            # Update is forced
+            check.ok_to_drudg = True
+            config.logger.info(
+                "Made a backup of the file to {}".format(backup_file_name)
+            )
+            # if there's a .new file, we don't need it any more
+            new_file_name = "{}.new".format(local_file)
+            if path.exists(new_file_name):
+                os.remove(new_file_name)
+
     if config.update:
         # the --update option was set. This means we force an update to the skd file and drudg
         # if necessary.
         # Do we have the skd file?
-        if got_sched_file:
+        if check.got_sched_file:
             # if there's a .skd.new file, rename it to .skd
-            local_file = "{}/{}.{}".format(config.SchedDir, ses.code, sched_type)
+            local_file = "{}/{}.{}".format(config.SchedDir, ses.code, check.sched_type)
             new_file_name = "{}.new".format(local_file)
             if path.exists(new_file_name):
                 config.logger.info("Making the new schedule file the default")
-                shutil.move(new_file_name, local_file)  # mv <sched.skd.new> <sched.skd>
+                replace(new_file_name, local_file)  # mv <sched.skd.new> <sched.skd>
         # the .skd file is the one to process
-        new = True
-        ok_to_drudg = True
+        check.new = True
+        check.ok_to_drudg = True
 
-    return (got_sched_file, new, sched_type, ok_to_drudg)
+    return (check.got_sched_file, check.new, check.sched_type, check.ok_to_drudg)
 
 
 def send_warning_new_sched(backup_f, current_f, new_f, config):
@@ -543,67 +839,305 @@ def drudg_session(ses, config, got_sched_file, new, sched_type):
     :return: none
     :rtype: none
     """
+    run_drudg_jobs(drudg_jobs(ses, config, got_sched_file, new, sched_type), config)
+
+
+# A drudg run for one station in a session
+DrudgJob = namedtuple("DrudgJob", ["ses", "station", "sched_type"])
+
+
+def drudg_jobs(ses, config, got_sched_file, new, sched_type):
+    """
+    Works out which of our stations in a session need to be drudged
+
+    :param ses: The session to be processed
+    :type ses: Session class
+    :param config: configuration parameters (from the config file)
+    :type config: Config class
+    :param got_sched_file: Did we get a file?
+    :type got_sched_file: boolean
+    :param new: Is it a new file?
+    :type new: boolean
+    :param sched_type: schedule file type (vex or skd)
+    :type sched_type: string
+    :return: the stations to drudg
+    :rtype: list of DrudgJob
+    """
+    update_stns = []
     if not config.DoDrudg:
         logging.info("Drudg will not be run on the schedule file")
+        return []
+
+    if not new:
+        # Checks came back with no new schedule file or no schedule file at all.
+        if not got_sched_file:
+            logging.info("There is no schedule file on the server.")
+        else:
+            logging.info("The local copy of the schedule file hasn't changed.")
+            drg = Drudg(
+                config.DrudgBinary,
+                config.SchedDir,
+                config.ProcDir,
+                sched_type,
+                config.LstDir,
+                config.SnapDir,
+            )
+            # Has the file been drudged?
+            # Look for snp, prc files that are later than the modification time of the schedule file
+            for station in sorted(ses.our_stns_in_exp):
+                drudge_products_up_to_date = drg.check_drudg_output_time(
+                    config.SchedDir, config.SnapDir, config.ProcDir, sched_type, ses.code, station,
+                    config.snapshot,
+                )
+                if not drudge_products_up_to_date:
+                    update_stns.append(station)
     else:
+        # There's a new schedule file
+        update_stns = sorted(ses.our_stns_in_exp)
+    return [DrudgJob(ses, station, sched_type) for station in update_stns]
 
-        update_stns = []
-        drg = Drudg(
-            config.DrudgBinary,
-            config.SchedDir,
-            config.ProcDir,
-            sched_type,
-            config.LstDir,
-            config.SnapDir,
+
+def drudg_station(job, config):
+    """
+    Runs drudg for one station in a session. Drudg is run in its own scratch directory (in SchedDir, so the
+    output files can be renamed into place) so that runs at the same time don't write over each other.
+
+    :param job: the session and station
+    :type job: DrudgJob
+    :param config: configuration parameters (from the config file)
+    :type config: Config class
+    :return: (success, snp file, prc file, lst file)
+    :rtype: tuple
+    """
+    # Nothing can replace the schedule while drudg reads it, and only one drudg runs for each station
+    with config.locks.locked(
+        "{}.sched".format(job.ses.code), shared=True
+    ), config.locks.locked(
+        "{}{}.drudg".format(job.ses.code, job.station)
+    ) as waited:
+        return drudg_station_locked(job, config, waited)
+
+
+def drudg_station_locked(job, config, waited=False):
+    """
+    The body of drudg_station, called with the locks on the schedule and station held
+
+    :param job: the session and station
+    :type job: DrudgJob
+    :param config: configuration parameters (from the config file)
+    :type config: Config class
+    :param waited: Did we have to wait for another fesh2 instance to finish with the station?
+    :type waited: boolean
+    :return: (success, snp file, prc file, lst file)
+    :rtype: tuple
+    """
+    drg = Drudg(
+        config.DrudgBinary,
+        config.SchedDir,
+        config.ProcDir,
+        job.sched_type,
+        config.LstDir,
+        config.SnapDir,
+    )
+    outfiles = [
+        "{}/{}{}.snp".format(config.SnapDir, job.ses.code, job.station),
+        "{}/{}{}.prc".format(config.ProcDir, job.ses.code, job.station),
+        "{}/{}{}.lst".format(config.LstDir, job.ses.code, job.station),
+    ]
+    if waited and drg.check_drudg_output_time(
+        config.SchedDir, config.SnapDir, config.ProcDir, job.sched_type, job.ses.code, job.station
+    ):
+        # the other instance has just drudged the same schedule
+        logging.info(
+            "Drudg output for station {} in {} was made by another fesh2 instance".format(
+                job.station, job.ses.code
+            )
+        )
+        return tuple([True] + outfiles)
+    # If drudg has already been run on a schedule with the same contents, with the same settings, use
+    # the files it made then
+    key = None
+    if config.drudg_cache:
+        sched_file = "{}/{}.{}".format(config.SchedDir, job.ses.code, job.sched_type)
+        key = config.drudg_cache.key(
+            config.manifest.sha256(sched_file), job.station, config
         )
+        if config.drudg_cache.restore(key, outfiles):
+            # same times as a drudg run
+            modtime = os.stat(sched_file).st_mtime
+            for outfile in outfiles:
+                drg.set_file_times_anow(outfile, modtime)
+            logging.info(
+                "Drudg output for station {} in {} was restored from the cache".format(
+                    job.station, job.ses.code
+                )
+            )
+            return tuple([True] + outfiles)
 
-        if not new:
-            # Checks came back with no new schedule file or no schedule file at all.
-            if not got_sched_file:
-                logging.info("There is no schedule file on the server.")
-            else:
-                logging.info("The local copy of the schedule file hasn't changed.")
-                # Has the file been drudged?
-                # Look for snp, prc files that are later than the modification time of the schedule file
-                for station in ses.our_stns_in_exp:
-                    drudge_products_up_to_date = drg.check_drudg_output_time(
-                        config.SchedDir, config.SnapDir, config.ProcDir, sched_type, ses.code, station,
-                    )
-                    if not drudge_products_up_to_date:
-                        update_stns.append(station)
+    work_dir = tempfile.mkdtemp(
+        prefix=".drudg-{}{}-".format(job.ses.code, job.station), dir=config.SchedDir
+    )
+    try:
+        result = drg.godrudg(job.station, job.ses.code, config, work_dir)
+    except Exception as e:
+        logging.error(
+            "Drudg failed for station {} in {}: {}".format(job.station, job.ses.code, e)
+        )
+        return (False, None, None, None)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if result[0] and key:
+        config.drudg_cache.store(key, result[1:])
+    return result
+
+
+def run_drudg_jobs(jobs, config):
+    """
+    Runs drudg for a list of stations and sessions, up to DrudgWorkers at a time. The results are
+    reported together once they have all finished.
+
+    :param jobs: the stations and sessions to drudg
+    :type jobs: list of DrudgJob
+    :param config: configuration parameters (from the config file)
+    :type config: Config class
+    :return: (success, snp file, prc file, lst file) for each job
+    :rtype: list of tuples
+    """
+    if not jobs:
+        return []
+    if config.drudg_cache:
+        config.drudg_cache.prune()
+    # Each job drives its own drudg process, so threads are enough to run them in parallel
+    with ThreadPoolExecutor(max_workers=config.DrudgWorkers) as pool:
+        results = list(pool.map(partial(drudg_station, config=config), jobs))
+    failed = 0
+    for (job, (success, o1, o2, o3)) in zip(jobs, results):
+        if success:
+            logging.info(
+                "Drudg created the following files: {} {} {}".format(o1, o2, o3)
+            )
         else:
-            # There's a new schedule file
-            for i in ses.our_stns_in_exp:
-                update_stns.append(i)
-        if update_stns:
-            # Run drudg
-            # print("Run drudg for these stations: {}".format(update_stns))
-            for s in update_stns:
-                (success, o1, o2, o3) = drg.godrudg(s, ses.code, config)
-                if success:
-                    logging.info(
-                        "Drudg created the following files: {} {} {}".format(o1, o2, o3)
-                    )
-                else:
-                    logging.error(
-                        "Drudg failed for station {}. Run drudg manually to search for the "
-                        "problem.".format(s)
-                    )
+            failed += 1
+            logging.error(
+                "Drudg failed for station {} in {}. Run drudg manually to search for the "
+                "problem.".format(job.station, job.ses.code)
+            )
+    logging.info(
+        "Drudg output for {} stations: {} succeeded, {} failed".format(
+            len(jobs), len(jobs) - failed, failed
+        )
+    )
+    return results
 
 
-def show_summary(config, mstrs, sessions_to_process):
+def build_status(config, mstrs, sessions, outcomes, last_check, servers, now_s=None):
     """
-    Prints a summary of the status of session processing ro the screen
+    Collects the state of the master files, schedules and FS files for the sessions into a dictionary that
+    can be written to the status file (as JSON) and used to print the summary. It contains only strings,
+    numbers, booleans, lists and dictionaries.
+
     :param config: configuration parameters (from the config file)
     :type config: Config class
     :param mstrs: list of master file names (full path)
     :type mstrs: array of strings
-    :param sessions_to_process: List of sessions to process
-    :type sessions_to_process: Session class
+    :param sessions: the sessions to report on
+    :type sessions: list of Session class
+    :param outcomes: what happened to each session in this check, keyed by session code
+    :type outcomes: dictionary
+    :param last_check: time of the last completed schedule check (time.time() value) or None
+    :type last_check: float
+    :param servers: timings of the last transfer from each server, keyed by server URL
+    :type servers: dictionary
+    :param now_s: the time of the status (time.time() value, default is now)
+    :type now_s: float
+    :return: the status
+    :rtype: OrderedDict
+    """
+    if now_s is None:
+        now_s = time.time()
+    # all the files are looked up in one read of each directory
+    snapshot = config.snapshot or DirSnapshot()
+
+    status = OrderedDict()
+    status["stations"] = list(config.Stations)
+    status["time"] = now_s
+    status["time_utc"] = utc_text(now_s)
+    status["last_check"] = last_check
+    status["last_check_utc"] = utc_text(last_check)
+
+    # the version of a master file is the time of the latest version downloaded
+    status["masters"] = []
+    for m in mstrs:
+        mtime = snapshot.mtime(m)
+        status["masters"].append(
+            OrderedDict(
+                [
+                    ("file", m),
+                    ("intensive", "int" in m),
+                    ("version", mtime),
+                    ("version_utc", utc_text(mtime)),
+                ]
+            )
+        )
+
+    status["sessions"] = []
+    for ses in sessions:
+        entry = OrderedDict()
+        entry["code"] = ses.code
+        entry["start"] = ses.start.strftime("%Y-%m-%d %H:%M:%S")
+        entry["end"] = ses.end.strftime("%Y-%m-%d %H:%M:%S")
+        entry["stations"] = sorted(ses.stations)
+        entry["our_stations"] = sorted(ses.our_stns_in_exp)
+        # the schedule file and a new version waiting to be drudged
+        sched_file = None
+        new_sched = False
+        for ext in ("skd", "vex"):
+            local_file = "{}/{}.{}".format(config.SchedDir, ses.code, ext)
+            if snapshot.exists(local_file):
+                sched_file = local_file
+            if snapshot.exists("{}.new".format(local_file)):
+                new_sched = True
+        entry["sched_file"] = sched_file
+        entry["sched_version"] = snapshot.mtime(sched_file) if sched_file else None
+        entry["sched_version_utc"] = utc_text(entry["sched_version"])
+        entry["new_sched"] = new_sched
+        # what happened in this check (None if the session wasn't checked)
+        entry["check"] = outcomes.get(ses.code)
+        # the FS files for each of our stations
+        products = OrderedDict()
+        for stn in config.Stations:
+            snp = snapshot.exists("{}/{}{}.snp".format(config.SchedDir, ses.code, stn))
+            prc = snapshot.exists("{}/{}{}.prc".format(config.ProcDir, ses.code, stn))
+            lst = snapshot.exists("{}/{}{}.lst".format(config.LstDir, ses.code, stn))
+            products[stn] = OrderedDict(
+                [
+                    ("in_session", stn in ses.our_stns_in_exp),
+                    ("snp", snp),
+                    ("prc", prc),
+                    ("lst", lst),
+                    ("prepared", snp and prc and lst),
+                ]
+            )
+        entry["products"] = products
+        status["sessions"].append(entry)
+
+    status["servers"] = servers
+    return status
+
+
+def show_summary(config, status):
+    """
+    Prints a summary of the status of session processing ro the screen
+    :param config: configuration parameters (from the config file)
+    :type config: Config class
+    :param status: the status, from build_status
+    :type status: dictionary
     :return: none
     :rtype: none
     """
     append_reprocess_note = False
+    masters = status["masters"]
+    sessions = status["sessions"]
 
     config.logger.info("--------------------------------------------------------------")
     config.logger.info(
@@ -612,7 +1146,7 @@ def show_summary(config, mstrs, sessions_to_process):
         + "Schedule Status for {}:".format(", ".join(sorted(config.Stations)))
         + Colour.END
     )
-    if len(mstrs) > 1:
+    if len(masters) > 1:
         config.logger.info(
             Colour.UNDERLINE
             + "Master file versions (UTC of latest version downloaded):"
@@ -624,16 +1158,29 @@ def show_summary(config, mstrs, sessions_to_process):
             + "Master file version (UTC of latest version downloaded):"
             + Colour.END
         )
-    for m in mstrs:
-        stinfo = os.stat(m)
-        tvers_txt = time.strftime("%Y-%m-%d %H:%M", time.gmtime(stinfo.st_mtime))
-        if "int" in m:
+    for m in masters:
+        tvers_txt = time.strftime("%Y-%m-%d %H:%M", time.gmtime(m["version"]))
+        if m["intensive"]:
             config.logger.info("\tIntensive sessions: {}".format(tvers_txt))
         else:
             config.logger.info("\t24h sessions:       {}".format(tvers_txt))
     config.logger.info("")
+    # servers that are being left out after failing
+    skipped = [
+        (url, server)
+        for (url, server) in sorted(status["servers"].items())
+        if (server.get("skipped_until") or 0) > status["time"]
+    ]
+    for (url, server) in skipped:
+        config.logger.info(
+            "Not using {} until {} UT. It has failed {} times in a row.".format(
+                url, server["skipped_until_utc"][:16], server["failures"]
+            )
+        )
+    if skipped:
+        config.logger.info("")
     config.logger.info(Colour.UNDERLINE + "Sessions:" + Colour.END)
-    if not sessions_to_process:
+    if not sessions:
         config.logger.info("\tNo sessions to process")
     else:
         if len(config.Stations) > 1:
@@ -658,63 +1205,35 @@ def show_summary(config, mstrs, sessions_to_process):
             config.logger.info(
                 "-------   ----------------   ---------   -----  ---------"
             )
-        for ses in sessions_to_process:
+        for ses in sessions:
             txt = ""
-            got_sched = False
-            got_sched_new = False
-            for ext in ("skd", "vex"):
-                local_file = "{}/{}.{}".format(config.SchedDir, ses.code, ext)
-                if path.exists(local_file):
-                    got_sched = True
-                    stinfo = os.stat(local_file)
-                local_file_new = "{}.new".format(local_file)
-                if path.exists(local_file_new):
-                    got_sched_new = True
-
+            got_sched = ses["sched_file"] is not None
             got_sched_txt = yn(got_sched)
-            if got_sched_new:
+            if ses["new_sched"]:
                 got_sched_txt = "{} **".format(got_sched_txt)
                 append_reprocess_note = True
             txt = "{}{:<7s}   {:<16s}   {:<9s}".format(
-                txt, ses.code, ses.start.strftime("%Y-%m-%d %H:%M"), got_sched_txt
+                txt, ses["code"], ses["start"][:16], got_sched_txt
             )
             if got_sched:
                 txt = "{}   {:<5d}  ".format(
-                    txt, int((time.time() - stinfo.st_mtime) / 60.0 / 60.0)
+                    txt, int((status["time"] - ses["sched_version"]) / 60.0 / 60.0)
                 )
             else:
                 txt = "{}          ".format(txt)
 
+            products = ses["products"]
             if len(config.Stations) > 1:
-                got_snp = {}
-                got_prc = {}
-                got_lst = {}
                 for i in config.Stations:
-                    if i in ses.our_stns_in_exp:
-                        got_snp[i] = path.exists(
-                            "{}/{}{}.snp".format(config.SchedDir, ses.code, i)
-                        )
-                        got_prc[i] = path.exists(
-                            "{}/{}{}.prc".format(config.ProcDir, ses.code, i)
-                        )
-                        got_lst[i] = path.exists(
-                            "{}/{}{}.lst".format(config.LstDir, ses.code, i)
-                        )
-                        tmp_txt = "{}".format(
-                            yn(got_snp[i] and got_prc[i] and got_lst[i])
-                        )
+                    if products[i]["in_session"]:
+                        tmp_txt = "{}".format(yn(products[i]["prepared"]))
                     else:
                         tmp_txt = "-"
                     txt = "{}{:<7s}".format(txt, tmp_txt)
                 config.logger.info(txt)
             else:
                 i = config.Stations[0]
-                got_snp = path.exists(
-                    "{}/{}{}.snp".format(config.SchedDir, ses.code, i)
-                )
-                got_prc = path.exists("{}/{}{}.prc".format(config.ProcDir, ses.code, i))
-                got_lst = path.exists("{}/{}{}.lst".format(config.LstDir, ses.code, i))
-                txt = "{}{}".format(txt, yn(got_snp and got_prc and got_lst))
+                txt = "{}{}".format(txt, yn(products[i]["prepared"]))
                 config.logger.info(txt)
 
         config.logger.info("")
@@ -780,23 +1299,17 @@ def read_master(files, year, stations):
     :rtype: an array of sessions from the Session class (see MasterSession.py)
     """
 
-    # make the list of stations a set
-    stns = set(stations)
+    # our stations as a bitmask
+    our_mask = station_mask(stations)
     # this will contain a list of sessions
     sessions_queue_ses = []
-    now = datetime.utcnow()
     for file in files:
-        # read each master file in turn
-        with open(file, mode="r") as fd:
-            for line in fd.readlines():
-                if line.startswith("|"):
-                    # line starts with a |, so it's a session
-                    # read it:
-                    ses = Session(line, year)
-                    # if any of our selected stations is in the session, tag it in ses.our_stns_in_exp
-                    ses.our_stns_in_exp = stns.intersection(ses.stations)
-                    # add the sesion to the list
-                    sessions_queue_ses.append(ses)
+        # read each master file in turn. They're only parsed if they have changed
+        for ses in load_master(file, year):
+            # if any of our selected stations is in the session, tag it in ses.our_stns_in_exp
+            ses.our_stns_in_exp = mask_stations(ses.station_mask & our_mask)
+            # add the sesion to the list
+            sessions_queue_ses.append(ses)
     # sort the sessions by start time
     lis = sorted(sessions_queue_ses, key=lambda i: i.start)
     return lis
@@ -1090,6 +1603,32 @@ class Args:
             required=True,
         )
 
+        self.parser.add_argument(
+            "--DrudgDriver",
+            default="batch",
+            choices=["batch", "pexpect"],
+            help="How to run drudg: 'batch' sends all the answers to drudg at once and checks its output "
+            "afterwards, falling back to 'pexpect' (answer each prompt as it comes) if that fails (default = "
+            "batch)",
+        )
+
+        self.parser.add_argument(
+            "--DrudgCache",
+            type=self.str2bool,
+            const=True,
+            default=True,
+            nargs='?',
+            help="Keep copies of the files made by drudg and use them instead of running drudg again on a "
+            "schedule with the same contents and settings (default = True)",
+        )
+
+        self.parser.add_argument(
+            "--DrudgWorkers",
+            type=int,
+            default=4,
+            help="The maximum number of drudg runs at the same time (default = 4)",
+        )
+
         self.parser.add_argument(
             "--TpiPeriod",
             default=items["misc.tpicd"],
@@ -1155,6 +1694,75 @@ class Args:
             "False)",
         )
 
+        self.parser.add_argument(
+            "--ProbeServers",
+            type=self.str2bool,
+            const=True,
+            default=True,
+            nargs='?',
+            help="Ask the servers for the time and size of a file before downloading it, and only download it if it "
+            "has changed (default = True)",
+        )
+
+        self.parser.add_argument(
+            "--WatchFiles",
+            type=self.str2bool,
+            const=True,
+            default=True,
+            nargs='?',
+            help="Watch the schedule, procedure, SNAP and LST directories and run drudg straight away when "
+            "files are changed by someone else (default = True)",
+        )
+
+        self.parser.add_argument(
+            "--ControlSocket",
+            default="",
+            help="The Unix socket a running fesh2 listens on for status requests and commands. Set it to none "
+            "to turn it off (default = .fesh2.sock in SchedDir)",
+        )
+
+        self.parser.add_argument(
+            "--BackupKeep",
+            type=int,
+            default=10,
+            help="The number of backups (<file>.bak.N) to keep of each schedule file. Older ones are removed. "
+            "0 keeps them all (default = 10)",
+        )
+
+        self.parser.add_argument(
+            "--SharedCache",
+            type=self.str2bool,
+            const=True,
+            default=False,
+            nargs='?',
+            help="Share the master and schedule files fetched from the servers with other fesh2 instances, so "
+            "each file is only fetched once per check interval. Needs SharedCacheDir (default = False)",
+        )
+
+        self.parser.add_argument(
+            "--SharedCacheDir",
+            default="",
+            help="The directory for the files shared with other fesh2 instances. It should be outside SchedDir, "
+            "which has its own copies of the files",
+        )
+
+        self.parser.add_argument(
+            "--ServerHealth",
+            type=self.str2bool,
+            const=True,
+            default=True,
+            nargs='?',
+            help="Try the servers that have been answering quickly and reliably first, and leave out servers "
+            "that keep failing for a while (default = True)",
+        )
+
+        self.parser.add_argument(
+            "--MaxDownloads",
+            type=int,
+            default=4,
+            help="The maximum number of schedule files to download from the servers at the same time (default = 4)",
+        )
+
         # self.parser.add_argument('-p', '--tpi-period', default=None, type=int, help="TPI period in centiseconds (0
         # = don't use the TPI Daemon, default). This can be set in the config file.")
 
@@ -1174,6 +1782,22 @@ class Args:
                  "last queried.",
         )
 
+        self.parser.add_argument(
+            "--control",
+            choices=["check", "force", "reload"],
+            default=None,
+            help="Send a command to the running fesh2 and exit: 'check' checks for new files now, 'force' downloads "
+                 "the schedules for the sessions given with -g and 'reload' reads the config file again",
+        )
+
+        self.parser.add_argument(
+            "--format",
+            choices=["text", "json"],
+            default="text",
+            help="The format of the status shown by --check. 'json' writes the status to standard output as a "
+                 "JSON object instead of the summary table (default = text)",
+        )
+
         self.parser.add_argument(
             "-q",
             "--quiet",
@@ -1222,273 +1846,225 @@ def get_default(items, key, default):
             return default
 
 
-def start_thread_main(event, config):
+def signal_handler(scheduler, sig, frame):
+    # see https://stackoverflow.com/questions/1112343/how-do-i-capture-sigint-in-python
+    logging.warning("Interrupt sent. Will end threads and exit.")
+    if scheduler:
+        # main() waits for the scheduler to stop and then exits
+        logging.warning("Waiting for any schedule check underway to finish...")
+        scheduler.stop()
+    else:
+        logging.warning("Exiting.")
+        sys.exit(0)
+
+
+def setup_state(config):
     """
-    Set up and start the wait_for_event thread 'sched_check' which does a schedule check when triggered
-    by the 'timing_loop' thread
+    Creates the long-lived objects that main_task uses between checks and keeps them in the config
 
-    :param event: When this event is set, a schedule check loop is done or underway
-    :type event: threading event
     :param config: configuration parameters (from the config file)
     :type config: Config class
-    :return: activated thread
-    :rtype: a python threading thread.
     """
-    thread = threading.Thread(
-        name="sched_check", target=wait_for_event, args=(event, config)
+    # How well the servers have been doing, so the best are used first and failing ones are left out
+    config.server_health = None
+    if config.ServerHealth:
+        config.server_health = ServerHealth(config.SchedDir)
+    # Curl handles are kept open between checks so connections to the servers can be reused. Open
+    # connections can only be shared if checks aren't run in parallel.
+    config.curl_pool = SchedServer.CurlPool(
+        config.MaxDownloads, config.server_health, config.MaxDownloads == 1
     )
-    thread.start()
-    return thread
-
-
-def start_thread_timing_loop(event_1, event_2, thread, config):
+    # Hashes of the files we have, to check if downloads are really new
+    config.manifest = Manifest(config.SchedDir)
+    # When files were last checked on the servers
+    config.check_state = CheckState(config.SchedDir)
+    # Locks on the files, shared with other fesh2 instances
+    config.locks = FileLocks("{}/.fesh2-locks".format(config.SchedDir))
+    # Files fetched from the servers, shared with other fesh2 instances. Reset first in case a reload has
+    # turned it off.
+    config.shared_cache = None
+    if config.SharedCache:
+        config.shared_cache = SharedCache(config.SharedCacheDir)
+    # Backups of schedule files that are replaced
+    config.backups = BackupFile(config.SchedDir, config.BackupKeep, config.manifest)
+    # Files made by drudg, so it doesn't have to be run again on the same schedule
+    config.drudg_cache = None
+    if config.DrudgCache:
+        config.drudg_cache = DrudgCache(config.SchedDir)
+    # The prompts drudg gives, so the batch driver can answer them in advance
+    config.drudg_profiles = DrudgProfiles(config.SchedDir)
+
+
+def close_state(config):
     """
-    This thread manages the main_task wait loop. It waits a specified time (the shortest out of the master and schedule file
-    check wait times) then triggers a check.
+    Closes the objects created by setup_state
 
-    :param event_1: When this event is set, a schedule check loop is done or underway
-    :type event_1: threading event
-    :param event_2: When this event is set, the event loop is exited
-    :type event_2: threading event
-    :param thread: the sched_check thread
-    :type thread: a python threading thread
     :param config: configuration parameters (from the config file)
     :type config: Config class
-    :return: activated thread
-    :rtype: a python threading thread.
     """
-    thread_2 = threading.Thread(
-        name="timing_loop",
-        target=set_event_loop,
-        args=(event_1, event_2, thread, config),
-    )
-    thread_2.start()
-    return thread_2
+    config.curl_pool.close()
+    config.manifest.close()
+    config.check_state.close()
+    config.backups.close()
+    config.drudg_profiles.close()
+    if config.server_health:
+        config.server_health.close()
 
 
-def wait_for_event(event, config):
+def read_config():
     """
-    Waits for the event to be triggerered, then does a schedule check.
-    :param event: When this event is set, a schedule check loop is done or underway
-    :type event: threading event
-    :param config: configuration parameters (from the config file)
-    :type config: Config class
-    """
-    config.logger.debug("WFE: wait for event")
-    event_is_set = event.wait()
-    config.logger.debug("WFE event set: {}".format(event_is_set))
-    # run the main task
-    main_task(config)
+    Reads command line arguments, config from the config file and env variables
 
-    config.logger.debug("WFE: clearing event1...")
-    event.clear()
+    :return: the configuration
+    :rtype: Config class
+    """
+    # --------------------------------------------------------------------------
+    # Read command-line arguments, config from the config file and env variables
+    config_in = Args(default_config_files)
+    # --------------------------------------------------------------------------
+    # Create a configuration instance and add the parameters from above
+    # Config instance
+    cnf = Config()
+    # Load in the config
+    cnf.load(config_in)
+    # check the config makes sense
+    cnf.check_config()
+    return cnf
 
 
-def set_event_loop(event_1, event_2, thread, config):
+def reload_config(new_cnf, config):
     """
-    Waits a specified time (the shortest out of the master and schedule file
-    check wait times) then triggers a schedule check in the other thread.
+    Replaces the settings in the running configuration with those in a newly read one. Called by the
+    sched_check thread between checks.
 
-    :param event_1: When this event is set, a schedule check loop is done or underway
-    :type event_1: threading event
-    :param event_2: When this event is set, the event loop is exited
-    :type event_2: threading event
-    :param thread: the sched_check thread
-    :type thread: a python threading thread
-    :param config: configuration parameters (from the config file)
+    :param new_cnf: the new configuration, from read_config
+    :type new_cnf: Config class
+    :param config: the running configuration
     :type config: Config class
     """
-    while not event_2.isSet():
-        # get time to wait until next check from the smallest check interval. Add 30 sec just to make sure we don't
-        # under-shoot
-        t_wait_h = min([config.ScheduleCheckTime, config.MasterCheckTime])
-        t_wait_s = (t_wait_h * 60 * 60) + 30
-        start_time = time.time()
-        target_time = start_time + t_wait_s
-        barLength = 36
-        test = time.time() >= target_time or event_2.isSet()
-        # logging.debug(
-        #     "set_event_loop top of wait loop. time.time() = {}, target_time = {}, event2.isSet() = {}, test = {}".format(start_time,target_time,event2.isSet(),test))
-        nwaits = 0
-        while not test:
-            time.sleep(2)
-            nwaits += 1
-            dt = time.time() - start_time
-            if dt < 0:
-                dt = 0.0
-            frac = dt / t_wait_s
-            block = int(round(barLength * frac))
-
-            if not config.quiet:
-                text = "\rNext check in {} [{}]".format(
-                    time.strftime("%H:%M:%S", time.gmtime(t_wait_s - dt)),
-                    "=" * block + " " * (barLength - block),
-                )
-                sys.stdout.write(text)
-                sys.stdout.flush()
-            elif nwaits % 15 == 0:
-                logging.info(
-                    "Next check in {}".format(
-                        time.strftime("%H:%M:%S", time.gmtime(t_wait_s - dt))
-                    )
-                )
-            test_time = time.time()
-            test = test_time >= target_time or event_2.isSet()
-            # logging.debug(
-            #     "set_event_loop bottom of wait loop. time.time() = {}, target_time = {}, event2.isSet() = {}, test = {}".format(start_time,target_time,event2.isSet(),test))
-        if not config.quiet:
-            print("")
-        if event_1.isSet():
-            # the check routine is still running, don't tell it to start again
-            logging.warning(
-                "set_event_loop: not signaling another schedule check as the previous one is still running. "
-            )
-        else:
-            if not event_2.isSet():
-                # if we want to exit, don't trigger a schedule check
-                logging.debug("set_event_loop setting event")
-                event_1.set()
-                logging.debug("set_event_loop: wait for thread to finish")
-                thread.join()
-                logging.debug("set_event_loop: thread finished")
-                logging.debug("set_event_loop: starting thread1")
-                thread = start_thread_main(event_1, config)
-                logging.debug("set_event_loop: thread started")
-    logging.debug("Event 2 is set")
-
-
-def signal_handler(event, thread, sig, frame):
-    # see https://stackoverflow.com/questions/1112343/how-do-i-capture-sigint-in-python
-    logging.warning("Interrupt sent. Will end threads and exit.")
-    if thread:
-        event.set()
-        logging.warning("Waiting for up to 10 sec for the main thread to finish...")
-        thread.join()
-        if thread.is_alive():
-            logging.warning("Thread is still alive. Exiting anyway.")
-        else:
-            logging.warning("Thread terminated.")
-    logging.warning("Exiting.")
-    sys.exit(0)
+    close_state(config)
+    config.update_from(new_cnf)
+    # the directories may have changed
+    setup_state(config)
+    logging.info(
+        "The configuration has been reloaded. Changes to LogDir, WatchFiles and ControlSocket need a restart."
+    )
 
 
-class BackupFile:
-    """ Manage backup file naming, creation, removal etc.
+def control_request(config, scheduler, request):
     """
+    Handles a request from the control socket. The commands are:
 
-    from shutil import copyfile
+        status: the status after the last check, and what the sched_check thread is doing
+        check: do a check now
+        force: download the schedules for the sessions given in "sessions" (a list of codes) now
+        reload: read the config file again
 
-    def __init__(self):
-        # file extension
-        self.suffix = "bak"
+    :param config: configuration parameters (from the config file)
+    :type config: Config class
+    :param scheduler: runs the checks
+    :type scheduler: CheckScheduler class
+    :param request: the request, with the command in "command"
+    :type request: dictionary
+    :return: the response, with "ok" set to True if the request was accepted, otherwise an "error" message
+    :rtype: dictionary
+    """
+    command = request.get("command")
+    logging.debug("Control request: {}".format(command))
+    if command == "status":
+        return {"ok": True, "status": config.status, "scheduler": scheduler.state()}
+    elif command == "check":
+        logging.info("A check was requested through the control socket")
+        scheduler.trigger()
+        return {"ok": True}
+    elif command == "force":
+        codes = request.get("sessions")
+        if not codes or not isinstance(codes, list):
+            return {"ok": False, "error": "Give the session codes in 'sessions'"}
+        codes = set(str(code).strip().lower() for code in codes)
+        logging.info(
+            "Schedule downloads for {} were requested through the control socket".format(
+                ", ".join(sorted(codes))
+            )
+        )
+        scheduler.force(codes)
+        return {"ok": True}
+    elif command == "reload":
+        # read it here so errors go back to the client
+        try:
+            new_cnf = read_config()
+        except SystemExit:
+            return {"ok": False, "error": "The command line arguments or config file are not valid"}
+        except Exception as e:
+            return {"ok": False, "error": "The config file is not valid: {}".format(e)}
+        scheduler.reconfigure(partial(reload_config, new_cnf))
+        return {"ok": True}
+    else:
+        return {"ok": False, "error": "Unknown command '{}'".format(command)}
 
-    def backup_file_name(self, name, version):
-        """ Given a file name and a versio, return the name of
-        the corresponding backup file
-        :param name: file name
-        :type name: string
-        :param version:
-        :type version: int
-        :return: filename
-        :rtype: string
-        """
-        return "{}.{}.{}".format(name, self.suffix, version)
 
-    def backup_file(self, filename):
-        """ Make a copy of the file and give it a suffix plus version number
+def send_control_command(cnf):
+    """
+    Sends the command given with --control to the running fesh2
 
-        :param filename: Full path to the file
-        :type filename: string
-        :return: New file name or '' if unsuccessful
-        :rtype: bool
-        """
-        from shutil import copy2
+    :param cnf: configuration parameters (from the config file)
+    :type cnf: Config class
+    """
+    request = {"command": cnf.control}
+    if cnf.control == "force":
+        if not cnf.g:
+            raise Exception("Give the sessions to download with -g")
+        request["sessions"] = re.split(r"[\s,]+", cnf.g.strip())
+    if not cnf.ControlSocket:
+        raise Exception("No ControlSocket is set in the config file")
+    response = send_request(cnf.ControlSocket, request)
+    if response is None:
+        raise Exception(
+            "No fesh2 is listening on {}. Is it running?".format(cnf.ControlSocket)
+        )
+    if not response.get("ok"):
+        raise Exception("fesh2 refused the command: {}".format(response.get("error")))
+    cnf.logger.info("The '{}' command was sent to fesh2".format(cnf.control))
 
-        if not path.exists(filename):
-            msg = "File to be backed up was not found: {}".format(filename)
-            logging.error(msg)
-            raise Exception(msg)
-            return ""
-
-        # get a list of files that have the backup file extension, find the highest version number
-        version_number = 1
-        highest_version = 0
-        test_file = self.backup_file_name(filename, version_number)
-        while path.exists(test_file):
-            highest_version = version_number
-            version_number += 1
-            test_file = self.backup_file_name(filename, version_number)
-
-        newfile = self.backup_file_name(filename, highest_version + 1)
-        copy2(filename, newfile)
-        if not path.exists(newfile):
-            msg = "Attempt to backup a file failed. Backup file not created. {}".format(
-                filename
-            )
-            logging.error(msg)
-            raise Exception(msg)
-            return ""
-        else:
-            return newfile
-
-
-class Locker:
-    """ Manage the lock file which prevents multiple instances of fesh2 from downloading
-    or processing logs at the same time
-    """
-
-    def __init__(self):
-        # location of the lock file
-        self.lock_file = "/tmp/fesh2.lock"
-        self.lock_fh = open(self.lock_file, "w+")
-        # change permissions so anyone can read/write
-        os.chmod(self.lock_file, 0o0666)
-
-    def lock(self):
-        # Attempt to lock out the file. Wait indefinitely?
-        # wait time in sec
-        wait_time = 10
-        logging.debug("Attempting to lock the lock file")
-        while True:
-            try:
-                fcntl.flock(self.lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                break
-            except IOError as e:
-                if e.errno != errno.EAGAIN:
-                    raise
-                else:
-                    logging.warning(
-                        "Another instance of fesh2 is accessing schedule files. Waiting for it to complete. "
-                        "Will check again in {} sec".format(wait_time)
-                    )
-                    time.sleep(wait_time)
 
-    def unlock(self):
-        # Unlock the file so other fesh2 processes can manipulate schedule files etc
-        logging.debug("Unlocking the lock file")
-        fcntl.flock(self.lock_fh, fcntl.LOCK_UN)
+def show_daemon_status(cnf):
+    """
+    Shows the status of a running fesh2 instance, if there is one with the same stations listening on the
+    control socket
 
-    def close(self):
-        self.lock_fh.close()
+    :param cnf: configuration parameters (from the config file)
+    :type cnf: Config class
+    :return: True if the status was shown
+    :rtype: boolean
+    """
+    if not cnf.ControlSocket or not path.exists(cnf.ControlSocket):
+        return False
+    response = send_request(cnf.ControlSocket, {"command": "status"})
+    if not response or not response.get("ok") or not response.get("status"):
+        return False
+    status = response["status"]
+    if sorted(status["stations"]) != sorted(cnf.Stations):
+        # it's looking after other stations
+        return False
+    if cnf.format == "json":
+        status["scheduler"] = response.get("scheduler")
+        print(json.dumps(status, indent=1))
+    else:
+        show_summary(cnf, status)
+        scheduler = response.get("scheduler")
+        if scheduler:
+            cnf.logger.info("The next check is at {} UT".format(scheduler["next_check_utc"]))
+    log_last_check(status.get("last_check"))
+    return True
 
 
 def main():
     """
     Reads command line arguments and the config file, starts logging, does an initial schedule
-    check and then starts the two threads that manage the main_task loop to periodically check for
-    schedule files and process them with Drudg 
+    check and then starts the thread that runs main_task whenever the master or schedule files are due for
+    a check
     """
-    # --------------------------------------------------------------------------
-    # Read command-line arguments, config from the config file and env variables
-    config_in = Args(default_config_files)
-    # --------------------------------------------------------------------------
-    # Create a configuration instance and add the parameters from above
-    # Config instance
-    cnf = Config()
-    # Load in the config
-    cnf.load(config_in)
-    # check the config makes sense
-    cnf.check_config()
+    cnf = read_config()
     # --------------------------------------------------------------------------
     # Set up logging
     log_file_str = "{}/{}".format(cnf.LogDir, log_filename)
@@ -1511,31 +2087,65 @@ def main():
         ch.setLevel(logging.DEBUG)
         ch.setFormatter(logging.Formatter(format_txt_short))
         cnf.logger.addHandler(ch)
-        print("Writing to log file {}.".format(log_file_str))
+        if not (cnf.check and cnf.format == "json"):
+            # standard output is just the status in JSON mode
+            print("Writing to log file {}.".format(log_file_str))
 
     # What to do if someone generates a keyboard interrupt
-    signal.signal(signal.SIGINT, partial(signal_handler, None, None))
-    signal.signal(signal.SIGHUP, partial(signal_handler, None, None))
+    signal.signal(signal.SIGINT, partial(signal_handler, None))
+    signal.signal(signal.SIGHUP, partial(signal_handler, None))
+
+    if cnf.control:
+        send_control_command(cnf)
+        logging.shutdown()
+        return
+
+    if cnf.check:
+        # A running fesh2 can tell us its status without all the work. Otherwise the status comes from the
+        # local files. Nothing is changed, so the state kept in the schedule directory isn't set up (the user
+        # may not be able to write there).
+        if not show_daemon_status(cnf):
+            main_task(cnf)
+        logging.shutdown()
+        return
+
+    setup_state(cnf)
 
     # run an initial update
-    main_task(cnf)
+    sessions = main_task(cnf)
 
     # Finish here if we are running in a one-pass only mode
     if (not cnf.run_once) and (not cnf.check):
-        # Set up threading
-        event1 = threading.Event()
-        event2 = threading.Event()
-        # Thread1 waits for event1 to set, then runs the schedule check
-        thread1 = start_thread_main(event1, cnf)
-        # event1.set()
-        # Thread2 runs a timing loop to set event2 every (specified) minutes
-        # If event2 is set then thread2 should quit
-        thread2 = start_thread_timing_loop(event1, event2, thread1, cnf)
-        # Set up so that keyboard interrupts will result in threads being terminated now
-        signal.signal(signal.SIGINT, partial(signal_handler, event2, thread2))
-        signal.signal(signal.SIGHUP, partial(signal_handler, event2, thread2))
-
-    #        signal.signal(signal.SIGINT, partial(signal_handler, event2, thread2))
+        # The sched_check thread does a check whenever a file is due
+        scheduler = CheckScheduler(cnf, main_task, process_local_changes)
+        if cnf.WatchFiles:
+            # React to files changed by operators or other fesh2 instances
+            scheduler.watcher = FileWatcher(
+                [cnf.SchedDir, cnf.ProcDir, cnf.SnapDir, cnf.LstDir], scheduler.changed
+            )
+            scheduler.watcher.start()
+            cnf.file_watcher = scheduler.watcher
+        # Status requests and commands from other processes
+        control = None
+        if cnf.ControlSocket:
+            control = ControlServer(
+                cnf.ControlSocket, partial(control_request, cnf, scheduler)
+            )
+            if not control.start():
+                control = None
+        # Set up so that keyboard interrupts will stop the thread now
+        signal.signal(signal.SIGINT, partial(signal_handler, scheduler))
+        signal.signal(signal.SIGHUP, partial(signal_handler, scheduler))
+        scheduler.start(sessions)
+        scheduler.join()
+        if scheduler.watcher:
+            cnf.file_watcher = None
+            scheduler.watcher.stop()
+        if control:
+            control.stop()
+        logging.warning("Thread terminated. Exiting.")
+    close_state(cnf)
+
     logging.shutdown()
 
 
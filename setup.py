@@ -19,7 +19,8 @@ if sys.version_info.major == 2:
         "pexpect >= 4.7.0",
         "pycurl >=7.43.0.2",
         "configparser >= 4.0.0",
-        "configargparse>=1.2.3"
+        "configargparse>=1.2.3",
+        "futures >= 3.0.0"
     ]
 else:
     install_requires = [
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""DrudgCache: what invalidates a cached drudg run, and storing and restoring the files"""
+import os
+
+import pytest
+
+from fesh2.Drudgery import DrudgCache
+
+
+class Conf:
+    TpiPeriod = 0
+    ContCalAction = "off"
+    ContCalPolarity = "none"
+    VsiAlign = "none"
+
+    def __init__(self, drudg):
+        self.DrudgBinary = drudg
+
+
+def write(filename, text):
+    with open(filename, "w") as fh:
+        fh.write(text)
+
+
+@pytest.fixture
+def cache(tmpdir, monkeypatch):
+    # hashes are kept between instances, keyed by file name, size and time
+    monkeypatch.setattr(DrudgCache, "file_hashes", {})
+    control = tmpdir.mkdir("control")
+    write(str(control.join("skedf.ctl")), "$misc\n tpicd no 0\n")
+    write(str(control.join("equip.ctl")), "dbbc_ddc/fila10g\nmark5b\n")
+    cache = DrudgCache(str(tmpdir))
+    cache.control_files = [str(control.join("skedf.ctl")), str(control.join("equip.ctl"))]
+    return cache
+
+
+@pytest.fixture
+def conf(tmpdir):
+    drudg = str(tmpdir.join("drudg"))
+    write(drudg, "drudg 1")
+    return Conf(drudg)
+
+
+def test_same_key(cache, conf, tmpdir, monkeypatch):
+    key = cache.key("abc", "hb", conf)
+    assert cache.key("abc", "hb", conf) == key
+    # e.g. in another fesh2 instance
+    monkeypatch.setattr(DrudgCache, "file_hashes", {})
+    other = DrudgCache(str(tmpdir))
+    other.control_files = cache.control_files
+    assert other.key("abc", "hb", conf) == key
+
+
+def test_key_inputs(cache, conf):
+    key = cache.key("abc", "hb", conf)
+    assert cache.key("abd", "hb", conf) != key
+    assert cache.key("abc", "ke", conf) != key
+    for (name, value) in [
+        ("TpiPeriod", 100),
+        ("ContCalAction", "on"),
+        ("ContCalPolarity", "1"),
+        ("VsiAlign", "0"),
+    ]:
+        other = Conf(conf.DrudgBinary)
+        setattr(other, name, value)
+        assert cache.key("abc", "hb", other) != key
+
+
+def test_new_drudg(cache, conf):
+    key = cache.key("abc", "hb", conf)
+    write(conf.DrudgBinary, "drudg 2.0")
+    assert cache.key("abc", "hb", conf) != key
+
+
+@pytest.mark.parametrize("which", [0, 1])
+def test_control_files(cache, conf, which):
+    ctl = cache.control_files[which]
+    key = cache.key("abc", "hb", conf)
+    # a new equipment or skedf.ctl setting
+    write(ctl, "something else entirely\n")
+    changed = cache.key("abc", "hb", conf)
+    assert changed != key
+    os.remove(ctl)
+    assert cache.key("abc", "hb", conf) not in (key, changed)
+
+
+def test_store_restore(cache, tmpdir):
+    made = []
+    for ext in ["snp", "prc", "lst"]:
+        filename = str(tmpdir.join("r4951hb.{}".format(ext)))
+        write(filename, "made by drudg {}\n".format(ext))
+        made.append(filename)
+    key = "0" * 64
+    assert not cache.restore(key, made)
+    cache.store(key, made)
+    out = tmpdir.mkdir("out")
+    outfiles = [str(out.join(path)) for path in ["a.snp", "a.prc", "a.lst"]]
+    assert cache.restore(key, outfiles)
+    for (src, dst) in zip(made, outfiles):
+        with open(src) as fsrc, open(dst) as fdst:
+            assert fsrc.read() == fdst.read()
+    # only the cache entries are left in the cache directory
+    assert os.listdir(cache.directory) == [key]
+
+
+def test_prune(cache, tmpdir):
+    made = []
+    for ext in ["snp", "prc", "lst"]:
+        filename = str(tmpdir.join("r4951hb.{}".format(ext)))
+        write(filename, ext)
+        made.append(filename)
+    cache.store("old", made)
+    cache.store("new", made)
+    old = os.path.join(cache.directory, "old")
+    cutoff = os.stat(old).st_mtime - (cache.max_age_days + 1) * 86400
+    os.utime(old, (cutoff, cutoff))
+    cache.prune()
+    assert os.listdir(cache.directory) == ["new"]
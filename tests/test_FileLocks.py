@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""FileLocks: waiting for locks, and removing unused lock files without splitting a lock in two"""
+import fcntl
+import os
+import threading
+import time
+
+import pytest
+
+from fesh2.FileLocks import FileLocks, same_file
+
+
+@pytest.fixture
+def locks(tmpdir):
+    return FileLocks(str(tmpdir.join("locks")))
+
+
+def held_elsewhere(lock_file):
+    """Does someone hold a lock on the file (as it's named now)?"""
+    fd = os.open(lock_file, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+
+class Holder(threading.Thread):
+    """Takes a lock in another thread and holds it until released"""
+
+    def __init__(self, locks, name, shared=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.locks = locks
+        self.name_ = name
+        self.shared = shared
+        self.waited = None
+        self.has_lock = threading.Event()
+        self.release = threading.Event()
+
+    def run(self):
+        with self.locks.locked(self.name_, self.shared) as waited:
+            self.waited = waited
+            self.has_lock.set()
+            self.release.wait(10)
+
+
+def test_locked(locks):
+    with locks.locked("r4951.sched") as waited:
+        assert not waited
+        assert held_elsewhere(locks.lock_file("r4951.sched"))
+    assert not held_elsewhere(locks.lock_file("r4951.sched"))
+
+
+def test_wait(locks):
+    first = Holder(locks, "r4951.sched")
+    first.start()
+    assert first.has_lock.wait(5)
+    second = Holder(locks, "r4951.sched")
+    second.start()
+    time.sleep(0.2)
+    assert not second.has_lock.is_set()
+    first.release.set()
+    assert second.has_lock.wait(5)
+    assert second.waited
+    second.release.set()
+    first.join()
+    second.join()
+
+
+def test_shared(locks):
+    readers = [Holder(locks, "master21.txt", shared=True) for i in range(2)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        assert reader.has_lock.wait(5)
+        assert not reader.waited
+        reader.release.set()
+        reader.join()
+
+
+def test_prune(locks):
+    for name in ["old", "new", "held"]:
+        with locks.locked(name):
+            pass
+    old = time.time() - (locks.max_age_days + 1) * 86400
+    for name in ["old", "held"]:
+        os.utime(locks.lock_file(name), (old, old))
+    holder = Holder(locks, "held")
+    holder.start()
+    assert holder.has_lock.wait(5)
+    # taking the lock marked it as used, so make it old again
+    os.utime(locks.lock_file("held"), (old, old))
+    locks.prune()
+    assert not os.path.exists(locks.lock_file("old"))
+    assert os.path.exists(locks.lock_file("new"))
+    # in use, so it's left alone
+    assert os.path.exists(locks.lock_file("held"))
+    holder.release.set()
+    holder.join()
+
+
+def test_removed_while_waiting(locks):
+    """A waiter that gets the lock on a file that was removed in the meantime locks the new file instead, so
+    it can't hold the lock at the same time as someone who opened the new file."""
+    lock_file = locks.lock_file("r4951.sched")
+    first = Holder(locks, "r4951.sched")
+    first.start()
+    assert first.has_lock.wait(5)
+    second = Holder(locks, "r4951.sched")
+    second.start()
+    time.sleep(0.2)
+    # as prune would once the lock is free
+    os.remove(lock_file)
+    first.release.set()
+    first.join()
+    assert second.has_lock.wait(5)
+    assert second.waited
+    assert os.path.exists(lock_file)
+    assert held_elsewhere(lock_file)
+    second.release.set()
+    second.join()
+
+
+def test_same_file(tmpdir):
+    filename = str(tmpdir.join("a.lock"))
+    fd = os.open(filename, os.O_RDONLY | os.O_CREAT)
+    try:
+        assert same_file(fd, filename)
+        os.remove(filename)
+        assert not same_file(fd, filename)
+        os.close(os.open(filename, os.O_RDONLY | os.O_CREAT))
+        assert not same_file(fd, filename)
+    finally:
+        os.close(fd)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""SessionIndex against a linear scan of the same sessions, and the master file index"""
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from fesh2 import MasterSession
+from fesh2.MasterSession import (
+    Session,
+    SessionIndex,
+    load_master,
+    mask_stations,
+    master_index_filename,
+    parse_master,
+    station_mask,
+)
+
+STATIONS = ["hb", "ke", "yg", "wz", "ho", "mc", "ny", "on", "ww", "k2"]
+YEAR = 2021
+
+
+def master_line(i, start, hours, stations, removed):
+    return "|TEST{} |t{:04d}|{}|{:03d}|{}|{}|{} -{}|NASA|BONN|NASA|PF|DBC|SUB|DEL|".format(
+        i,
+        i,
+        start.strftime("%b%d").upper(),
+        start.timetuple().tm_yday,
+        start.strftime("%H:%M"),
+        hours,
+        "".join(stn.capitalize() for stn in stations),
+        "".join(stn.capitalize() for stn in removed),
+    )
+
+
+def make_lines(n=300, seed=1):
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(n):
+        start = datetime(YEAR, 1, 1) + timedelta(minutes=30 * rnd.randrange(0, 365 * 48))
+        stations = rnd.sample(STATIONS, rnd.randint(1, 6))
+        removed = rnd.sample([s for s in STATIONS if s not in stations], rnd.randint(0, 2))
+        lines.append(master_line(i, start, rnd.choice([1, 24, 25, 48]), stations, removed))
+    return lines
+
+
+@pytest.fixture
+def index():
+    return SessionIndex([Session(line, YEAR) for line in make_lines()])
+
+
+def matches(ses, stations, all_stations):
+    if stations is None:
+        return True
+    stations = set(stations)
+    if all_stations:
+        return stations <= ses.stations
+    return bool(stations & ses.stations)
+
+
+STATION_SETS = [None, ["hb"], ["hb", "ke"], ["wz", "ny", "k2"], ["xx"]]
+TIMES = [datetime(YEAR, m, d, h) for (m, d, h) in [(1, 1, 0), (3, 14, 12), (7, 1, 23), (12, 31, 6)]]
+
+
+def test_station_mask_round_trip():
+    assert mask_stations(station_mask(STATIONS)) == set(STATIONS)
+    assert mask_stations(0) == set()
+
+
+def test_parse_stations():
+    line = master_line(1, datetime(YEAR, 5, 1, 18), 24, ["hb", "ke"], ["yg"])
+    ses = Session(line, YEAR)
+    assert ses.code == "t0001"
+    assert ses.start == datetime(YEAR, 5, 1, 18)
+    assert ses.end == datetime(YEAR, 5, 2, 18)
+    assert ses.stations == set(["hb", "ke"])
+    assert ses.stations_removed == set(["yg"])
+
+
+@pytest.mark.parametrize("stations", STATION_SETS)
+@pytest.mark.parametrize("all_stations", [False, True])
+def test_running(index, stations, all_stations):
+    for now in TIMES:
+        expected = [
+            ses
+            for ses in index.sessions
+            if ses.start <= now < ses.end and matches(ses, stations, all_stations)
+        ]
+        assert index.running(now, stations, all_stations) == expected
+
+
+@pytest.mark.parametrize("stations", STATION_SETS)
+@pytest.mark.parametrize("all_stations", [False, True])
+def test_window(index, stations, all_stations):
+    for now in TIMES:
+        end = now + timedelta(days=7)
+        running = [ses for ses in index.sessions if ses.start <= now < ses.end]
+        starting = [
+            ses for ses in index.sessions if now <= ses.start < end and ses not in running
+        ]
+        expected = [
+            ses for ses in running + starting if matches(ses, stations, all_stations)
+        ]
+        assert index.window(now, timedelta(days=7), stations, all_stations) == expected
+
+
+@pytest.mark.parametrize("stations", STATION_SETS)
+@pytest.mark.parametrize("n", [None, 1, 5])
+def test_upcoming(index, stations, n):
+    for now in TIMES:
+        expected = [
+            ses
+            for ses in index.sessions
+            if (ses.start <= now < ses.end or ses.start >= now)
+            and matches(ses, stations, False)
+        ]
+        if n is not None:
+            expected = expected[:n]
+        assert index.upcoming(now, n, stations) == expected
+
+
+@pytest.mark.parametrize("stations", STATION_SETS[1:])
+@pytest.mark.parametrize("all_stations", [False, True])
+@pytest.mark.parametrize("removed", [False, True])
+def test_query(index, stations, all_stations, removed):
+    begin = datetime(YEAR, 2, 1)
+    end = datetime(YEAR, 9, 1)
+    for (lo, hi) in [(None, None), (begin, end)]:
+        expected = []
+        for ses in index.sessions:
+            if lo is not None and not lo <= ses.start < hi:
+                continue
+            have = ses.stations_removed if removed else ses.stations
+            if all_stations:
+                ok = set(stations) <= have
+            else:
+                ok = bool(set(stations) & have)
+            if ok:
+                expected.append(ses)
+        assert index.query(stations, all_stations, removed, lo, hi) == expected
+
+
+def test_sessions_by_station(index):
+    begin = datetime(YEAR, 4, 1)
+    end = datetime(YEAR, 6, 1)
+    result = index.sessions_by_station(STATIONS, begin, end)
+    for stn in STATIONS:
+        assert result[stn] == [
+            ses for ses in index.sessions if begin <= ses.start < end and stn in ses.stations
+        ]
+
+
+def test_with_codes(index):
+    codes = ["t0003", "T0100", "t0007", "nope"]
+    expected = [ses for ses in index.sessions if ses.code in ("t0003", "t0100", "t0007")]
+    assert index.with_codes(codes) == expected
+
+
+def same_sessions(a, b):
+    fields = ["line", "code", "start", "end", "station_mask", "removed_mask"]
+    return [[getattr(ses, f) for f in fields] for ses in a] == [
+        [getattr(ses, f) for f in fields] for ses in b
+    ]
+
+
+def test_master_index(tmpdir, monkeypatch):
+    monkeypatch.setattr(MasterSession, "_master_cache", {})
+    master = str(tmpdir.join("master21.txt"))
+    with open(master, "w") as fh:
+        fh.write("## header\n" + "\n".join(make_lines(50)) + "\n")
+    parsed = parse_master(master, YEAR)
+    assert same_sessions(load_master(master, YEAR), parsed)
+    index_file = master_index_filename(master)
+    with open(index_file) as fh:
+        # plain data, not a pickle
+        assert json.load(fh)["sha256"]
+
+    # read back from the index file rather than parsed
+    MasterSession._master_cache.clear()
+    monkeypatch.setattr(MasterSession, "parse_master", None)
+    assert same_sessions(load_master(master, YEAR), parsed)
+
+
+def test_bad_master_index(tmpdir, monkeypatch):
+    monkeypatch.setattr(MasterSession, "_master_cache", {})
+    master = str(tmpdir.join("master21.txt"))
+    with open(master, "w") as fh:
+        fh.write("\n".join(make_lines(20)) + "\n")
+    parsed = parse_master(master, YEAR)
+    index_file = master_index_filename(master)
+    for content in ["{not json", json.dumps({"version": MasterSession.INDEX_VERSION})]:
+        with open(index_file, "w") as fh:
+            fh.write(content)
+        MasterSession._master_cache.clear()
+        assert same_sessions(load_master(master, YEAR), parsed)
+        # and it's been rebuilt
+        assert MasterSession.read_master_index(index_file, master, YEAR) is not None
+
+
+def test_master_index_content_changed(tmpdir, monkeypatch):
+    monkeypatch.setattr(MasterSession, "_master_cache", {})
+    master = str(tmpdir.join("master21.txt"))
+    lines = make_lines(20)
+    with open(master, "w") as fh:
+        fh.write("\n".join(lines) + "\n")
+    stinfo = os.stat(master)
+    load_master(master, YEAR)
+    # same size and time, different content
+    with open(master, "w") as fh:
+        fh.write("\n".join(lines[1:] + lines[:1]) + "\n")
+    os.utime(master, (stinfo.st_atime, stinfo.st_mtime))
+    index_file = master_index_filename(master)
+    assert MasterSession.read_master_index(index_file, master, YEAR) is None
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""ServerHealth: the backoff of failing servers and the order servers are tried in"""
+import pytest
+
+from fesh2.ServerHealth import ServerHealth
+
+URL = "https://example.org/vlbi"
+
+
+@pytest.fixture
+def health(tmpdir):
+    health = ServerHealth(str(tmpdir))
+    yield health
+    health.close()
+
+
+def fail(health, entry, now, n=1):
+    for i in range(n):
+        entry = health.update(entry, now, False, 0, 0, 0)
+    return entry
+
+
+def test_backoff(health):
+    now = 1000000.0
+    entry = health.read(URL)
+    # not skipped until failures_to_skip failures in a row
+    entry = fail(health, entry, now, health.failures_to_skip - 1)
+    assert entry.failures == health.failures_to_skip - 1
+    assert entry.retry_after == 0
+    entry = fail(health, entry, now)
+    assert entry.retry_after == now + health.backoff_s
+    # doubling with each failure after that
+    entry = fail(health, entry, now)
+    assert entry.retry_after == now + 2 * health.backoff_s
+    entry = fail(health, entry, now)
+    assert entry.retry_after == now + 4 * health.backoff_s
+    # up to the maximum
+    entry = fail(health, entry, now, 20)
+    assert entry.retry_after == now + health.max_backoff_s
+    assert entry.attempts == health.failures_to_skip + 22
+
+
+def test_success_resets(health):
+    now = 1000000.0
+    entry = fail(health, health.read(URL), now, 5)
+    entry = health.update(entry, now + 10, True, 0.5, 2.0, 1000.0)
+    assert entry.failures == 0
+    assert entry.retry_after == 0
+    assert entry.last_success == now + 10
+    assert entry.response_s == 2.0
+    assert entry.connect_s == 0.5
+    assert entry.speed == 1000.0
+    # averaged from then on, and connect time and speed are only updated when measured
+    entry = health.update(entry, now + 20, True, 0, 4.0, 0)
+    assert entry.response_s == pytest.approx((1 - health.weight) * 2.0 + health.weight * 4.0)
+    assert entry.connect_s == 0.5
+    assert entry.speed == 1000.0
+
+
+def test_record_and_rank(tmpdir, health):
+    good = "https://good.example.org"
+    slow = "https://slow.example.org"
+    bad = "https://bad.example.org"
+    health.record(
+        [(good, True, 0.1, 0.5, 0), (slow, True, 0.1, 5.0, 0)]
+        + [(bad, False, 0, 0, 0)] * health.failures_to_skip
+    )
+    assert health.skipped(bad)
+    assert not health.skipped(good)
+    assert health.rank([bad, slow, good]) == [good, slow]
+    # new servers are tried first
+    assert health.rank([slow, good, "https://new.example.org"])[0] == "https://new.example.org"
+
+    # kept in the database for other instances
+    other = ServerHealth(str(tmpdir))
+    try:
+        assert other.get(bad).failures == health.failures_to_skip
+        assert other.rank([bad, slow, good]) == [good, slow]
+    finally:
+        other.close()
+
+
+def test_all_skipped(health):
+    urls = ["https://a.example.org", "https://b.example.org"]
+    health.record([(url, False, 0, 0, 0) for url in urls] * health.failures_to_skip)
+    assert all(health.skipped(url) for url in urls)
+    # they're all tried rather than none
+    assert sorted(health.rank(urls)) == urls